@@ -0,0 +1,128 @@
+'''
+Measures write throughput for enrollment-shaped rows with DataFrame.to_sql (the previous
+approach) and DBCreator.bulk_insert, both with LOAD DATA LOCAL INFILE and with its multi-row
+INSERT fallback. Rows are written to a scratch copy of the enrollment table (without foreign
+keys) in the INVENTORY_DB database, which is dropped afterwards. After each write the table's row
+count and column checksums are compared with the DataFrame's, so a path that loses or mangles
+rows is reported as unverified. Run from the repository root with ``python -m benchmarks.bulk_load``;
+the MySQL server needs local_infile enabled.
+'''
+
+# standard libraries
+import argparse, logging, time, zlib
+from typing import Callable, Dict, Tuple
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+
+# local libraries
+from db.db_creator import DBCreator
+from environ import ENV
+
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_TABLE_NAME = 'enrollment_bulk_load_benchmark'
+
+
+def make_enrollment_df(num_rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'canvas_id': np.arange(1, num_rows + 1, dtype=np.int64),
+        'user_id': rng.integers(1, 500000, num_rows),
+        'course_id': rng.integers(1, 20000, num_rows),
+        'course_section_id': rng.integers(1, 40000, num_rows),
+        'role_type': rng.choice(['StudentEnrollment', 'TeacherEnrollment', 'TaEnrollment'], num_rows),
+        'workflow_state': rng.choice(['active', 'completed', 'invited'], num_rows)
+    })
+
+
+def get_df_checksums(enrollment_df: pd.DataFrame) -> Tuple[int, ...]:
+    string_checksum = sum(
+        zlib.crc32(f'{role_type}|{workflow_state}'.encode('utf-8'))
+        for role_type, workflow_state in zip(enrollment_df['role_type'], enrollment_df['workflow_state'])
+    )
+    return (
+        len(enrollment_df),
+        int(enrollment_df['canvas_id'].sum()),
+        int(enrollment_df['user_id'].sum()),
+        int(enrollment_df['course_id'].sum()),
+        int(enrollment_df['course_section_id'].sum()),
+        string_checksum
+    )
+
+
+def get_table_checksums(db_creator_obj: DBCreator) -> Tuple[int, ...]:
+    row = db_creator_obj.engine.execute(
+        'SELECT COUNT(*), SUM(canvas_id), SUM(user_id), SUM(course_id), SUM(course_section_id), '
+        f"SUM(CRC32(CONCAT(role_type, '|', workflow_state))) FROM {SCRATCH_TABLE_NAME};"
+    ).fetchone()
+    return tuple(int(value or 0) for value in row)
+
+
+def measure(
+    name: str,
+    db_creator_obj: DBCreator,
+    write: Callable[[], None],
+    num_rows: int,
+    expected_checksums: Tuple[int, ...]
+) -> Dict:
+    db_creator_obj.engine.execute(f'TRUNCATE TABLE {SCRATCH_TABLE_NAME};')
+    start = time.perf_counter()
+    write()
+    seconds = time.perf_counter() - start
+    return {
+        'approach': name,
+        'rows': num_rows,
+        'seconds': round(seconds, 1),
+        'rows_per_second': round(num_rows / seconds),
+        'verified': get_table_checksums(db_creator_obj) == expected_checksums
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--skip-to-sql', action='store_true', help='Skip the slow to_sql baseline')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    db_creator_obj = DBCreator(ENV['INVENTORY_DB'])
+    enrollment_df = make_enrollment_df(args.rows)
+    expected_checksums = get_df_checksums(enrollment_df)
+
+    db_creator_obj.engine.execute(f'DROP TABLE IF EXISTS {SCRATCH_TABLE_NAME};')
+    db_creator_obj.engine.execute(f'CREATE TABLE {SCRATCH_TABLE_NAME} LIKE enrollment;')
+    try:
+        results = []
+        if not args.skip_to_sql:
+            results.append(measure(
+                'to_sql (before)', db_creator_obj,
+                lambda: enrollment_df.to_sql(
+                    SCRATCH_TABLE_NAME, db_creator_obj.engine, if_exists='append', index=False),
+                args.rows, expected_checksums
+            ))
+        results.append(measure(
+            'bulk_insert, LOAD DATA LOCAL INFILE', db_creator_obj,
+            lambda: db_creator_obj.bulk_insert(SCRATCH_TABLE_NAME, enrollment_df),
+            args.rows, expected_checksums
+        ))
+        results.append(measure(
+            'bulk_insert, upsert through temporary table', db_creator_obj,
+            lambda: db_creator_obj.bulk_insert(SCRATCH_TABLE_NAME, enrollment_df, on_duplicate='update'),
+            args.rows, expected_checksums
+        ))
+        db_creator_obj.local_infile_enabled = False
+        results.append(measure(
+            'bulk_insert, multi-row INSERT fallback', db_creator_obj,
+            lambda: db_creator_obj.bulk_insert(SCRATCH_TABLE_NAME, enrollment_df),
+            args.rows, expected_checksums
+        ))
+        print(pd.DataFrame(results).to_string(index=False))
+    finally:
+        db_creator_obj.engine.execute(f'DROP TABLE IF EXISTS {SCRATCH_TABLE_NAME};')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+'''
+Runs the real job entry points (run_course_inventory, the CanvasLtiPlacementProcessor report, and
+FetchPublishedDate) against a local mock Canvas server for synthetic datasets of increasing size,
+reporting wall time, peak RSS and request counts. Each job runs in its own process, so peak RSS
+is per job; the mock server runs in this process.
+
+The jobs write to the INVENTORY_DB database from the configuration, which must be a local MySQL
+database (e.g. the docker-compose one); its records (except reference data such as lti_type) are
+reset before each dataset. The course
+inventory job also needs a PostgreSQL database standing in for UDW: with --seed-udw, the UDW
+database from the configuration (which must also be local) gets course_section_dim and
+unizin_metadata tables matching the dataset. Run from the repository root with
+``python -m benchmarks.e2e_jobs``.
+'''
+
+# standard libraries
+import argparse, io, json, logging, resource, subprocess, sys, time
+from typing import Any, Callable, Dict, List
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from benchmarks.mock_canvas import MOCK_ACCOUNT_ID, MOCK_TERM_IDS, MockCanvasServer, SyntheticCanvas
+from db.db_creator import DBCreator
+from environ import ENV
+
+
+logger = logging.getLogger(__name__)
+
+JOB_NAMES = ['course_inventory', 'canvas_lti', 'published_date']
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', 'course_inventory_mysql')
+UDW_DATA_DATE = '2020-01-06 03:00:00.000000+0000'
+# Tables of reference data seeded by migrations, which are kept when the database is reset
+REFERENCE_TABLE_NAMES = ('lti_type',)
+
+
+def check_local_db(db_params: Dict[str, Any], db_label: str, allow_remote: bool) -> None:
+    if db_params.get('host') not in LOCAL_HOSTS and not allow_remote:
+        sys.exit(
+            f'{db_label} host {db_params.get("host")} doesn\'t look local, and the benchmark overwrites its data; '
+            'use --allow-remote-db if this is intended'
+        )
+
+
+def reset_database(db_creator_obj: DBCreator) -> List[int]:
+    '''
+    Empties the job tables (but not the reference tables) and applies any outstanding migrations;
+    returns the LTI tool IDs in lti_type, which the synthetic placements use.
+    '''
+    db_creator_obj.drop_records([
+        table_name for table_name in db_creator_obj.get_table_names()
+        if 'yoyo' not in table_name and table_name not in REFERENCE_TABLE_NAMES
+    ]).migrate()
+    tool_ids = [tool_id for tool_id in db_creator_obj.get_pk_values('lti_type', 'canvas_id') if tool_id is not None]
+    if not tool_ids:
+        logger.warning('lti_type is empty, so the datasets will have no LTI placements; re-apply its migration')
+    return tool_ids
+
+
+def seed_udw(dataset: SyntheticCanvas) -> None:
+    '''
+    Creates course_section_dim and unizin_metadata tables in the configured UDW database, with
+    the sections the mock GraphQL server assigns to each course (see make_enrollment_node).
+    '''
+    import psycopg2
+
+    section_lines = [
+        f'{course_id * 10 + i}\t{100000 + course_id}{i:03d}\n'
+        for course_id, course_size in dataset.course_sizes.items()
+        for i in range(min(course_size, 3))
+    ]
+    conn = psycopg2.connect(**ENV['UDW'])
+    with conn.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS course_section_dim;')
+        cursor.execute('CREATE TABLE course_section_dim (canvas_id BIGINT PRIMARY KEY, sis_source_id VARCHAR);')
+        cursor.copy_expert(
+            'COPY course_section_dim (canvas_id, sis_source_id) FROM STDIN;', io.StringIO(''.join(section_lines))
+        )
+        cursor.execute('DROP TABLE IF EXISTS unizin_metadata;')
+        cursor.execute('CREATE TABLE unizin_metadata (key VARCHAR, value VARCHAR);')
+        cursor.execute('INSERT INTO unizin_metadata VALUES (%s, %s);', ('canvasdatadate', UDW_DATA_DATE))
+    conn.commit()
+    conn.close()
+    logger.info(f'Seeded UDW with {len(section_lines)} course sections')
+
+
+def configure_for_mock(canvas_url: str) -> None:
+    '''
+    Points the configuration at the mock server; this has to happen before the job modules are
+    imported, since they read ENV when they are.
+    '''
+    ENV['CANVAS'] = {
+        **ENV.get('CANVAS', {}),
+        'CANVAS_ACCOUNT_ID': MOCK_ACCOUNT_ID,
+        'CANVAS_TERM_IDS': MOCK_TERM_IDS,
+        'ADD_COURSE_IDS': [],
+        'API_BASE_URL': canvas_url,
+        'API_SCOPE_PREFIX': 'aa/CanvasReadOnly',
+        'API_SUBSCRIPTION_NAME': 'canvasreadonly',
+        'API_CLIENT_ID': 'benchmark',
+        'API_CLIENT_SECRET': 'benchmark',
+        'CANVAS_URL': canvas_url,
+        'CANVAS_TOKEN': 'benchmark'
+    }
+    # The UDW stand-in only has section and metadata tables, and resuming would skew timings
+    ENV['ENROLLMENT_SOURCE'] = 'canvas_graphql'
+    ENV['CHECKPOINT_MAX_AGE_HOURS'] = 0
+    ENV['CREATE_CSVS'] = False
+    ENV['EXPORT_FORMATS'] = []
+
+
+def prepare_course_inventory() -> Callable[[], Any]:
+    from course_inventory.inventory import run_course_inventory
+    return run_course_inventory
+
+
+def prepare_canvas_lti() -> Callable[[], Any]:
+    from lti_placements.canvas_placements import main
+    return main
+
+
+def prepare_published_date() -> Callable[[], Any]:
+    from canvas_client.client import CanvasClient
+    from course_inventory.inventory import (
+        ACCOUNT_ID, CANVAS_TOKEN, CANVAS_URL, MAX_REQ_ATTEMPTS, NUM_ASYNC_WORKERS, RATE_LIMIT_THRESHOLD, TERM_IDS,
+        gather_course_data_from_api
+    )
+    from course_inventory.published_date import FetchPublishedDate
+
+    # Only fetching published dates is measured, not gathering the course data it starts from
+    course_df = gather_course_data_from_api(ACCOUNT_ID, TERM_IDS)
+    course_from_db_df = pd.DataFrame({
+        'canvas_id': pd.Series(dtype='int64'),
+        'published_at': pd.Series(dtype='datetime64[ns]'),
+        'checked_at': pd.Series(dtype='datetime64[ns]')
+    })
+
+    def run_published_date() -> pd.DataFrame:
+        canvas_client = CanvasClient(CANVAS_URL, CANVAS_TOKEN, NUM_ASYNC_WORKERS, RATE_LIMIT_THRESHOLD)
+        fetch_published_date = FetchPublishedDate(canvas_client, course_df, course_from_db_df, MAX_REQ_ATTEMPTS)
+        pub_dates_df = fetch_published_date.get_published_date()
+        canvas_client.close()
+        return pub_dates_df
+
+    return run_published_date
+
+
+# Each function imports a job's module and does any setup that shouldn't be measured, returning
+# the call to measure
+JOB_PREPARERS: Dict[str, Callable[[], Callable[[], Any]]] = {
+    'course_inventory': prepare_course_inventory,
+    'canvas_lti': prepare_canvas_lti,
+    'published_date': prepare_published_date
+}
+
+
+def run_child(job_name: str, canvas_url: str) -> None:
+    '''
+    Runs one job in this process and prints its measurements as JSON on the last line of stdout.
+    '''
+    configure_for_mock(canvas_url)
+    from instrumentation.http_metrics import HTTP_METRICS
+    from instrumentation.spans import record, span
+
+    run_job = JOB_PREPARERS[job_name]()
+    HTTP_METRICS.reset()
+    start = time.perf_counter()
+    with span(job_name) as job_span:
+        result = run_job()
+        if isinstance(result, pd.DataFrame):
+            record(rows=len(result))
+    seconds = time.perf_counter() - start
+
+    with HTTP_METRICS.lock:
+        endpoint_stats = list(HTTP_METRICS.endpoints.values())
+    print(json.dumps({
+        'seconds': round(seconds, 1),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        'client_requests': sum(stats.count for stats in endpoint_stats),
+        'client_retries': sum(stats.num_retries for stats in endpoint_stats),
+        'rows': job_span.rows_produced
+    }))
+
+
+def run_job_process(job_name: str, server: MockCanvasServer, log_level: str) -> Dict[str, Any]:
+    start_counts = server.get_request_counts()
+    completed_process = subprocess.run(
+        [
+            sys.executable, '-m', 'benchmarks.e2e_jobs',
+            '--child-job', job_name, '--canvas-url', server.url, '--log-level', log_level
+        ],
+        stdout=subprocess.PIPE, universal_newlines=True
+    )
+    request_counts = {
+        route_name: count - start_counts.get(route_name, 0)
+        for route_name, count in server.get_request_counts().items()
+        if count > start_counts.get(route_name, 0)
+    }
+    result: Dict[str, Any] = {'job': job_name, 'courses': server.dataset.num_courses}
+    if completed_process.returncode != 0:
+        logger.error(f'{job_name} failed with exit code {completed_process.returncode}')
+        result['failed'] = True
+    else:
+        result.update(json.loads(completed_process.stdout.strip().splitlines()[-1]))
+    result['server_requests'] = sum(
+        count for route_name, count in request_counts.items() if route_name != 'throttled'
+    )
+    result['throttled'] = request_counts.get('throttled', 0)
+    result['requests_by_route'] = request_counts
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of courses')
+    parser.add_argument('--jobs', nargs='+', choices=JOB_NAMES, default=JOB_NAMES)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per mock response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of responses that are 500s')
+    parser.add_argument(
+        '--rate-limit-capacity', type=float, default=700.0, help='Rate-limit bucket size; 0 disables throttling'
+    )
+    parser.add_argument('--rate-limit-refill', type=float, default=200.0, help='Bucket refill per second')
+    parser.add_argument('--usage-days', type=int, default=60, help='Days of course activity per course')
+    parser.add_argument('--seed-udw', action='store_true', help='Create UDW stand-in tables for each dataset')
+    parser.add_argument('--allow-remote-db', action='store_true')
+    parser.add_argument('--output', help='Also write the results, with requests by route, to this JSON file')
+    parser.add_argument('--log-level', default='WARNING', help='Log level for the job processes')
+    parser.add_argument('--child-job', choices=JOB_NAMES, help=argparse.SUPPRESS)
+    parser.add_argument('--canvas-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level if args.child_job else logging.INFO)
+    if args.child_job:
+        run_child(args.child_job, args.canvas_url)
+        return
+
+    check_local_db(ENV['INVENTORY_DB'], 'INVENTORY_DB', args.allow_remote_db)
+    if args.seed_udw:
+        check_local_db(ENV['UDW'], 'UDW', args.allow_remote_db)
+    db_creator_obj = DBCreator(ENV['INVENTORY_DB'])
+
+    results: List[Dict[str, Any]] = []
+    for num_courses in args.sizes:
+        tool_ids = reset_database(db_creator_obj)
+        dataset = SyntheticCanvas(num_courses, tool_ids, args.usage_days)
+        if args.seed_udw:
+            seed_udw(dataset)
+
+        server = MockCanvasServer(
+            dataset, args.latency, args.error_rate, args.rate_limit_capacity, args.rate_limit_refill
+        ).start()
+        for job_name in args.jobs:
+            logger.info(f'Running {job_name} with {num_courses} courses')
+            results.append(run_job_process(job_name, server, args.log_level))
+        server.shutdown()
+        server.server_close()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    print(pd.DataFrame(results).drop(columns=['requests_by_route']).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
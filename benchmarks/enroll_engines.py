@@ -0,0 +1,100 @@
+'''
+Compares the thread-based and asyncio-based GraphQL enrollment engines, with and without
+multi-course batching, against a local mock GraphQL server. Run from the repository root with
+``python -m benchmarks.enroll_engines``.
+'''
+
+# standard libraries
+import argparse, logging, random, time
+from typing import Dict, List, Type
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from canvas_client.client import CanvasClient
+from benchmarks.mock_graphql import MockGraphQLServer
+from course_inventory.aio_enroll_gatherer import AioEnrollGatherer
+from course_inventory.async_enroll_gatherer import AsyncEnrollGatherer
+from course_inventory.gql_queries import queries as QUERIES
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_course_sizes(num_courses: int, seed: int = 0) -> Dict[int, int]:
+    # Most courses are small, with a long tail of large ones
+    rng = random.Random(seed)
+    return {
+        course_id: min(int(rng.paretovariate(1.2) * 15), 5000)
+        for course_id in range(1, num_courses + 1)
+    }
+
+
+def run_engine(
+    gatherer_class: Type[AsyncEnrollGatherer],
+    server: MockGraphQLServer,
+    num_workers: int,
+    course_batch_size: int = 1
+) -> Dict:
+    canvas_client = CanvasClient(server.url, 'token', num_workers)
+    gatherer = gatherer_class(
+        course_ids=list(server.course_sizes.keys()),
+        canvas_client=canvas_client,
+        gql_query=QUERIES['course_enrollments'],
+        enroll_page_size=75,
+        num_workers=num_workers,
+        course_batch_size=course_batch_size
+    )
+    start_num_requests = server.num_requests
+    start = time.perf_counter()
+    gatherer.gather()
+    enrollment_df, section_df = gatherer.generate_output()
+    canvas_client.close()
+    return {
+        'engine': gatherer_class.__name__,
+        'num_workers': num_workers,
+        'batch_size': course_batch_size,
+        'seconds': round(time.perf_counter() - start, 2),
+        'requests': server.num_requests - start_num_requests,
+        'enrollments': len(enrollment_df),
+        'sections': len(section_df),
+        'output': (
+            enrollment_df.sort_values('canvas_id').reset_index(drop=True),
+            section_df.sort_values('canvas_id').reset_index(drop=True)
+        )
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--courses', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per mock response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--thread-workers', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--async-workers', type=int, nargs='+', default=[8, 32, 256])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = MockGraphQLServer(make_course_sizes(args.courses), args.latency, args.error_rate).start()
+
+    results: List[Dict] = []
+    for course_batch_size in args.batch_sizes:
+        for num_workers in args.thread_workers:
+            results.append(run_engine(AsyncEnrollGatherer, server, num_workers, course_batch_size))
+        for num_workers in args.async_workers:
+            results.append(run_engine(AioEnrollGatherer, server, num_workers, course_batch_size))
+    server.shutdown()
+
+    baseline_enrollment_df, baseline_section_df = results[0]['output']
+    for result in results:
+        enrollment_df, section_df = result.pop('output')
+        result['same_output'] = (
+            enrollment_df.equals(baseline_enrollment_df) and section_df.equals(baseline_section_df)
+        )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
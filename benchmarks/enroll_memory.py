@@ -0,0 +1,103 @@
+'''
+Measures peak traced memory while accumulating GraphQL enrollment pages and generating the
+output DataFrames, comparing the previous approach (keeping raw nodes until generate_output,
+then flattening to dicts) with AsyncEnrollGatherer's column buffers. Run from the repository
+root with ``python -m benchmarks.enroll_memory``.
+'''
+
+# standard libraries
+import argparse, gc, json, logging, time, tracemalloc
+from typing import Dict, Iterator, List, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from canvas_client.client import CanvasClient
+from benchmarks.mock_graphql import make_enrollment_node
+from course_inventory.async_enroll_gatherer import AsyncEnrollGatherer
+
+
+logger = logging.getLogger(__name__)
+
+
+def generate_pages(num_enrollments: int, page_size: int = 75, course_size: int = 150) -> Iterator[str]:
+    for offset in range(0, num_enrollments, page_size):
+        course_id = offset // course_size + 1
+        nodes = [
+            make_enrollment_node(course_id, i % course_size)
+            for i in range(offset, min(num_enrollments, offset + page_size))
+        ]
+        # Make IDs unique across the run
+        for i, node in enumerate(nodes):
+            node['_id'] = str(offset + i)
+        yield json.dumps({'data': {'course': {
+            '_id': str(course_id),
+            'enrollmentsConnection': {
+                'nodes': nodes,
+                'pageInfo': {'endCursor': '', 'hasNextPage': False}
+            }
+        }}})
+
+
+def run_legacy(num_enrollments: int) -> Tuple[pd.DataFrame, ...]:
+    raw_nodes: List[Dict] = []
+    for page_text in generate_pages(num_enrollments):
+        raw_nodes += json.loads(page_text)['data']['course']['enrollmentsConnection']['nodes']
+
+    enrollment_records = []
+    section_records = []
+    for node in raw_nodes:
+        enrollment_records.append({
+            'canvas_id': int(node['_id']),
+            'user_id': int(node['user']['_id']),
+            'course_id': int(node['course']['_id']),
+            'course_section_id': int(node['section']['_id']),
+            'role_type': node['type'],
+            'workflow_state': node['state']
+        })
+        section_records.append({'canvas_id': int(node['section']['_id']), 'name': node['section']['name']})
+    enrollment_df = pd.DataFrame(enrollment_records).drop_duplicates(subset=['canvas_id'], keep='last')
+    section_df = pd.DataFrame(section_records).drop_duplicates(subset=['canvas_id'], keep='last')
+    return (enrollment_df, section_df)
+
+
+def run_buffered(num_enrollments: int) -> Tuple[pd.DataFrame, ...]:
+    gatherer = AsyncEnrollGatherer([], CanvasClient('http://localhost', 'token'), '')
+    for page_text in generate_pages(num_enrollments):
+        gatherer.parse_enrollment_page(200, page_text)
+    return gatherer.generate_output()
+
+
+def measure(name: str, func, num_enrollments: int) -> Dict:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    enrollment_df, section_df = func(num_enrollments)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'approach': name,
+        'enrollments': len(enrollment_df),
+        'sections': len(section_df),
+        'peak_mib': round(peak / 2 ** 20, 1),
+        'seconds': round(seconds, 1)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--enrollments', type=int, default=500000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = [
+        measure('raw nodes + dicts (before)', run_legacy, args.enrollments),
+        measure('column buffers (after)', run_buffered, args.enrollments)
+    ]
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Measures how peak RSS grows with the number of courses while fetching published dates and course
+usage from a local mock Canvas server, comparing the previous approach (a future for every course
+submitted up front and kept until the round finishes) with RetryScheduler's bounded window of
+streamed requests. Each measurement runs in its own process; the growth reported is the peak RSS
+during the fetch less the RSS before it, alongside the number of results kept (published dates, or
+course usage rows). The window keeps the memory used for requests and responses flat; what grows
+is the results, which the job loads once the fetch (and the course table load) is done. The
+previous approach is measured for the first round only (no follow-up pages or retries). Run from
+the repository root with ``python -m benchmarks.fetch_memory``.
+'''
+
+# standard libraries
+import argparse, functools, json, logging, resource, subprocess, sys, time
+from concurrent.futures import as_completed
+from typing import Any, Callable, Dict, List
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from benchmarks.mock_canvas import MockCanvasServer, SyntheticCanvas
+from canvas_client.client import CanvasClient
+from course_inventory.canvas_course_usage import CanvasCourseUsage
+from course_inventory.published_date import FetchPublishedDate
+
+
+logger = logging.getLogger(__name__)
+
+FETCHER_NAMES = ['published_date', 'course_usage']
+APPROACHES = ['all_futures', 'window']
+
+
+def get_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fetch_with_all_futures(
+    canvas_client: CanvasClient,
+    urls: List[str],
+    handler: Callable[[Any], Any]
+) -> None:
+    responses = [canvas_client.get_async(url) for url in urls]
+    for response in as_completed(responses):
+        handler(response.result())
+
+
+def run_child(fetcher_name: str, approach: str, num_courses: int, canvas_url: str, num_workers: int) -> None:
+    '''
+    Runs one fetch in this process and prints its measurements as JSON on the last line of stdout.
+    '''
+    canvas_client = CanvasClient(canvas_url, 'benchmark', num_workers)
+    course_ids = list(range(1, num_courses + 1))
+    if fetcher_name == 'published_date':
+        fetcher = FetchPublishedDate(canvas_client, pd.DataFrame(), pd.DataFrame(), 3)
+        urls = [f'/api/v1/audit/course/courses/{course_id}?per_page=100' for course_id in course_ids]
+        handler = fetcher.published_date_resp_parsing
+        fetch_in_window = functools.partial(fetcher.get_published_course_date, course_ids)
+    else:
+        fetcher = CanvasCourseUsage(canvas_client, 3, course_ids)
+        urls = [f'/api/v1/courses/{course_id}/analytics/activity' for course_id in course_ids]
+        handler = fetcher.parsing_canvas_course_usage_data
+        fetch_in_window = fetcher._get_canvas_course_views_participation_data
+
+    if approach == 'window':
+        # The request list is built lazily, so it isn't counted against this approach
+        del urls
+    start_rss_mib = get_rss_mib()
+    start = time.perf_counter()
+    if approach == 'window':
+        fetch_in_window()
+    else:
+        fetch_with_all_futures(canvas_client, urls, handler)
+    seconds = time.perf_counter() - start
+    canvas_client.close()
+    print(json.dumps({
+        'seconds': round(seconds, 1),
+        'results': len(fetcher.published_course_date if fetcher_name == 'published_date' else fetcher.usage_buffer),
+        'start_rss_mib': round(start_rss_mib),
+        'rss_growth_mib': round(get_rss_mib() - start_rss_mib)
+    }))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 10000, 40000], help='Numbers of courses')
+    parser.add_argument('--fetchers', nargs='+', choices=FETCHER_NAMES, default=FETCHER_NAMES)
+    parser.add_argument('--approaches', nargs='+', choices=APPROACHES, default=APPROACHES)
+    parser.add_argument('--usage-days', type=int, default=120, help='Days of course activity per course')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--child', nargs=4, metavar=('FETCHER', 'APPROACH', 'COURSES', 'URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.child:
+        fetcher_name, approach, num_courses, canvas_url = args.child
+        run_child(fetcher_name, approach, int(num_courses), canvas_url, args.workers)
+        return
+
+    results: List[Dict[str, Any]] = []
+    for num_courses in args.sizes:
+        server = MockCanvasServer(
+            SyntheticCanvas(num_courses, usage_days=args.usage_days), latency=0.0, rate_limit_capacity=None
+        ).start()
+        for fetcher_name in args.fetchers:
+            for approach in args.approaches:
+                completed_process = subprocess.run(
+                    [
+                        sys.executable, '-m', 'benchmarks.fetch_memory', '--workers', str(args.workers),
+                        '--child', fetcher_name, approach, str(num_courses), server.url
+                    ],
+                    stdout=subprocess.PIPE, universal_newlines=True, check=True
+                )
+                results.append({
+                    'fetcher': fetcher_name,
+                    'approach': approach,
+                    'courses': num_courses,
+                    **json.loads(completed_process.stdout.strip().splitlines()[-1])
+                })
+        server.shutdown()
+        server.server_close()
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+'''
+Compares the memory used by the course, enrollment, course_section and canvas_course_usage
+DataFrames with default dtypes (as they were built before) and with the compact dtypes from
+course_inventory.schema, for a synthetic dataset. Reports each frame's size and the peak traced
+memory while building it. Run from the repository root with ``python -m benchmarks.inventory_dtypes``.
+'''
+
+# standard libraries
+import argparse, gc, logging, tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from benchmarks.mock_canvas import SyntheticCanvas
+from benchmarks.mock_graphql import make_enrollment_node
+from course_inventory.async_enroll_gatherer import EnrollmentBuffer
+from course_inventory.canvas_course_usage import CanvasCourseUsage
+from course_inventory.schema import apply_schema
+
+
+logger = logging.getLogger(__name__)
+
+CANVAS_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def measure(build: Callable[[], pd.DataFrame]) -> Tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+    df = build()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (int(df.memory_usage(deep=True).sum()), peak_bytes)
+
+
+def make_course_dicts(dataset: SyntheticCanvas) -> List[Dict[str, Any]]:
+    course_dicts = []
+    for course_id in range(1, dataset.num_courses + 1):
+        course = dataset.make_course(course_id)
+        course_dicts.append({
+            'canvas_id': course['id'],
+            'sis_id': course['sis_course_id'],
+            'name': course['name'],
+            'account_id': course['account_id'],
+            'term_id': course['enrollment_term_id'],
+            'created_at': course['created_at'],
+            'workflow_state': course['workflow_state'],
+            'total_students': course['total_students']
+        })
+    return course_dicts
+
+
+def build_course_df_before(course_dicts: List[Dict[str, Any]]) -> pd.DataFrame:
+    course_df = pd.DataFrame(course_dicts)
+    course_df['created_at'] = pd.to_datetime(course_df['created_at'], format=CANVAS_DATETIME_FORMAT, errors='coerce')
+    return course_df
+
+
+def build_course_df_after(course_dicts: List[Dict[str, Any]]) -> pd.DataFrame:
+    return apply_schema(build_course_df_before(course_dicts), 'course')
+
+
+def build_enrollment_dfs_before(enrollment_buffer: EnrollmentBuffer) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    enrollment_df, section_df = enrollment_buffer.to_dfs()
+    enrollment_df = enrollment_df.astype({
+        'canvas_id': 'int64', 'course_id': 'int64', 'course_section_id': 'int64',
+        'role_type': 'object', 'workflow_state': 'object'
+    })
+    return (enrollment_df, section_df.astype({'canvas_id': 'int64'}))
+
+
+def make_usage_responses(dataset: SyntheticCanvas) -> List[Tuple[int, List[Dict[str, Any]]]]:
+    return [(course_id, dataset.make_activity(course_id)) for course_id in range(1, dataset.num_courses + 1)]
+
+
+def build_usage_df_before(usage_responses: List[Tuple[int, List[Dict[str, Any]]]]) -> pd.DataFrame:
+    rows = []
+    for course_id, analytics in usage_responses:
+        for row in analytics:
+            rows.append({**row, 'course_id': str(course_id)})
+    return pd.DataFrame(rows).drop(['id'], axis=1).drop_duplicates()
+
+
+def build_usage_df_after(usage_responses: List[Tuple[int, List[Dict[str, Any]]]]) -> pd.DataFrame:
+    canvas_course_usage = CanvasCourseUsage(None, 0, [])
+    for course_id, analytics in usage_responses:
+        canvas_course_usage.usage_buffer.add_rows(course_id, analytics)
+    return canvas_course_usage.canvas_course_usage_to_df()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--courses', type=int, default=20000)
+    parser.add_argument('--usage-days', type=int, default=120)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    dataset = SyntheticCanvas(args.courses, usage_days=args.usage_days)
+    course_dicts = make_course_dicts(dataset)
+
+    enrollment_buffer = EnrollmentBuffer()
+    for course_id, course_size in dataset.course_sizes.items():
+        enrollment_buffer.add_nodes([make_enrollment_node(course_id, i) for i in range(course_size)])
+
+    usage_responses = make_usage_responses(dataset)
+
+    results = []
+    comparisons = [
+        ('course', lambda: build_course_df_before(course_dicts), lambda: build_course_df_after(course_dicts)),
+        (
+            'enrollment',
+            lambda: build_enrollment_dfs_before(enrollment_buffer)[0],
+            lambda: enrollment_buffer.to_dfs()[0]
+        ),
+        (
+            'course_section',
+            lambda: build_enrollment_dfs_before(enrollment_buffer)[1],
+            lambda: enrollment_buffer.to_dfs()[1]
+        ),
+        (
+            'canvas_course_usage',
+            lambda: build_usage_df_before(usage_responses),
+            lambda: build_usage_df_after(usage_responses)
+        )
+    ]
+    for table_name, build_before, build_after in comparisons:
+        size_before, peak_before = measure(build_before)
+        size_after, peak_after = measure(build_after)
+        results.append({
+            'table': table_name,
+            'frame_mib_before': round(size_before / 2 ** 20, 1),
+            'frame_mib_after': round(size_after / 2 ** 20, 1),
+            'peak_mib_before': round(peak_before / 2 ** 20, 1),
+            'peak_mib_after': round(peak_after / 2 ** 20, 1)
+        })
+    results_df = pd.DataFrame(results)
+    results_df.loc[len(results_df)] = ['total', *results_df.drop(columns=['table']).sum().round(1)]
+    print(results_df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+'''
+A local stand-in for the Canvas REST and GraphQL APIs (and the U-M API Directory's token
+endpoint), serving a synthetic dataset. Responses can be delayed, fail at a configurable rate,
+carry Canvas-style rate-limit headers (with 403 "Rate Limit Exceeded" responses once the
+server's cost bucket runs dry), and are paginated with Link headers like Canvas's.
+'''
+
+# standard libraries
+import json, random, re, threading, time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# local libraries
+from benchmarks.mock_graphql import MockGraphQLHandler, MockGraphQLServer
+
+
+MOCK_ACCOUNT_ID = 1
+MOCK_TERM_IDS = [164, 165]
+NUM_SUB_ACCOUNTS = 50
+MAX_PER_PAGE = 100
+
+CANVAS_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+BASE_DATETIME = datetime(2020, 1, 6, 9)
+
+
+class SyntheticCanvas:
+    '''
+    A deterministic synthetic Canvas instance: num_courses courses spread across MOCK_TERM_IDS
+    and sub-accounts of MOCK_ACCOUNT_ID, with long-tailed enrollment counts. Everything except the
+    enrollment counts is derived from the course ID when requested, so large datasets stay small
+    in memory. External tool tabs use tool_ids (e.g. the canvas_id values in lti_type).
+    '''
+
+    def __init__(
+        self,
+        num_courses: int,
+        tool_ids: Sequence[int] = (),
+        usage_days: int = 60,
+        seed: int = 0
+    ) -> None:
+        self.num_courses: int = num_courses
+        self.tool_ids: List[int] = list(tool_ids)
+        self.usage_days: int = usage_days
+        self.seed: int = seed
+
+        rng = random.Random(seed)
+        # Most courses are small, with a long tail of large ones; some have no students
+        self.course_sizes: Dict[int, int] = {
+            course_id: 0 if rng.random() < 0.1 else min(int(rng.paretovariate(1.2) * 15), 5000)
+            for course_id in range(1, num_courses + 1)
+        }
+
+    def get_rng(self, course_id: int, salt: int = 0) -> random.Random:
+        return random.Random(self.seed * 1000003 + course_id * 31 + salt)
+
+    def get_term_course_ids(self, term_id: int) -> range:
+        term_index = MOCK_TERM_IDS.index(term_id)
+        return range(term_index + 1, self.num_courses + 1, len(MOCK_TERM_IDS))
+
+    def get_workflow_state(self, course_id: int) -> str:
+        state_value = self.get_rng(course_id).random()
+        if state_value < 0.8:
+            return 'available'
+        return 'unpublished' if state_value < 0.95 else 'completed'
+
+    def make_course(self, course_id: int) -> Dict[str, Any]:
+        rng = self.get_rng(course_id, 1)
+        return {
+            'id': course_id,
+            'sis_course_id': str(100000 + course_id),
+            'name': f'COURSE {course_id} {MOCK_TERM_IDS[(course_id - 1) % len(MOCK_TERM_IDS)]}',
+            'account_id': MOCK_ACCOUNT_ID + 1 + course_id % NUM_SUB_ACCOUNTS,
+            'enrollment_term_id': MOCK_TERM_IDS[(course_id - 1) % len(MOCK_TERM_IDS)],
+            'created_at': (BASE_DATETIME - timedelta(hours=rng.randrange(24 * 120))).strftime(CANVAS_DATETIME_FORMAT),
+            'workflow_state': self.get_workflow_state(course_id),
+            'total_students': self.course_sizes[course_id]
+        }
+
+    def make_term(self, term_id: int) -> Dict[str, Any]:
+        start_at = BASE_DATETIME + timedelta(days=120 * MOCK_TERM_IDS.index(term_id))
+        return {
+            'id': term_id,
+            'name': f'Term {term_id}',
+            'sis_term_id': str(2000 + term_id),
+            'start_at': start_at.strftime(CANVAS_DATETIME_FORMAT),
+            'end_at': (start_at + timedelta(days=110)).strftime(CANVAS_DATETIME_FORMAT)
+        }
+
+    def make_account(self, account_id: int) -> Dict[str, Any]:
+        account = {'id': account_id, 'name': f'Account {account_id}'}
+        if account_id % 5 != 0:
+            account['sis_account_id'] = str(account_id * 10)
+        return account
+
+    def make_audit_events(self, course_id: int) -> List[Dict[str, Any]]:
+        '''
+        Returns the course's audit events, newest first. Available courses have a "published"
+        event among up to 150 "updated" ones (so some need a second page); the rest have none.
+        '''
+        rng = self.get_rng(course_id, 2)
+        num_events = rng.randint(1, 150)
+        published_index = rng.randrange(num_events) if self.get_workflow_state(course_id) == 'available' else None
+        return [
+            {
+                'id': f'{course_id}-{i}',
+                'created_at': (BASE_DATETIME - timedelta(hours=i * 3 + course_id % 7)).strftime(CANVAS_DATETIME_FORMAT),
+                'event_type': 'published' if i == published_index else 'updated',
+                'event_source': 'manual',
+                'links': {'course': course_id, 'user': 1}
+            }
+            for i in range(num_events)
+        ]
+
+    def make_activity(self, course_id: int) -> List[Dict[str, Any]]:
+        rng = self.get_rng(course_id, 3)
+        activity = []
+        for day in range(self.usage_days):
+            views = rng.randrange(0, 4 * (self.course_sizes[course_id] + 1))
+            activity.append({
+                'date': (BASE_DATETIME.date() - timedelta(days=day)).isoformat(),
+                'id': day,
+                'participations': rng.randrange(0, views + 1),
+                'views': views
+            })
+        return activity
+
+    def make_tabs(self, course_id: int) -> List[Dict[str, Any]]:
+        rng = self.get_rng(course_id, 4)
+        tabs: List[Dict[str, Any]] = [
+            {'id': 'home', 'label': 'Home', 'type': 'internal', 'position': 1},
+            {'id': 'syllabus', 'label': 'Syllabus', 'type': 'internal', 'position': 2}
+        ]
+        num_tools = rng.randint(0, min(3, len(self.tool_ids)))
+        for tool_id in rng.sample(self.tool_ids, num_tools):
+            # Labels never say "Zoom", so the job doesn't try to launch the real Zoom LTI
+            tab = {
+                'id': f'context_external_tool_{tool_id}',
+                'label': f'Tool {tool_id}',
+                'type': 'external',
+                'position': len(tabs) + 1,
+                'url': f'/api/v1/courses/{course_id}/external_tools/sessionless_launch?id={tool_id}'
+            }
+            if rng.random() < 0.2:
+                tab['hidden'] = True
+            tabs.append(tab)
+        return tabs
+
+
+class RateLimitBucket:
+    '''
+    Models Canvas's per-token rate limit: each request drains its cost from a bucket of the
+    given capacity, which refills continuously; requests arriving when it's empty are throttled.
+    '''
+
+    def __init__(self, capacity: float, refill_rate: float) -> None:
+        self.capacity: float = capacity
+        self.refill_rate: float = refill_rate
+        self.remaining: float = capacity
+        self.updated_at: float = time.monotonic()
+        self.lock: threading.Lock = threading.Lock()
+
+    def spend(self, cost: float) -> Tuple[bool, float]:
+        '''
+        Returns whether the request is allowed, and what remains in the bucket.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.remaining = min(self.capacity, self.remaining + (now - self.updated_at) * self.refill_rate)
+            self.updated_at = now
+            if self.remaining < cost:
+                return (False, self.remaining)
+            self.remaining -= cost
+            return (True, self.remaining)
+
+
+class MockCanvasHandler(MockGraphQLHandler):
+
+    routes: List[Tuple[str, re.Pattern]] = [
+        ('terms', re.compile(r'/accounts/(\d+)/terms/(\d+)/?$')),
+        ('courses', re.compile(r'/accounts/(\d+)/courses/?$')),
+        ('account', re.compile(r'/accounts/(\d+)/?$')),
+        ('audit', re.compile(r'/audit/course/courses/(\d+)/?$')),
+        ('analytics', re.compile(r'/courses/(\d+)/analytics/activity/?$')),
+        ('tabs', re.compile(r'/courses/(\d+)/tabs/?$')),
+        ('course', re.compile(r'/courses/(\d+)/?$'))
+    ]
+
+    def reset_response_headers(self) -> None:
+        # One handler serves every request on a keep-alive connection
+        self.link_headers: Dict[str, str] = {}
+        self.rate_limit_remaining: Optional[float] = None
+
+    def get_extra_headers(self) -> Dict[str, str]:
+        headers = self.link_headers
+        if self.rate_limit_remaining is not None:
+            headers = {
+                **headers,
+                'X-Rate-Limit-Remaining': f'{self.rate_limit_remaining:.1f}',
+                'X-Request-Cost': f'{self.server.request_cost:.1f}'
+            }
+        return headers
+
+    def begin_request(self, route_name: str) -> bool:
+        '''
+        Counts the request and applies the rate limit; returns False if the request was throttled
+        (and a 403 response was sent).
+        '''
+        self.server.count_request(route_name)
+        if self.server.rate_limit_bucket is not None:
+            allowed, self.rate_limit_remaining = self.server.rate_limit_bucket.spend(self.server.request_cost)
+            if not allowed:
+                self.server.count_request('throttled')
+                self.send_body(403, b'403 Forbidden (Rate Limit Exceeded)')
+                return False
+        return True
+
+    def do_POST(self) -> None:
+        self.reset_response_headers()
+        if 'oauth2/token' in self.path:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_body(200, json.dumps({
+                'access_token': 'mock-token', 'token_type': 'bearer', 'expires_in': 3600, 'scope': 'canvasreadonly'
+            }).encode())
+        elif urlparse(self.path).path.rstrip('/').endswith('/api/graphql'):
+            if not self.begin_request('graphql'):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                return
+            super().do_POST()
+        else:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_body(404, b'{"errors": [{"message": "The specified resource does not exist."}]}')
+
+    def do_GET(self) -> None:
+        self.reset_response_headers()
+        parsed_url = urlparse(self.path)
+        params = parse_qs(parsed_url.query)
+        for route_name, route_pattern in self.routes:
+            route_match = route_pattern.search(parsed_url.path)
+            if route_match is not None:
+                break
+        else:
+            self.send_body(404, b'{"errors": [{"message": "The specified resource does not exist."}]}')
+            return
+
+        if not self.begin_request(route_name):
+            return
+        with self.server.lock:
+            self.server.num_requests += 1
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send_body(500, b'{"errors": [{"message": "Mock error"}]}')
+            return
+
+        ids = [int(group) for group in route_match.groups()]
+        dataset: SyntheticCanvas = self.server.dataset
+        body: Any
+        if route_name == 'terms':
+            body = dataset.make_term(ids[1])
+        elif route_name == 'account':
+            body = dataset.make_account(ids[0])
+        elif route_name == 'course':
+            body = dataset.make_course(ids[0])
+        elif route_name == 'courses':
+            term_ids = params.get('enrollment_term_id', [str(term_id) for term_id in MOCK_TERM_IDS])
+            course_ids = [
+                course_id for term_id in term_ids for course_id in dataset.get_term_course_ids(int(term_id))
+            ]
+            if params.get('published', [''])[0] == 'true':
+                course_ids = [
+                    course_id for course_id in course_ids if dataset.get_workflow_state(course_id) == 'available'
+                ]
+            body = [dataset.make_course(course_id) for course_id in self.paginate(course_ids, params)]
+        elif route_name == 'audit':
+            events = dataset.make_audit_events(ids[0])
+            if 'start_time' in params:
+                # Times are all formatted the same way, so they compare as strings
+                events = [event for event in events if event['created_at'] >= params['start_time'][0]]
+            events = self.paginate(events, params)
+            body = {'links': {}, 'events': events, 'linked': {}}
+        elif route_name == 'analytics':
+            body = dataset.make_activity(ids[0])
+        else:
+            body = self.paginate(dataset.make_tabs(ids[0]), params)
+        self.send_body(200, json.dumps(body).encode())
+
+    def paginate(self, items: Sequence[Any], params: Dict[str, List[str]]) -> Sequence[Any]:
+        '''
+        Returns the requested page of items, setting Link headers the way Canvas does (current,
+        next, prev, first and last, with numeric page parameters).
+        '''
+        per_page = min(int(params.get('per_page', ['10'])[0]), MAX_PER_PAGE)
+        page = int(params.get('page', ['1'])[0])
+        last_page = max(1, -(-len(items) // per_page))
+
+        def make_page_url(page_num: int) -> str:
+            page_params = {**params, 'page': [str(page_num)], 'per_page': [str(per_page)]}
+            return f'{self.server.url}{urlparse(self.path).path}?{urlencode(page_params, doseq=True)}'
+
+        links = [f'<{make_page_url(page)}>; rel="current"']
+        if page < last_page:
+            links.append(f'<{make_page_url(page + 1)}>; rel="next"')
+        if page > 1:
+            links.append(f'<{make_page_url(page - 1)}>; rel="prev"')
+        links.append(f'<{make_page_url(1)}>; rel="first"')
+        links.append(f'<{make_page_url(last_page)}>; rel="last"')
+        self.link_headers = {'Link': ','.join(links)}
+        return items[(page - 1) * per_page:page * per_page]
+
+
+class MockCanvasServer(MockGraphQLServer):
+    '''
+    Serves a SyntheticCanvas. Without a rate_limit_capacity, requests are never throttled and no
+    rate-limit headers are sent.
+    '''
+
+    def __init__(
+        self,
+        dataset: SyntheticCanvas,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        rate_limit_capacity: Optional[float] = 700.0,
+        rate_limit_refill_rate: float = 200.0,
+        request_cost: float = 1.0
+    ) -> None:
+        super().__init__(dataset.course_sizes, latency, error_rate)
+        self.RequestHandlerClass = MockCanvasHandler
+        self.dataset: SyntheticCanvas = dataset
+        self.request_cost: float = request_cost
+        self.rate_limit_bucket: Optional[RateLimitBucket] = (
+            RateLimitBucket(rate_limit_capacity, rate_limit_refill_rate) if rate_limit_capacity else None
+        )
+        self.request_counts: Counter = Counter()
+
+    def count_request(self, route_name: str) -> None:
+        with self.lock:
+            self.request_counts[route_name] += 1
+
+    def get_request_counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.request_counts)
@@ -0,0 +1,106 @@
+# standard libraries
+import json, logging, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_enrollment_node(course_id: int, index: int) -> Dict:
+    section_id = course_id * 10 + index % 3
+    return {
+        '_id': str(course_id * 100000 + index),
+        'section': {'_id': str(section_id), 'name': f'Section {section_id}'},
+        'state': 'active',
+        'type': 'TeacherEnrollment' if index == 0 else 'StudentEnrollment',
+        'user': {'_id': str(index + 1)},
+        'course': {'_id': str(course_id)}
+    }
+
+
+class MockGraphQLHandler(BaseHTTPRequestHandler):
+    '''
+    Answers courseEnrollmentsQuery and batchedCourseEnrollmentsQuery requests using the server's
+    course_sizes mapping. Cursors are enrollment offsets encoded as strings.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        logger.debug(format % args)
+
+    def get_extra_headers(self) -> Dict[str, str]:
+        return {}
+
+    def send_body(self, status_code: int, body: bytes) -> None:
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header_name, header_value in self.get_extra_headers().items():
+            self.send_header(header_name, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        request_data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.num_requests += 1
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send_body(500, b'{"errors": ["Mock error"]}')
+            return
+
+        variables = request_data['variables']
+        page_size = variables['enrollmentPageSize']
+        if 'courseID' in variables:
+            course_data = {
+                'course': self.get_course_data(
+                    int(variables['courseID']), page_size, int(variables['enrollmentPageCursor'] or 0)
+                )
+            }
+        else:
+            # Batched query, with courses aliased as course0, course1, etc.
+            course_data = {
+                name.replace('courseID', 'course'): self.get_course_data(int(course_id), page_size, 0)
+                for name, course_id in variables.items() if name.startswith('courseID')
+            }
+        self.send_body(200, json.dumps({'data': course_data}).encode())
+
+    def get_course_data(self, course_id: int, page_size: int, start: int) -> Dict:
+        course_size = self.server.course_sizes.get(course_id, 0)
+        end = min(course_size, start + page_size)
+        return {
+            '_id': str(course_id),
+            'enrollmentsConnection': {
+                'nodes': [make_enrollment_node(course_id, i) for i in range(start, end)],
+                'pageInfo': {'endCursor': str(end), 'hasNextPage': end < course_size}
+            }
+        }
+
+
+class MockGraphQLServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        course_sizes: Dict[int, int],
+        latency: float = 0.05,
+        error_rate: float = 0.0
+    ) -> None:
+        super().__init__(('127.0.0.1', 0), MockGraphQLHandler)
+        self.course_sizes: Dict[int, int] = course_sizes
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.num_requests: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self) -> 'MockGraphQLServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
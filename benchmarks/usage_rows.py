@@ -0,0 +1,124 @@
+'''
+Compares how canvas_course_usage rows were built before (each response's parsed analytics kept
+as dicts, then mutated with course_id, made into a DataFrame, and scanned for duplicates twice)
+with UsageBuffer, which turns each response into typed columns as it arrives and deduplicates
+once by (course_id, date). Response bodies are generated up front, so both approaches start from
+the same JSON text; collecting covers parsing every response, building covers making the frame.
+Times are measured without tracing; memory (retained after collecting, and peak) is traced in a
+separate pass. Run from the repository root with ``python -m benchmarks.usage_rows``.
+'''
+
+# standard libraries
+import argparse, gc, json, logging, time, tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from benchmarks.mock_canvas import SyntheticCanvas
+from course_inventory.canvas_course_usage import CanvasCourseUsage
+from course_inventory.schema import apply_schema
+
+
+logger = logging.getLogger(__name__)
+
+
+def collect_before(response_texts: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    return [
+        {'course_id': course_id, 'analytics': json.loads(response_text)}
+        for course_id, response_text in response_texts
+    ]
+
+
+def build_before(canvas_usage_courses: List[Dict[str, Any]]) -> pd.DataFrame:
+    rows = []
+    for data in canvas_usage_courses:
+        analytics = data['analytics']
+        course_id = data['course_id']
+
+        for row in analytics:
+            row['course_id'] = course_id
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    df = df.drop(['id'], axis=1)
+    df['date'] = pd.to_datetime(df['date'], utc=True).dt.tz_convert(None).dt.normalize()
+    df_dup = df[df.duplicated(subset=['course_id', 'date'], keep='last')]
+    logger.info(df_dup)
+    return apply_schema(df.drop_duplicates(subset=['course_id', 'date'], keep='last'), 'canvas_course_usage')
+
+
+def collect_after(response_texts: List[Tuple[int, str]]) -> CanvasCourseUsage:
+    canvas_course_usage = CanvasCourseUsage(None, 0, [])
+    for course_id, response_text in response_texts:
+        canvas_course_usage.usage_buffer.add_rows(course_id, json.loads(response_text))
+    return canvas_course_usage
+
+
+def build_after(canvas_course_usage: CanvasCourseUsage) -> pd.DataFrame:
+    return canvas_course_usage.canvas_course_usage_to_df()
+
+
+def time_approach(
+    collect: Callable[[Any], Any],
+    build: Callable[[Any], pd.DataFrame],
+    response_texts: List[Tuple[int, str]]
+) -> Dict[str, Any]:
+    gc.collect()
+    start = time.perf_counter()
+    collected = collect(response_texts)
+    collect_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    df = build(collected)
+    build_seconds = time.perf_counter() - start
+    return {
+        'collect_seconds': round(collect_seconds, 2),
+        'build_seconds': round(build_seconds, 2),
+        'rows': len(df)
+    }
+
+
+def trace_approach(
+    collect: Callable[[Any], Any],
+    build: Callable[[Any], pd.DataFrame],
+    response_texts: List[Tuple[int, str]]
+) -> Dict[str, Any]:
+    gc.collect()
+    tracemalloc.start()
+    collected = collect(response_texts)
+    retained_bytes, _ = tracemalloc.get_traced_memory()
+    df = build(collected)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'retained_mib': round(retained_bytes / 2 ** 20, 1),
+        'peak_mib': round(peak_bytes / 2 ** 20, 1),
+        'frame_mib': round(df.memory_usage(deep=True).sum() / 2 ** 20, 1)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--courses', type=int, default=20000)
+    parser.add_argument('--usage-days', type=int, default=120)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    dataset = SyntheticCanvas(args.courses, usage_days=args.usage_days)
+    response_texts = [
+        (course_id, json.dumps(dataset.make_activity(course_id))) for course_id in range(1, args.courses + 1)
+    ]
+
+    results = []
+    for approach, collect, build in [('before', collect_before, build_before), ('after', collect_after, build_after)]:
+        results.append({
+            'approach': approach,
+            **time_approach(collect, build, response_texts),
+            **trace_approach(collect, build, response_texts)
+        })
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
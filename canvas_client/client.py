@@ -0,0 +1,150 @@
+# standard libraries
+import contextvars, logging, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+# third-party libraries
+import requests
+from requests.adapters import HTTPAdapter
+
+# local libraries
+from canvas_client.fixtures import attach_fixture_store, FixtureStore
+from canvas_client.limiter import AdaptiveLimiter, is_throttled
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class CanvasClient:
+    '''
+    Shared HTTP client for the Canvas REST and GraphQL APIs. Owns one pooled, keep-alive session
+    authenticated with the Canvas token, a thread pool for asynchronous requests, and an
+    AdaptiveLimiter that keeps concurrency just under Canvas's throttle. Every response received
+    through the session updates the limiter. canvasapi keeps its own session, so its calls are
+    wrapped with call_limited or iterate_limited to wait for the limiter (their responses don't
+    update it). With a fixture_store, the session's responses are recorded to it or replayed from it.
+    '''
+
+    def __init__(
+        self,
+        canvas_url: str,
+        canvas_token: str,
+        max_workers: int = 8,
+        rate_limit_threshold: float = 200.0,
+        max_throttle_retries: int = 5,
+        fixture_store: Optional[FixtureStore] = None
+    ) -> None:
+        self.canvas_url: str = canvas_url.rstrip('/')
+        self.canvas_token: str = canvas_token
+        self.max_workers: int = max_workers
+        self.max_throttle_retries: int = max_throttle_retries
+        self.limiter: AdaptiveLimiter = AdaptiveLimiter(max_workers, threshold=rate_limit_threshold)
+
+        self.session: requests.Session = self.create_session()
+        self.session.headers.update({'Authorization': f'Bearer {canvas_token}'})
+        self.session.hooks['response'].append(self.observe_response)
+        if fixture_store is not None:
+            attach_fixture_store(self.session, fixture_store)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def create_session(self) -> requests.Session:
+        '''
+        Creates a session with a connection pool sized for max_workers, whose responses are
+        counted in the current span and HTTP_METRICS. Sessions for other hosts (e.g. Zoom) can use
+        this without sharing the Canvas token or cookies.
+        '''
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(record_response)
+        return session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def observe_response(self, response: requests.Response, *args, **kwargs) -> None:
+        self.limiter.observe(response.status_code, response.headers, get_throttle_text(response))
+
+    def make_url(self, url: str) -> str:
+        return url if url.startswith('http') else f'{self.canvas_url}/{url.lstrip("/")}'
+
+    def request(self, method: str, url: str, retry_throttled: bool = True, **kwargs: Any) -> requests.Response:
+        '''
+        Makes a request once the limiter allows it; throttled requests are re-tried with backoff,
+        unless retry_throttled is False (e.g. when the caller retries them itself).
+        '''
+        complete_url = self.make_url(url)
+        max_throttle_retries = self.max_throttle_retries if retry_throttled else 0
+        for attempt in range(max_throttle_retries + 1):
+            with self.limiter:
+                response = self.session.request(method, complete_url, **kwargs)
+            if not is_throttled(response.status_code, get_throttle_text(response)) \
+                    or attempt == max_throttle_retries:
+                return response
+            delay = 2 ** attempt
+            logger.info(f'Throttled by Canvas; retrying in {delay} second(s)')
+            record(retries=1)
+            HTTP_METRICS.record_retry(method, complete_url)
+            time.sleep(delay)
+        return response
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def submit(self, method: str, url: str, **kwargs: Any) -> Future:
+        # Run in the caller's context, so the request is counted in the caller's span
+        return self.executor.submit(contextvars.copy_context().run, self.request, method, url, **kwargs)
+
+    def get_async(self, url: str, **kwargs: Any) -> Future:
+        return self.submit('GET', url, **kwargs)
+
+    def post_async(self, url: str, **kwargs: Any) -> Future:
+        return self.submit('POST', url, **kwargs)
+
+    def call_limited(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        '''
+        Calls func (e.g. a canvasapi method that makes one request) once the limiter allows it.
+        '''
+        with self.limiter:
+            return func(*args, **kwargs)
+
+    def iterate_limited(self, iterable: Iterable[T]) -> Iterator[T]:
+        '''
+        Iterates over iterable (e.g. a canvasapi PaginatedList, which requests the next page when
+        it runs out of items), getting each item once the limiter allows it.
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.limiter:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+
+def get_throttle_text(response: requests.Response) -> str:
+    # Only a 403's body says whether it's throttling, so other bodies aren't decoded
+    return response.text if response.status_code == 403 else ''
+
+
+def record_response(response: requests.Response, *args, **kwargs) -> None:
+    record(requests=1, bytes_received=len(response.content))
+    HTTP_METRICS.observe_response(response)
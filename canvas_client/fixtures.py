@@ -0,0 +1,196 @@
+# standard libraries
+import base64, gzip, hashlib, io, json, logging, os, threading, time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Any, Dict, IO, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+# third-party libraries
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_MODES = ('record', 'replay')
+
+
+class FixtureMissingError(requests.exceptions.ConnectionError):
+    '''
+    Raised in replay mode for a request that wasn't recorded; it's a ConnectionError, so callers
+    handle it like a network failure.
+    '''
+
+
+def make_request_key(method: str, url: str, body: Union[bytes, str, None] = None) -> str:
+    '''
+    Identifies a request by its method, its URL with the query parameters sorted, and a hash of
+    its body (e.g. a GraphQL query and its variables).
+    '''
+    parsed_url = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parsed_url.query, keep_blank_values=True)))
+    key = f'{method.upper()} {parsed_url.netloc}{parsed_url.path}?{query}'
+    if body:
+        body_bytes = body.encode() if isinstance(body, str) else body
+        key += f' {hashlib.sha1(body_bytes).hexdigest()}'
+    return key
+
+
+class FixtureStore:
+    '''
+    An append-only store of raw HTTP responses, keyed by request. Each recording is a run
+    directory holding segments of gzipped JSON lines (every line is its own gzip member, so it can
+    be read back on its own) and an index of where each key's responses are. Replaying serves a
+    key's responses in the order they were recorded (e.g. a 500, then the 200 from the retry),
+    repeating the last one once they run out. By default, the most recent run is replayed.
+    '''
+
+    index_file_name = 'index.jsonl'
+
+    def __init__(
+        self,
+        directory: str,
+        mode: str,
+        run_name: Optional[str] = None,
+        max_segment_bytes: int = 64 * 2 ** 20
+    ) -> None:
+        if mode not in FIXTURE_MODES:
+            raise ValueError(f'Invalid fixture mode: {mode}')
+        self.directory: str = directory
+        self.mode: str = mode
+        self.max_segment_bytes: int = max_segment_bytes
+        self.lock: threading.Lock = threading.Lock()
+
+        if mode == 'record':
+            self.run_name: str = run_name or time.strftime('%Y%m%dT%H%M%S')
+            os.makedirs(os.path.join(directory, self.run_name), exist_ok=True)
+            self.segment_num: int = 0
+            self.segment_file: Optional[IO[bytes]] = None
+            self.index_file: IO[str] = open(self.get_path(self.index_file_name), 'a')
+            logger.info(f'Recording HTTP responses to {self.get_path("")}')
+        else:
+            run_names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+            if run_name is None and not run_names:
+                raise FileNotFoundError(f'No recorded runs were found in {directory}')
+            self.run_name = run_name or run_names[-1]
+            self.entries: Dict[str, List[Tuple[str, int, int]]] = defaultdict(list)
+            self.positions: Dict[str, int] = defaultdict(int)
+            with open(self.get_path(self.index_file_name)) as index_file:
+                for line in index_file:
+                    index_entry = json.loads(line)
+                    self.entries[index_entry['key']].append(
+                        (index_entry['segment'], index_entry['offset'], index_entry['length'])
+                    )
+            logger.info(f'Replaying {len(self.entries)} recorded request(s) from {self.get_path("")}')
+
+    def get_path(self, file_name: str) -> str:
+        return os.path.join(self.directory, self.run_name, file_name)
+
+    def record(self, key: str, response: requests.Response) -> None:
+        content = response.content
+        try:
+            body = {'text': content.decode('utf-8')}
+        except UnicodeDecodeError:
+            body = {'base64': base64.b64encode(content).decode('ascii')}
+        line = json.dumps({
+            'key': key,
+            'url': response.url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'elapsed': response.elapsed.total_seconds(),
+            **body
+        })
+        member = gzip.compress(line.encode() + b'\n', compresslevel=6)
+
+        with self.lock:
+            if self.segment_file is None or self.segment_file.tell() + len(member) > self.max_segment_bytes:
+                if self.segment_file is not None:
+                    self.segment_file.close()
+                self.segment_num += 1
+                self.segment_file = open(self.get_path(f'segment-{self.segment_num:05d}.jsonl.gz'), 'ab')
+            segment_name = os.path.basename(self.segment_file.name)
+            offset = self.segment_file.tell()
+            self.segment_file.write(member)
+            self.segment_file.flush()
+            # The index is written after the segment, so it never points at a partial record
+            self.index_file.write(json.dumps({
+                'key': key, 'segment': segment_name, 'offset': offset, 'length': len(member)
+            }) + '\n')
+            self.index_file.flush()
+
+    def has(self, key: str) -> bool:
+        return key in self.entries
+
+    def replay(self, key: str, request: Optional[requests.PreparedRequest] = None) -> requests.Response:
+        with self.lock:
+            key_entries = self.entries.get(key)
+            if not key_entries:
+                raise FixtureMissingError(f'No recorded response for {key}', request=request)
+            position = self.positions[key]
+            self.positions[key] = position + 1
+        segment_name, offset, length = key_entries[min(position, len(key_entries) - 1)]
+
+        with open(self.get_path(segment_name), 'rb') as segment_file:
+            segment_file.seek(offset)
+            fixture = json.loads(gzip.decompress(segment_file.read(length)))
+
+        response = requests.Response()
+        response.status_code = fixture['status_code']
+        response.reason = fixture['reason']
+        response.headers = CaseInsensitiveDict(fixture['headers'])
+        # The body was stored decoded, so it shouldn't be decompressed again
+        response.headers.pop('Content-Encoding', None)
+        response._content = (
+            fixture['text'].encode('utf-8') if 'text' in fixture else base64.b64decode(fixture['base64'])
+        )
+        response.encoding = 'utf-8'
+        response.url = fixture['url']
+        response.elapsed = timedelta(seconds=fixture['elapsed'])
+        if request is None:
+            request = requests.Request('GET', fixture['url']).prepare()
+        response.request = request
+        response.raw = io.BytesIO(response._content)
+        return response
+
+    def close(self) -> None:
+        if self.mode == 'record':
+            with self.lock:
+                if self.segment_file is not None:
+                    self.segment_file.close()
+                    self.segment_file = None
+                self.index_file.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    '''
+    A requests transport adapter that serves responses from a FixtureStore instead of the network.
+    '''
+
+    def __init__(self, fixture_store: FixtureStore) -> None:
+        super().__init__()
+        self.fixture_store: FixtureStore = fixture_store
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        key = make_request_key(request.method, request.url, request.body)
+        return self.fixture_store.replay(key, request)
+
+    def close(self) -> None:
+        pass
+
+
+def attach_fixture_store(session: requests.Session, fixture_store: FixtureStore) -> None:
+    '''
+    Makes a session record its responses to the store, or replay them from it.
+    '''
+    if fixture_store.mode == 'replay':
+        replay_adapter = ReplayAdapter(fixture_store)
+        session.mount('https://', replay_adapter)
+        session.mount('http://', replay_adapter)
+    else:
+        def record_fixture(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+            fixture_store.record(
+                make_request_key(response.request.method, response.request.url, response.request.body), response
+            )
+        session.hooks['response'].append(record_fixture)
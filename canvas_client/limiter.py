@@ -0,0 +1,92 @@
+# standard libraries
+import logging, math, threading
+from typing import Mapping, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttled(status_code: int, response_text: str) -> bool:
+    '''
+    Canvas signals throttling with a 403 whose body includes "Rate Limit Exceeded"; 429 is
+    treated the same way.
+    '''
+    return status_code == 429 or (status_code == 403 and 'Rate Limit Exceeded' in response_text)
+
+
+class AdaptiveLimiter:
+    '''
+    Limits the number of concurrent requests, adjusting the limit from Canvas's rate-limit headers.
+    Canvas gives each token a bucket that requests drain by their X-Request-Cost and that refills
+    over time; X-Rate-Limit-Remaining reports what is left. When the bucket drops below the
+    threshold, or a request is throttled, the limit is cut multiplicatively; while there is room
+    for every in-flight request to spend its cost and stay above the threshold, it grows by one.
+    '''
+
+    def __init__(self, max_limit: int, min_limit: int = 1, threshold: float = 200.0) -> None:
+        self.max_limit: int = max(max_limit, 1)
+        self.min_limit: int = max(min(min_limit, self.max_limit), 1)
+        self.threshold: float = threshold
+        self.limit: int = self.max_limit
+        self.active: int = 0
+        self.condition: threading.Condition = threading.Condition()
+
+    def __enter__(self) -> 'AdaptiveLimiter':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def set_limit(self, limit: int) -> None:
+        with self.condition:
+            limit = max(self.min_limit, min(self.max_limit, limit))
+            if limit != self.limit:
+                logger.debug(f'Changing concurrency limit from {self.limit} to {limit}')
+                self.limit = limit
+                self.condition.notify_all()
+
+    def observe(self, status_code: int, headers: Mapping[str, str], response_text: str = '') -> None:
+        '''
+        Adjusts the limit using the status code, rate-limit headers and body of a response.
+        '''
+        if is_throttled(status_code, response_text):
+            logger.warning(f'Request was throttled; reducing concurrency limit from {self.limit}')
+            self.set_limit(self.limit // 2)
+            return
+
+        remaining = parse_float(headers.get('X-Rate-Limit-Remaining'))
+        if remaining is None:
+            return
+        cost = parse_float(headers.get('X-Request-Cost')) or 1.0
+        if remaining < self.threshold:
+            self.set_limit(math.floor(self.limit * 0.75))
+        elif remaining > self.threshold + cost * (self.limit + 1):
+            self.set_limit(self.limit + 1)
+
+    def scale(self, num_workers: int) -> int:
+        '''
+        Scales another worker count (e.g. an asyncio connection limit) by the current fraction
+        of the maximum limit, so it backs off along with requests made through this limiter.
+        '''
+        return max(1, math.floor(num_workers * self.limit / self.max_limit))
+
+
+def parse_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
@@ -0,0 +1,236 @@
+# standard libraries
+import heapq, itertools, logging, random, time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# third-party libraries
+import requests
+
+# local libraries
+from canvas_client.client import CanvasClient, get_throttle_text
+from canvas_client.limiter import is_throttled
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Lower numbers are sent first; pages following a response go ahead of requests not yet started
+PRIORITY_FOLLOW_UP = 0
+PRIORITY_INITIAL = 1
+
+# A handler takes a response and returns the URLs of any follow-up requests (e.g. the next page)
+ResponseHandler = Callable[[requests.Response], Optional[Iterable[str]]]
+
+
+class RetryableResponseError(Exception):
+    '''
+    Raised by a handler when a response can't be used (e.g. its body isn't valid JSON), so the
+    request is retried like one that failed.
+    '''
+
+
+class ScheduledRequest:
+
+    __slots__ = ('method', 'url', 'params', 'handler', 'priority', 'attempt')
+
+    def __init__(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        handler: ResponseHandler,
+        priority: int
+    ) -> None:
+        self.method: str = method
+        self.url: str = url
+        self.params: Optional[Dict[str, Any]] = params
+        self.handler: ResponseHandler = handler
+        self.priority: int = priority
+        self.attempt: int = 0
+
+
+def get_backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    '''
+    Returns a delay before the next try after the given attempt: an exponential backoff with full
+    jitter, capped at max_delay.
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    '''
+    Returns the number of seconds a Retry-After header (in seconds or as an HTTP date) asks for.
+    '''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryScheduler:
+    '''
+    Sends requests through a CanvasClient and passes their responses to handlers, iteratively.
+    Failed requests (connection errors, RETRY_STATUS_CODES, throttled 403s, or a
+    RetryableResponseError from the handler) are retried individually after an exponential
+    backoff with full jitter, or after the time a Retry-After header asks for, until max_attempts
+    is reached; the client doesn't retry throttled requests itself, so this is the only layer
+    that does. Other error statuses (e.g. 401 or 404) aren't retried or passed to the handler, and
+    are given up on at once. Follow-up requests a
+    handler returns are sent as soon as there's room, ahead of requests not yet started. At most
+    max_in_flight requests are submitted to the client at a time, so priorities are respected and
+    only that many responses are held; requests added with add_stream are only created as there's
+    room for them, so the memory used for requests stays flat however many there are (what the
+    handlers keep is up to them).
+    '''
+
+    def __init__(
+        self,
+        canvas_client: CanvasClient,
+        max_attempts: int,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_in_flight: Optional[int] = None
+    ) -> None:
+        self.canvas_client: CanvasClient = canvas_client
+        self.max_attempts: int = max(max_attempts, 1)
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.max_in_flight: int = max_in_flight or canvas_client.max_workers * 2
+        self.counter: itertools.count = itertools.count()
+        # (priority, order added, request) for requests that can be sent now
+        self.ready: List[Tuple[int, int, ScheduledRequest]] = []
+        # (time to send, order added, request) for requests backing off
+        self.delayed: List[Tuple[float, int, ScheduledRequest]] = []
+        # (iterator of URLs and params, handler, method) for requests not yet created
+        self.streams: Deque[Tuple[Iterator[Tuple[str, Optional[Dict[str, Any]]]], ResponseHandler, str]] = deque()
+        self.in_flight: Dict[Future, ScheduledRequest] = {}
+        self.failed: List[ScheduledRequest] = []
+
+    def add(
+        self,
+        url: str,
+        handler: ResponseHandler,
+        params: Optional[Dict[str, Any]] = None,
+        method: str = 'GET',
+        priority: int = PRIORITY_INITIAL
+    ) -> None:
+        scheduled_request = ScheduledRequest(method, self.canvas_client.make_url(url), params, handler, priority)
+        heapq.heappush(self.ready, (priority, next(self.counter), scheduled_request))
+
+    def add_stream(
+        self,
+        urls_and_params: Iterable[Tuple[str, Optional[Dict[str, Any]]]],
+        handler: ResponseHandler,
+        method: str = 'GET'
+    ) -> None:
+        '''
+        Adds requests for the URLs and params, which are taken from the iterable as there's room
+        for them, after any follow-ups and retries that are ready.
+        '''
+        self.streams.append((iter(urls_and_params), handler, method))
+
+    def pop_next_request(self) -> Optional[ScheduledRequest]:
+        if self.ready:
+            return heapq.heappop(self.ready)[2]
+        while self.streams:
+            urls_and_params, handler, method = self.streams[0]
+            try:
+                url, params = next(urls_and_params)
+            except StopIteration:
+                self.streams.popleft()
+                continue
+            return ScheduledRequest(method, self.canvas_client.make_url(url), params, handler, PRIORITY_INITIAL)
+        return None
+
+    def give_up(self, scheduled_request: ScheduledRequest, reason: str) -> None:
+        logger.warning(f'Giving up on {scheduled_request.url} after {scheduled_request.attempt} attempt(s): {reason}')
+        self.failed.append(scheduled_request)
+
+    def schedule_retry(self, scheduled_request: ScheduledRequest, reason: str, retry_after: Optional[float]) -> None:
+        if scheduled_request.attempt >= self.max_attempts:
+            self.give_up(scheduled_request, reason)
+            return
+        delay = get_backoff_delay(scheduled_request.attempt, self.base_delay, self.max_delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        logger.debug(f'Retrying {scheduled_request.url} in {delay:.1f} second(s): {reason}')
+        record(retries=1)
+        HTTP_METRICS.record_retry(scheduled_request.method, scheduled_request.url)
+        heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), scheduled_request))
+
+    def handle_result(self, future: Future, scheduled_request: ScheduledRequest) -> None:
+        try:
+            response = future.result()
+        except requests.exceptions.RequestException as error:
+            self.schedule_retry(scheduled_request, repr(error), None)
+            return
+
+        if response.status_code in RETRY_STATUS_CODES \
+                or is_throttled(response.status_code, get_throttle_text(response)):
+            self.schedule_retry(
+                scheduled_request, f'status {response.status_code}: {response.text[:200]}', get_retry_after(response)
+            )
+            return
+        if not response.ok:
+            self.give_up(scheduled_request, f'status {response.status_code}: {response.text[:200]}')
+            return
+
+        try:
+            follow_up_urls = scheduled_request.handler(response)
+        except RetryableResponseError as error:
+            self.schedule_retry(scheduled_request, str(error), None)
+            return
+        for follow_up_url in follow_up_urls or []:
+            self.add(
+                follow_up_url, scheduled_request.handler, method=scheduled_request.method, priority=PRIORITY_FOLLOW_UP
+            )
+
+    def run(self) -> List[ScheduledRequest]:
+        '''
+        Sends the requests added so far, and any follow-ups and retries, until all are handled or
+        given up on; returns the ones given up on.
+        '''
+        while self.ready or self.delayed or self.in_flight or self.streams:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, order, scheduled_request = heapq.heappop(self.delayed)
+                heapq.heappush(self.ready, (scheduled_request.priority, order, scheduled_request))
+
+            while len(self.in_flight) < self.max_in_flight:
+                scheduled_request = self.pop_next_request()
+                if scheduled_request is None:
+                    break
+                scheduled_request.attempt += 1
+                future = self.canvas_client.submit(
+                    scheduled_request.method, scheduled_request.url,
+                    retry_throttled=False, params=scheduled_request.params
+                )
+                self.in_flight[future] = scheduled_request
+
+            timeout = max(self.delayed[0][0] - now, 0.0) if self.delayed else None
+            if not self.in_flight:
+                time.sleep(timeout or 0.0)
+                continue
+            done_futures, _ = wait(list(self.in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                self.handle_result(future, self.in_flight.pop(future))
+
+        failed = self.failed
+        self.failed = []
+        return failed
@@ -0,0 +1,80 @@
+# standard libraries
+import asyncio, logging, time
+from typing import Dict, Sequence, Tuple
+
+# third-party libraries
+import aiohttp
+
+# local libraries
+from course_inventory.async_enroll_gatherer import AsyncEnrollGatherer
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record
+
+
+logger = logging.getLogger(__name__)
+
+
+class AioEnrollGatherer(AsyncEnrollGatherer):
+    '''
+    Gathers enrollments the same way as AsyncEnrollGatherer, but uses asyncio and aiohttp
+    instead of a thread per worker. All requests share one long-lived, keep-alive connection
+    pool, so num_workers can be set to hundreds of concurrent requests. Responses update the
+    CanvasClient's limiter, which scales the number of requests in flight.
+    '''
+
+    async def post_enrollment_request_async(
+        self,
+        session: aiohttp.ClientSession,
+        course_ids: Sequence[int]
+    ) -> Tuple[int, str]:
+        start = time.perf_counter()
+        try:
+            async with session.post(self.complete_url, json=self.build_request_body(course_ids)) as response:
+                response_bytes = await response.read()
+                response_text = response_bytes.decode(response.get_encoding(), errors='replace')
+                record(requests=1, bytes_received=len(response_bytes))
+                HTTP_METRICS.observe(
+                    'POST', self.complete_url, response.status, time.perf_counter() - start, len(response_bytes)
+                )
+                self.canvas_client.limiter.observe(response.status, response.headers, response_text)
+                return (response.status, response_text)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logger.warning(f'Request for course(s) {course_ids} failed: {error!r}')
+            HTTP_METRICS.observe('POST', self.complete_url, 0, time.perf_counter() - start)
+            return (0, '')
+
+    async def gather_async(self) -> None:
+        self.start_queue()
+        in_flight: Dict[asyncio.Task, Tuple[int, ...]] = {}
+
+        connector = aiohttp.TCPConnector(limit=self.num_workers)
+        headers = {'Authorization': f'Bearer {self.canvas_client.canvas_token}'}
+        limiter = self.canvas_client.limiter
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            while self.queued_course_ids or self.delayed_course_ids or in_flight:
+                next_release = self.release_delayed_course_ids()
+
+                # Keep num_workers requests in flight, scaled down with the shared limiter
+                while self.queued_course_ids and len(in_flight) < limiter.scale(self.num_workers):
+                    course_ids = self.pop_course_ids()
+                    task = asyncio.ensure_future(self.post_enrollment_request_async(session, course_ids))
+                    in_flight[task] = course_ids
+
+                if not in_flight:
+                    # Every remaining course is backing off
+                    await asyncio.sleep(next_release or 0.0)
+                    continue
+                completed_tasks, _ = await asyncio.wait(
+                    in_flight, timeout=next_release, return_when=asyncio.FIRST_COMPLETED
+                )
+                for completed_task in completed_tasks:
+                    course_ids = in_flight.pop(completed_task)
+                    status_code, response_text = completed_task.result()
+                    self.requeue_course_ids(course_ids, self.parse_enrollment_page(status_code, response_text))
+
+    def gather(self) -> None:
+        logger.info('** AioEnrollGatherer')
+        logger.info('Gathering enrollment data for courses with asyncio and GraphQL')
+        asyncio.run(self.gather_async())
+        self.log_failed_course_ids()
+        logger.info('Enrollment records for the course IDs have been gathered')
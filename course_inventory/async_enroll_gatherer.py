@@ -1,52 +1,117 @@
 # standard libraries
-import copy, json, logging
-from typing import Any, Dict, Sequence, Tuple
+import heapq, itertools, json, logging, sys, time
+from array import array
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Set, Tuple
 from json.decoder import JSONDecodeError
 
 # third-party libraries
+import numpy as np
 import pandas as pd
-from requests_futures.sessions import FuturesSession
-from concurrent.futures import as_completed, Future
+import requests
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 
+# local libraries
+from canvas_client.client import CanvasClient
+from canvas_client.retry_scheduler import get_backoff_delay
+from course_inventory.checkpoints import CheckpointStore
+from course_inventory.gql_queries import build_batched_course_enrollments_query
+from course_inventory.schema import apply_schema
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record
 
-logger = logging.getLogger(__name__)
 
+logger = logging.getLogger(__name__)
 
-def unnest_enrollment(enroll_dict: Dict) -> Tuple[Dict, ...]:
-    flat_enroll_dict = {
-        'canvas_id': int(enroll_dict['_id']),
-        'user_id': int(enroll_dict['user']['_id']),
-        'course_id': int(enroll_dict['course']['_id']),
-        'course_section_id': int(enroll_dict['section']['_id']),
-        'role_type': enroll_dict['type'],
-        'workflow_state': enroll_dict['state']
-    }
 
-    section_data = enroll_dict['section']
-    flat_section_dict = {
-        'canvas_id': int(section_data['_id']),
-        'name': section_data['name'],
-    }
-    return (flat_enroll_dict, flat_section_dict)
+class EnrollmentBuffer:
+    '''
+    Accumulates enrollments as they are parsed, flattened into typed column arrays (of the
+    dtypes in course_inventory.schema), with course sections de-duplicated by ID. Repeated strings
+    (role types and states) are interned, so each row only holds references to them.
+    '''
+
+    __slots__ = (
+        'canvas_ids', 'user_ids', 'course_ids', 'course_section_ids',
+        'role_types', 'workflow_states', 'section_names'
+    )
+
+    def __init__(self) -> None:
+        # Canvas IDs can be over 2^31, so they're all 64-bit
+        self.canvas_ids: array = array('q')
+        self.user_ids: array = array('q')
+        self.course_ids: array = array('q')
+        self.course_section_ids: array = array('q')
+        self.role_types: List[str] = []
+        self.workflow_states: List[str] = []
+        self.section_names: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.canvas_ids)
+
+    def add_nodes(self, enroll_dicts: Sequence[Dict]) -> None:
+        for enroll_dict in enroll_dicts:
+            section_id = int(enroll_dict['section']['_id'])
+            self.canvas_ids.append(int(enroll_dict['_id']))
+            self.user_ids.append(int(enroll_dict['user']['_id']))
+            self.course_ids.append(int(enroll_dict['course']['_id']))
+            self.course_section_ids.append(section_id)
+            self.role_types.append(sys.intern(enroll_dict['type']))
+            self.workflow_states.append(sys.intern(enroll_dict['state']))
+            self.section_names[section_id] = enroll_dict['section']['name']
+
+    def to_dfs(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        # The arrays' own type codes are used, since a checkpoint may hold arrays of another width
+        enrollment_df = pd.DataFrame({
+            'canvas_id': np.frombuffer(self.canvas_ids, dtype=self.canvas_ids.typecode),
+            'user_id': np.frombuffer(self.user_ids, dtype=self.user_ids.typecode),
+            'course_id': np.frombuffer(self.course_ids, dtype=self.course_ids.typecode),
+            'course_section_id': np.frombuffer(self.course_section_ids, dtype=self.course_section_ids.typecode),
+            'role_type': pd.Categorical(self.role_types),
+            'workflow_state': pd.Categorical(self.workflow_states)
+        })
+        section_df = pd.DataFrame({
+            'canvas_id': np.fromiter(self.section_names.keys(), dtype=np.int64, count=len(self.section_names)),
+            'name': list(self.section_names.values())
+        })
+        return (apply_schema(enrollment_df, 'enrollment'), section_df)
 
 
 class AsyncEnrollGatherer:
 
+    checkpoint_name = 'enrollment_pages'
+
     def __init__(
         self,
         course_ids: Sequence[int],
-        access_token: str,
-        complete_url: str,
+        canvas_client: CanvasClient,
         gql_query: str,
         enroll_page_size: int = 75,
-        num_workers: int = 8
+        num_workers: int = 8,
+        course_batch_size: int = 1,
+        course_sizes: Optional[Dict[int, int]] = None,
+        max_page_size: int = 100,
+        checkpoint_store: Optional[CheckpointStore] = None,
+        checkpoint_interval: float = 60.0,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
     ):
-        self.course_ids: Sequence[int] = sorted(course_ids)
-        self.complete_url: str = complete_url
+        # Expected numbers of enrollments (e.g. total_students) are used to schedule the largest
+        # courses first and to give them larger pages, so they don't become the tail of the run
+        self.course_sizes: Dict[int, int] = course_sizes if course_sizes is not None else {}
+        self.course_ids: Sequence[int] = sorted(
+            course_ids, key=lambda course_id: (-self.course_sizes.get(course_id, 0), course_id)
+        )
+        self.enroll_page_size: int = enroll_page_size
+        self.max_page_size: int = max(max_page_size, enroll_page_size)
+        self.canvas_client: CanvasClient = canvas_client
+        self.complete_url: str = canvas_client.make_url('/api/graphql')
         self.gql_query: str = gql_query
         self.num_workers: int = num_workers
+        # The first pages for up to this many courses are requested together using aliases
+        self.course_batch_size: int = course_batch_size
         self.default_params: Dict[str, Any] = {
-            'access_token': access_token,
             'query': gql_query,
             'variables': {
                 'courseID': None,
@@ -55,10 +120,10 @@ class AsyncEnrollGatherer:
             }
         }
 
-        # course_enrollments will have this structure
+        # course_enrollments will have this structure; the enrollments themselves are flattened
+        # into enrollment_buffer as each page is parsed, and the raw page is dropped
         # {
         #     course_id: {
-        #         'enrollments': [nested_gql_enrollment_dict, ...],
         #         'page_info': {
         #             'endCursor': some_code,
         #             'hasNextPage': some_bool
@@ -67,147 +132,271 @@ class AsyncEnrollGatherer:
         #     }
         # }
         self.course_enrollments: Dict[int, Dict[str, Any]] = {}
-
-    def get_complete_course_ids(self) -> Sequence[int]:
-        complete_course_ids = []
-        for course_id in self.course_enrollments.keys():
-            course_enrollment_dict = self.course_enrollments[course_id]
-            if not course_enrollment_dict['page_info']['hasNextPage']:
-                complete_course_ids.append(course_id)
-        return complete_course_ids
-
-    def get_incomplete_course_ids(self) -> Sequence[int]:
-        course_ids = []
-
-        # Get unstarted course_ids
-        for course_id in self.course_ids:
-            if course_id not in self.course_enrollments.keys():
-                course_ids.append(course_id)
-
-        # Get in-progress course ids
-        for course_id in self.course_enrollments.keys():
-            course_enrollment_dict = self.course_enrollments[course_id]
-            if course_enrollment_dict['page_info']['hasNextPage']:
-                course_ids.append(course_id)
-
-        return course_ids
-
-    def parse_enrollment_response(self, future_response: Future) -> None:
+        self.enrollment_buffer: EnrollmentBuffer = EnrollmentBuffer()
+        self.num_complete_courses: int = 0
+        self.queued_course_ids: Deque[int] = deque()
+
+        # A course whose request fails is re-queued after a backoff, and given up on after
+        # max_attempts failures in a row
+        self.max_attempts: int = max(max_attempts, 1)
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.course_attempts: Dict[int, int] = {}
+        self.counter: itertools.count = itertools.count()
+        # (time to re-queue, order added, course ID) for courses backing off
+        self.delayed_course_ids: List[Tuple[float, int, int]] = []
+        self.failed_course_ids: List[int] = []
+
+        # Stored pages and cursors are saved every checkpoint_interval seconds, so a re-run can
+        # resume each course after its last stored page
+        self.checkpoint_store: Optional[CheckpointStore] = checkpoint_store
+        self.checkpoint_interval: float = checkpoint_interval
+        self.last_checkpoint_at: float = time.time()
+
+    def parse_enrollment_response(self, future_response: Future) -> Set[int]:
+        try:
+            response = future_response.result()
+        except requests.exceptions.RequestException as error:
+            logger.warning(f'Request failed: {error!r}')
+            return set()
+        return self.parse_enrollment_page(response.status_code, response.text)
+
+    def parse_enrollment_page(self, status_code: int, response_text: str) -> Set[int]:
+        '''
+        Stores the enrollments and page info from a single-course or batched (aliased) response;
+        returns the IDs of the courses whose pages were stored.
+        '''
         # Check for irregular results
         problem_encountered = False
-        response = future_response.result()
 
-        status_code = response.status_code
         if status_code != 200:
             logger.warning(f'Received irregular status code: {status_code}')
-            logger.debug(response.text)
+            logger.debug(response_text)
             problem_encountered = True
         else:
             try:
-                response_data = json.loads(response.text)
+                response_data = json.loads(response_text)
             except JSONDecodeError:
                 logger.warning('JSONDecodeError encountered')
                 problem_encountered = True
 
+        if not problem_encountered and not response_data.get('data'):
+            logger.warning(f'No data found in response: {response_data.get("errors")}')
+            problem_encountered = True
+
         if problem_encountered:
             logger.warning('No data will be stored, and the request will be re-tried')
+            return set()
+
+        # Single-course responses use the "course" key; batched responses use "course0", "course1", etc.
+        stored_course_ids = set()
+        for course_data in response_data['data'].values():
+            if course_data is not None:
+                stored_course_ids.add(self.store_course_page(course_data))
+        return stored_course_ids
+
+    def store_course_page(self, course_data: Dict[str, Any]) -> int:
+        response_course_id = int(course_data['_id'])
+
+        enrollments_connection = course_data['enrollmentsConnection']
+        enrollment_page_info = enrollments_connection['pageInfo']
+        self.enrollment_buffer.add_nodes(enrollments_connection['nodes'])
+
+        if response_course_id not in self.course_enrollments.keys():
+            # Create new in-progress record
+            self.course_enrollments[response_course_id] = {
+                'page_info': enrollment_page_info,
+                'num_pages': 1
+            }
+        else:
+            # Update existing in-progress record
+            self.course_enrollments[response_course_id]['page_info'] = enrollment_page_info
+            self.course_enrollments[response_course_id]['num_pages'] += 1
+
+        if not enrollment_page_info['hasNextPage']:
+            self.num_complete_courses += 1
+        return response_course_id
+
+    def get_page_size(self, course_id: int) -> int:
+        '''
+        Returns a page size large enough for the course's expected enrollments (with some room for
+        non-student enrollments), between enroll_page_size and max_page_size.
+        '''
+        if course_id not in self.course_sizes:
+            return self.enroll_page_size
+        expected_size = int(self.course_sizes[course_id] * 1.1) + 5
+        return min(self.max_page_size, max(self.enroll_page_size, expected_size))
+
+    def build_request_body(self, course_ids: Sequence[int]) -> Dict[str, Any]:
+        if len(course_ids) > 1:
+            # Only unstarted courses are batched, so no cursors are needed
+            variables = {
+                f'courseID{i}': course_id for i, course_id in enumerate(course_ids)
+            }
+            variables['enrollmentPageSize'] = max(self.get_page_size(course_id) for course_id in course_ids)
+            logger.debug(variables)
+            return {
+                **self.default_params,
+                'query': build_batched_course_enrollments_query(len(course_ids)),
+                'variables': variables
+            }
+
+        course_id = course_ids[0]
+        variables = {
+            **self.default_params['variables'],
+            'courseID': course_id,
+            'enrollmentPageSize': self.get_page_size(course_id)
+        }
+        if course_id in self.course_enrollments:
+            variables['enrollmentPageCursor'] = self.course_enrollments[course_id]['page_info']['endCursor']
+        logger.debug(variables)
+        return {**self.default_params, 'variables': variables}
+
+    def post_enrollment_request(self, course_ids: Sequence[int]) -> Future:
+        return self.canvas_client.post_async(self.complete_url, json=self.build_request_body(course_ids))
+
+    def save_checkpoint(self) -> None:
+        if self.checkpoint_store is None:
+            return
+        self.checkpoint_store.save(
+            self.checkpoint_name,
+            (self.course_enrollments, self.num_complete_courses, self.enrollment_buffer)
+        )
+        self.last_checkpoint_at = time.time()
+        logger.info(f'Saved checkpoint with {len(self.enrollment_buffer)} enrollment records')
+
+    def load_checkpoint(self) -> None:
+        if self.checkpoint_store is None or not self.checkpoint_store.has(self.checkpoint_name):
+            return
+        self.course_enrollments, self.num_complete_courses, self.enrollment_buffer = (
+            self.checkpoint_store.load(self.checkpoint_name)
+        )
+        logger.info(
+            f'Resuming from checkpoint with {len(self.course_enrollments)} started and '
+            f'{self.num_complete_courses} completed courses'
+        )
+
+    def start_queue(self) -> None:
+        # Course IDs whose next page should be requested. Follow-up pages for started courses are
+        # placed at the front, so courses are finished as soon as possible; unstarted courses whose
+        # first request failed are placed at the back, once they've backed off.
+        self.load_checkpoint()
+        self.queued_course_ids = deque(
+            [
+                course_id for course_id in self.course_ids
+                if course_id in self.course_enrollments and
+                self.course_enrollments[course_id]['page_info']['hasNextPage']
+            ] +
+            [course_id for course_id in self.course_ids if course_id not in self.course_enrollments]
+        )
+
+    def pop_course_ids(self) -> Tuple[int, ...]:
+        '''
+        Pops the next course ID from the queue; if it is for an unstarted course, up to
+        course_batch_size unstarted course IDs are popped so they can be requested together.
+        '''
+        course_ids = [self.queued_course_ids.popleft()]
+        if course_ids[0] not in self.course_enrollments:
+            while (
+                len(course_ids) < self.course_batch_size and self.queued_course_ids and
+                self.queued_course_ids[0] not in self.course_enrollments
+            ):
+                course_ids.append(self.queued_course_ids.popleft())
+        return tuple(course_ids)
+
+    def queue_course_id(self, course_id: int) -> None:
+        if course_id in self.course_enrollments:
+            self.queued_course_ids.appendleft(course_id)
         else:
-            response_course_id = int(response_data['data']['course']['_id'])
-
-            enrollments_connection = response_data['data']['course']['enrollmentsConnection']
-            enrollment_dicts = enrollments_connection['nodes']
-            enrollment_page_info = enrollments_connection['pageInfo']
-
-            if response_course_id not in self.course_enrollments.keys():
-                # Create new in-progress record
-                self.course_enrollments[response_course_id] = {
-                    'enrollments': enrollment_dicts,
-                    'page_info': enrollment_page_info,
-                    'num_pages': 1
-                }
+            self.queued_course_ids.append(course_id)
+
+    def delay_course_id(self, course_id: int) -> None:
+        '''
+        Counts a failed request for the course, and schedules it to be re-queued after a backoff,
+        or gives up on it once it has failed max_attempts times in a row.
+        '''
+        attempt = self.course_attempts.get(course_id, 0) + 1
+        self.course_attempts[course_id] = attempt
+        if attempt >= self.max_attempts:
+            started = 'started' if course_id in self.course_enrollments else 'unstarted'
+            logger.warning(f'Giving up on {started} course {course_id} after {attempt} failed attempt(s)')
+            self.failed_course_ids.append(course_id)
+            return
+        record(retries=1)
+        HTTP_METRICS.record_retry('POST', self.complete_url)
+        delay = get_backoff_delay(attempt, self.base_delay, self.max_delay)
+        heapq.heappush(self.delayed_course_ids, (time.monotonic() + delay, next(self.counter), course_id))
+
+    def release_delayed_course_ids(self) -> Optional[float]:
+        '''
+        Queues the courses whose backoff has passed; returns the seconds until the next one will
+        have, or None if none are backing off.
+        '''
+        now = time.monotonic()
+        while self.delayed_course_ids and self.delayed_course_ids[0][0] <= now:
+            self.queue_course_id(heapq.heappop(self.delayed_course_ids)[2])
+        return max(self.delayed_course_ids[0][0] - now, 0.0) if self.delayed_course_ids else None
+
+    def requeue_course_ids(self, course_ids: Sequence[int], stored_course_ids: Set[int]) -> None:
+        for course_id in course_ids:
+            if course_id not in stored_course_ids:
+                self.delay_course_id(course_id)
             else:
-                # Update existing in-progress record
-                self.course_enrollments[response_course_id]['enrollments'] += enrollment_dicts
-                self.course_enrollments[response_course_id]['page_info'] = enrollment_page_info
-                self.course_enrollments[response_course_id]['num_pages'] += 1
-
-    def make_requests(self, course_ids: Sequence[int]) -> None:
-        with FuturesSession(max_workers=self.num_workers) as session:
-            responses = []
-            for course_id in course_ids:
-                # Prep params
-                params = copy.deepcopy(self.default_params)
-                params['variables']['courseID'] = course_id
-                if course_id in self.course_enrollments.keys():
-                    course_enrollment_dict = self.course_enrollments[course_id]
-                    enroll_page_info = course_enrollment_dict['page_info']
-                    params['variables']['enrollmentPageCursor'] = enroll_page_info['endCursor']
-
-                logger.debug(params['variables'])
-                response = session.post(self.complete_url, json=params)
-                responses.append(response)
-
-            for completed_response in as_completed(responses):
-                self.parse_enrollment_response(completed_response)
-
-                # Log process status
-                logger.info(f'# started courses: {len(self.course_enrollments)}')
-                logger.info(f'# completed courses: {len(self.get_complete_course_ids())}')
+                self.course_attempts.pop(course_id, None)
+                if self.course_enrollments[course_id]['page_info']['hasNextPage']:
+                    self.queued_course_ids.appendleft(course_id)
+
+        # Log process status
+        logger.debug(f'# started courses: {len(self.course_enrollments)}')
+        logger.debug(f'# completed courses: {self.num_complete_courses}')
+
+        if time.time() - self.last_checkpoint_at >= self.checkpoint_interval:
+            self.save_checkpoint()
+
+    def log_failed_course_ids(self) -> None:
+        if not self.failed_course_ids:
+            return
+        if len(self.course_enrollments) == 0:
+            logger.error('No course IDs could be processed!')
+        else:
+            logger.warning(f'{len(self.failed_course_ids)} course ID(s) could not be processed')
+        logger.warning(sorted(self.failed_course_ids))
 
     def generate_output(self) -> Tuple[pd.DataFrame, ...]:
         logger.debug('generate_output')
-        enrollment_records = []
-        section_records = []
-
-        for course_id in self.course_enrollments.keys():
-            enrollment_dicts = self.course_enrollments[course_id]['enrollments']
-            for enrollment_dict in enrollment_dicts:
-                enrollment_record, section_record = unnest_enrollment(enrollment_dict)
-                enrollment_records.append(enrollment_record)
-                section_records.append(section_record)
+        enrollment_df, section_df = self.enrollment_buffer.to_dfs()
 
         # Seems like we shouldn't have to drop duplicates for enrollments, but once one
         # duplicate broke the process
-        enrollment_df = pd.DataFrame(enrollment_records)
         orig_enrollment_count = len(enrollment_df)
         enrollment_df = enrollment_df.drop_duplicates(subset=['canvas_id'], keep='last')
         logger.info(f'{orig_enrollment_count - len(enrollment_df)} enrollment records were dropped')
-
-        section_df = pd.DataFrame(section_records).drop_duplicates(subset=['canvas_id'], keep='last')
         return (enrollment_df, section_df)
 
     def gather(self) -> None:
         logger.info('** AsyncEnrollGatherer')
         logger.info('Gathering enrollment data for courses asynchronously with GraphQL')
 
-        more_to_gather = True
+        self.start_queue()
+        in_flight: Dict[Future, Tuple[int, ...]] = {}
 
-        loop_num = 0
-        while more_to_gather:
-            loop_num += 1
-            logger.info(f'Starting loop number {loop_num}')
-            course_ids_to_process = sorted(self.get_incomplete_course_ids())
+        while self.queued_course_ids or self.delayed_course_ids or in_flight:
+            next_release = self.release_delayed_course_ids()
 
-            if len(course_ids_to_process) == 0:
-                more_to_gather = False
-            else:
-                unstarted_course_ids = [
-                    course_id for course_id in course_ids_to_process
-                    if course_id not in self.course_enrollments.keys()
-                ]
-                # This condition will stop the gather process if all the remaining course_ids
-                # have not been started. Usually, several request attempts will have been made
-                # using this course_id before reaching this state. The first check ensures that
-                # all requests are tried at least once; if the unlikely event occurred that all
-                # requests failed the first time, the process would then exit.
-                if (loop_num > 1) and (unstarted_course_ids == course_ids_to_process):
-                    more_to_gather = False
-                    if loop_num == 2:
-                        logger.error('No course IDs could be processed on the first loop!')
-                    else:
-                        logger.warning('Some course IDs could not be processed')
-                    logger.warning(course_ids_to_process)
-                else:
-                    self.make_requests(course_ids_to_process)
+            # Keep num_workers requests in flight, scaled down with the shared limiter (as in
+            # AioEnrollGatherer) if Canvas is close to throttling
+            while self.queued_course_ids and len(in_flight) < self.canvas_client.limiter.scale(self.num_workers):
+                course_ids = self.pop_course_ids()
+                in_flight[self.post_enrollment_request(course_ids)] = course_ids
+
+            if not in_flight:
+                # Every remaining course is backing off
+                time.sleep(next_release or 0.0)
+                continue
+            completed_responses, _ = wait(in_flight, timeout=next_release, return_when=FIRST_COMPLETED)
+            for completed_response in completed_responses:
+                course_ids = in_flight.pop(completed_response)
+                self.requeue_course_ids(course_ids, self.parse_enrollment_response(completed_response))
 
+        self.log_failed_course_ids()
         logger.info('Enrollment records for the course IDs have been gathered')
@@ -1,102 +1,188 @@
 import logging
 import time
+import numpy as np
 import pandas as pd
+import requests
 from json.decoder import JSONDecodeError
-from requests_futures.sessions import FuturesSession
-from concurrent.futures import as_completed
 import json
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from canvas_client.client import CanvasClient
+from canvas_client.retry_scheduler import RetryableResponseError, RetryScheduler
+from course_inventory.schema import apply_schema
+from db.db_creator import DBCreator
 logger = logging.getLogger(__name__)
 
+INT32_INFO = np.iinfo(np.int32)
+# Stands for a missing date among dates in nanoseconds, as in pandas
+NAT_VALUE = np.iinfo(np.int64).min
+
+
+class UsageBuffer:
+    '''
+    Accumulates course activity as each response is parsed, flattened into typed column arrays
+    (of the dtypes in course_inventory.schema). Canvas sends the same few dates for every course,
+    so each distinct date string is parsed once, to a UTC date in nanoseconds, and cached. Missing
+    counts are stored as 0; rows without a date, or with counts that don't fit the 32-bit columns,
+    are skipped (and counted) rather than failing the job once the fetch is done.
+    '''
+
+    __slots__ = ('course_ids', 'dates', 'views', 'participations', 'parsed_dates', 'num_skipped_rows')
+
+    def __init__(self) -> None:
+        self.course_ids: array = array('q')
+        self.dates: array = array('q')
+        self.views: array = array('i')
+        self.participations: array = array('i')
+        self.parsed_dates: Dict[str, int] = {}
+        self.num_skipped_rows: int = 0
+
+    def __len__(self) -> int:
+        return len(self.course_ids)
+
+    def parse_date(self, date_str: Optional[str]) -> int:
+        date_value = self.parsed_dates.get(date_str)
+        if date_value is None:
+            if date_str is None:
+                return NAT_VALUE
+            # Canvas may send dates with a time and offset; they're stored as UTC dates
+            timestamp = pd.Timestamp(date_str)
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+            date_value = timestamp.normalize().value
+            self.parsed_dates[date_str] = date_value
+        return date_value
+
+    def clean_rows(self, course_id: int, analytics: List[Dict[str, Any]]) -> Tuple[np.ndarray, ...]:
+        num_rows = len(analytics)
+        date_values = np.fromiter((self.parse_date(row.get('date')) for row in analytics), np.int64, num_rows)
+        # Missing counts become NaN, then 0
+        views = np.nan_to_num(np.array([row.get('views') for row in analytics], dtype=np.float64))
+        participations = np.nan_to_num(np.array([row.get('participations') for row in analytics], dtype=np.float64))
+        is_valid = (
+            (date_values != NAT_VALUE)
+            & (views >= INT32_INFO.min) & (views <= INT32_INFO.max)
+            & (participations >= INT32_INFO.min) & (participations <= INT32_INFO.max)
+        )
+        num_invalid = num_rows - int(is_valid.sum())
+        if num_invalid:
+            logger.warning(
+                f'Skipping {num_invalid} canvas course usage record(s) for course {course_id} '
+                'without a date or with counts that are out of range'
+            )
+            self.num_skipped_rows += num_invalid
+        return (
+            date_values[is_valid],
+            views[is_valid].astype(np.int32),
+            participations[is_valid].astype(np.int32)
+        )
+
+    def add_rows(self, course_id: int, analytics: List[Dict[str, Any]], keep_after: Optional[int] = None) -> None:
+        '''
+        Adds a course's activity rows, skipping days on or before keep_after (in nanoseconds).
+        '''
+        try:
+            # Nearly every response has a date and integer counts that fit the columns in every
+            # row, which the arrays check as they're built; other responses are cleaned row by row
+            date_values = array('q', [self.parse_date(row['date']) for row in analytics])
+            views = array('i', [row['views'] for row in analytics])
+            participations = array('i', [row['participations'] for row in analytics])
+            if NAT_VALUE in date_values:
+                raise ValueError('Missing date')
+            columns = (
+                np.frombuffer(date_values, np.int64),
+                np.frombuffer(views, np.int32),
+                np.frombuffer(participations, np.int32)
+            )
+        except (KeyError, TypeError, OverflowError, ValueError):
+            columns = self.clean_rows(course_id, analytics)
+
+        if keep_after is not None:
+            is_kept = columns[0] > keep_after
+            columns = tuple(column[is_kept] for column in columns)
+        self.course_ids.frombytes(np.full(len(columns[0]), course_id, dtype=np.int64).tobytes())
+        for buffer_array, column in zip((self.dates, self.views, self.participations), columns):
+            buffer_array.frombytes(column.tobytes())
+
+    def to_df(self) -> pd.DataFrame:
+        df = pd.DataFrame({
+            'date': np.frombuffer(self.dates, dtype=np.int64).view('datetime64[ns]'),
+            'participations': np.frombuffer(self.participations, dtype=self.participations.typecode),
+            'views': np.frombuffer(self.views, dtype=self.views.typecode),
+            'course_id': np.frombuffer(self.course_ids, dtype=self.course_ids.typecode)
+        })
+        return apply_schema(df, 'canvas_course_usage')
+
 
 class CanvasCourseUsage:
-    def __init__(self, canvas_url, canvas_token, retry_attempts, course_ids):
-        self.canvas_url = canvas_url
-        self.canvas_token = canvas_token
+    def __init__(
+        self,
+        canvas_client: CanvasClient,
+        retry_attempts,
+        course_ids,
+        watermarks: Optional[pd.Series] = None,
+        overlap_days: int = 2
+    ):
+        self.canvas_client = canvas_client
         self.course_ids = course_ids
         self.retry_attempts = retry_attempts
-        self.canvas_usage_courses = []
-        self.course_retry_list = []
-        self.retry_count = 0
-
-    def parsing_canvas_course_usage_data(self, response) -> None:
+        # With watermarks (the latest stored date, indexed by course ID), only the days after a
+        # course's watermark, less overlap_days (which Canvas may still be updating), are kept
+        self.watermarks = watermarks
+        self.overlap_days = overlap_days
+        self.usage_buffer = UsageBuffer()
+        self.num_courses_with_usage = 0
+
+    def get_keep_after(self, course_id: int) -> Optional[int]:
+        if self.watermarks is None:
+            return None
+        watermark = self.watermarks.get(course_id)
+        if watermark is None or pd.isna(watermark):
+            return None
+        return (pd.Timestamp(watermark) - pd.Timedelta(days=self.overlap_days)).value
+
+    def parsing_canvas_course_usage_data(self, response: requests.Response) -> None:
         logger.debug("parsing_canvas_course_usage_data Call")
-        new_dic = {}
-        if response is None:
-            logger.info(f"For Canvas Course usage response is None ")
-            return
-
-        logger.info(f"CanvasCourseUsage data collected so far : {len(self.canvas_usage_courses)}")
-        status = response.result().status_code
-
-        course_id = response.result().url.split('courses/')[1].split('/')[0]
-
-        status_codes_to_retry = [500]
-        if status != 200:
-            logger.info(f'retry_count: {self.retry_count}')
-            if self.retry_count < self.retry_attempts and status in status_codes_to_retry:
-                logger.info("Append to retry list")
-                self.course_retry_list.append(course_id)
-            logger.info(f"Response not successful with status code {status} due to {response.result().text}")
-            return
+        logger.debug(f"CanvasCourseUsage data collected so far : {self.num_courses_with_usage}")
+        course_id = int(response.url.split('courses/')[1].split('/')[0])
 
         try:
-            analytics_data = json.loads(response.result().text)
+            analytics_data = json.loads(response.text)
         except JSONDecodeError as e:
-            logger.error(f"Error in parsing the response due to {e.msg}")
-            logger.info("Append to retry list")
-            self.course_retry_list.append(course_id)
-            return
+            raise RetryableResponseError(f"Error in parsing the response due to {e.msg}")
 
         if not analytics_data:
-            logger.info(f"Response for fetching canvas course usage is empty")
+            logger.debug(f"Response for fetching canvas course usage is empty")
             return
-        new_dic['course_id'] = course_id
-        new_dic['analytics'] = analytics_data
+        self.usage_buffer.add_rows(course_id, analytics_data, self.get_keep_after(course_id))
+        self.num_courses_with_usage += 1
 
-        self.canvas_usage_courses.append(new_dic)
-
-    def _get_canvas_course_views_participation_data(self, retry_courses=None):
+    def _get_canvas_course_views_participation_data(self):
         logger.debug("Starting of _get_canvas_course_views_participation_data call")
-        with FuturesSession() as session:
-            headers = {'Content-type': 'application/json', 'Authorization': 'Bearer ' + self.canvas_token}
-            # https://umich.instructure.com/api/v1/courses/course_id/analytics/activity
-            if retry_courses is None:
-                logger.info("Initial round getting canvas_course_usage data")
-                responses = [session.get(f'{self.canvas_url}/api/v1/courses/{course_id}/analytics/activity',
-                                         headers=headers) for course_id in self.course_ids]
-            else:
-                self.course_retry_list = []
-                logger.info("Retry round getting canvas_course_usage data")
-                responses = [session.get(f'{self.canvas_url}/api/v1/courses/{retry_course}/analytics/activity',
-                                         headers=headers) for retry_course in retry_courses]
-
-            for response in as_completed(responses):
-                self.parsing_canvas_course_usage_data(response)
-
-        logger.info(f"Any thing to Retry? With List of length {len(self.course_retry_list)} : {self.course_retry_list}")
-        if len(self.course_retry_list) != 0 and self.retry_count < self.retry_attempts:
-            logger.info(f"Retrying again for {self.retry_count + 1}")
-            self.retry_count = self.retry_count + 1
-            self._get_canvas_course_views_participation_data(self.course_retry_list)
+        # https://umich.instructure.com/api/v1/courses/course_id/analytics/activity
+        retry_scheduler = RetryScheduler(self.canvas_client, self.retry_attempts)
+        retry_scheduler.add_stream(
+            ((f'/api/v1/courses/{course_id}/analytics/activity', None) for course_id in self.course_ids),
+            self.parsing_canvas_course_usage_data
+        )
+        failed_requests = retry_scheduler.run()
+        if failed_requests:
+            logger.warning(f"Canvas course usage could not be fetched for {len(failed_requests)} course(s)")
 
     # preparing the data to be loaded to df in format [date, views, paticipations, course_id]
     def canvas_course_usage_to_df(self):
-        rows = []
-        for data in self.canvas_usage_courses:
-            analytics = data['analytics']
-            course_id = data['course_id']
-
-            for row in analytics:
-                row['course_id'] = course_id
-                rows.append(row)
-
-        df = pd.DataFrame(rows)
+        df = self.usage_buffer.to_df()
         logger.info(df.head())
-        df = df.drop(['id'], axis=1)
-        df_dup = df[df.duplicated()]
-        logger.info('Check for duplicate items')
-        logger.info(df_dup)
-        df = df.drop_duplicates()
+        if self.usage_buffer.num_skipped_rows:
+            logger.warning(f'Skipped {self.usage_buffer.num_skipped_rows} invalid canvas course usage records')
+        if self.watermarks is not None:
+            logger.info(f'Kept {len(df)} canvas course usage records after the stored dates')
+        # (course_id, date) is unique in the table, so only the last record of a day is kept
+        num_rows = len(df)
+        df = df.drop_duplicates(subset=['course_id', 'date'], keep='last', ignore_index=True)
+        if len(df) < num_rows:
+            logger.info(f'Dropped {num_rows - len(df)} duplicate canvas course usage records')
         logger.debug(df.head())
         return df
 
@@ -107,3 +193,19 @@ class CanvasCourseUsage:
         str_time = time.strftime("%H:%M:%S", time.gmtime(delta))
         logger.info(f'Duration of Canvas Course usage run took: {str_time}')
         return self.canvas_course_usage_to_df()
+
+
+def load_incremental_course_usage(
+    db_creator_obj: DBCreator,
+    usage_df: pd.DataFrame,
+    stored_course_ids: Iterable[int],
+    available_course_ids: Iterable[int]
+) -> None:
+    '''
+    Brings canvas_course_usage to what a full run would load: the stored records of courses that
+    are no longer available are deleted, then the new records are upserted by (course_id, date).
+    '''
+    stale_course_ids = sorted(set(stored_course_ids) - set(available_course_ids))
+    logger.info(f'Deleting canvas_course_usage records of {len(stale_course_ids)} course(s) no longer available')
+    db_creator_obj.delete_keys('canvas_course_usage', pd.DataFrame({'course_id': stale_course_ids}, dtype='int64'))
+    db_creator_obj.bulk_insert('canvas_course_usage', usage_df, on_duplicate='update')
@@ -0,0 +1,122 @@
+# standard libraries
+import gzip, json, logging, os, pickle, time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    '''
+    Keeps gzipped pickles of a job's intermediate results (e.g. stage DataFrames, whose pickles
+    hold each column as one binary block) in a spill directory, so a failed run can be resumed.
+    Checkpoints older than max_age_seconds, counted from the run that wrote the first one, are
+    discarded; call clear once the job has finished.
+
+    Each checkpoint starts with a JSON header line giving the job name, the run key (a string
+    describing the run's inputs, e.g. its account and terms) and when the run started, which is
+    checked against the current run before anything is unpickled; checkpoints that don't match
+    are discarded rather than resumed.
+    '''
+
+    run_file_name = 'run.json'
+
+    def __init__(self, directory: str, max_age_seconds: float, job_name: str, run_key: str) -> None:
+        self.directory: str = directory
+        self.job_name: str = job_name
+        self.run_key: str = run_key
+        os.makedirs(self.directory, exist_ok=True)
+
+        run_info = self.read_run_info()
+        if run_info is not None:
+            age = time.time() - datetime.fromisoformat(run_info['run_started_at']).timestamp()
+            if run_info['job_name'] != job_name or run_info['run_key'] != run_key:
+                logger.warning(
+                    f'Discarding checkpoints in {self.directory} from a {run_info["job_name"]} run '
+                    f'with other inputs ({run_info["run_key"]})'
+                )
+                run_info = None
+            elif age > max_age_seconds:
+                logger.info(f'Discarding checkpoints from {age / 3600:.1f} hour(s) ago in {self.directory}')
+                run_info = None
+            else:
+                logger.info(f'Resuming from checkpoints from {age / 3600:.1f} hour(s) ago in {self.directory}')
+
+        if run_info is None:
+            self.clear()
+            run_info = {
+                'job_name': job_name,
+                'run_key': run_key,
+                'run_started_at': datetime.now(timezone.utc).isoformat()
+            }
+            with open(os.path.join(self.directory, self.run_file_name), 'w') as run_file:
+                json.dump(run_info, run_file)
+        self.run_started_at: str = run_info['run_started_at']
+
+    def read_run_info(self) -> Optional[Dict[str, str]]:
+        run_path = os.path.join(self.directory, self.run_file_name)
+        if not os.path.exists(run_path):
+            return None
+        try:
+            with open(run_path) as run_file:
+                run_info = json.load(run_file)
+            datetime.fromisoformat(run_info['run_started_at'])
+            return {key: run_info[key] for key in ('job_name', 'run_key', 'run_started_at')}
+        except (ValueError, KeyError, TypeError) as error:
+            logger.warning(f'Discarding checkpoints in {self.directory} with an unreadable run file: {error!r}')
+            return None
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.pkl.gz')
+
+    def make_header(self, name: str) -> Dict[str, str]:
+        return {
+            'name': name,
+            'job_name': self.job_name,
+            'run_key': self.run_key,
+            'run_started_at': self.run_started_at
+        }
+
+    def read_header(self, checkpoint_file: gzip.GzipFile) -> Optional[Dict[str, str]]:
+        try:
+            return json.loads(checkpoint_file.readline())
+        except (OSError, EOFError, ValueError):
+            return None
+
+    def has(self, name: str) -> bool:
+        '''
+        Returns whether there's a checkpoint from this run with the name; one from another run is
+        removed.
+        '''
+        path = self.get_path(name)
+        if not os.path.exists(path):
+            return False
+        with gzip.open(path, 'rb') as checkpoint_file:
+            header = self.read_header(checkpoint_file)
+        if header != self.make_header(name):
+            logger.warning(f'Discarding checkpoint {name}, which is not from this run: {header}')
+            os.remove(path)
+            return False
+        return True
+
+    def load(self, name: str) -> Any:
+        with gzip.open(self.get_path(name), 'rb') as checkpoint_file:
+            header = self.read_header(checkpoint_file)
+            if header != self.make_header(name):
+                raise ValueError(f'Checkpoint {name} is not from this run: {header}')
+            return pickle.load(checkpoint_file)
+
+    def save(self, name: str, value: Any) -> None:
+        # Write to a temporary file first, so an interrupted write never leaves a partial checkpoint
+        temp_path = f'{self.get_path(name)}.tmp'
+        with gzip.open(temp_path, 'wb', compresslevel=1) as checkpoint_file:
+            checkpoint_file.write(json.dumps(self.make_header(name)).encode('utf-8') + b'\n')
+            pickle.dump(value, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.get_path(name))
+        logger.debug(f'Saved checkpoint {name}')
+
+    def clear(self) -> None:
+        for file_name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, file_name))
+        logger.info(f'Cleared checkpoints in {self.directory}')
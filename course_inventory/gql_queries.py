@@ -1,3 +1,7 @@
+# standard libraries
+from functools import lru_cache
+
+
 course_enrollments_query = '''
     query courseEnrollmentsQuery (
         $courseID: ID!,
@@ -34,6 +38,60 @@ course_enrollments_query = '''
     }
 '''
 
+
+batched_course_enrollments_fragment = '''
+    fragment courseEnrollmentsFields on Course {
+        _id
+        enrollmentsConnection(
+            first: $enrollmentPageSize
+        ) {
+            nodes {
+                _id
+                section {
+                    _id
+                    name
+                }
+                state
+                type
+                user {
+                    _id
+                }
+                course {
+                    _id
+                }
+            }
+            pageInfo {
+                endCursor
+                hasNextPage
+            }
+        }
+    }
+'''
+
+
+@lru_cache(maxsize=None)
+def build_batched_course_enrollments_query(num_courses: int) -> str:
+    '''
+    Builds a query requesting the first page of enrollments for num_courses courses at once.
+    Each course is aliased as course0, course1, etc. and identified by the $courseID0, $courseID1,
+    etc. variables; later pages should be requested one course at a time with course_enrollments.
+    '''
+    variable_defs = ',\n'.join(f'        $courseID{i}: ID!' for i in range(num_courses))
+    aliased_courses = '\n'.join(
+        f'        course{i}: course(id: $courseID{i}) {{ ...courseEnrollmentsFields }}'
+        for i in range(num_courses)
+    )
+    return (
+        '\n    query batchedCourseEnrollmentsQuery (\n'
+        f'{variable_defs},\n'
+        '        $enrollmentPageSize: Int\n'
+        '    ) {\n'
+        f'{aliased_courses}\n'
+        '    }\n'
+        f'{batched_course_enrollments_fragment}'
+    )
+
+
 queries = {
     'course_enrollments': course_enrollments_query
 }
@@ -1,7 +1,10 @@
 # standard libraries
-import json, logging, os, time
+import io, json, logging, os, time
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
 from json.decoder import JSONDecodeError
-from typing import Any, Dict, List, Sequence, Union
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar, Union
+from urllib.parse import parse_qs, urlencode, urlparse
 
 # third-party libraries
 import pandas as pd
@@ -11,12 +14,22 @@ from requests import Response
 from umich_api.api_utils import ApiUtil
 
 # local libraries
+from canvas_client.client import CanvasClient
+from canvas_client.fixtures import FixtureStore, make_request_key
+from course_inventory.aio_enroll_gatherer import AioEnrollGatherer
 from course_inventory.async_enroll_gatherer import AsyncEnrollGatherer
-from course_inventory.canvas_course_usage import CanvasCourseUsage
+from course_inventory.canvas_course_usage import CanvasCourseUsage, load_incremental_course_usage
+from course_inventory.checkpoints import CheckpointStore
 from course_inventory.gql_queries import queries as QUERIES
 from course_inventory.published_date import FetchPublishedDate
-from db.db_creator import DBCreator
+from course_inventory.schema import apply_schema
+from course_inventory.stage_dag import StageDAG
+from course_inventory.udw_enroll_gatherer import stream_udw_query, UDWEnrollGatherer
+from db.db_creator import DBCreator, get_staging_table_name
 from environ import DATA_DIR, ENV
+from export.snapshots import SnapshotWriter
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record
 from vocab import DataSourceStatus, JobError, ValidDataSourceName
 
 # Initialize settings and globals
@@ -36,16 +49,41 @@ CANVAS_URL = CANVAS['CANVAS_URL']
 
 MAX_REQ_ATTEMPTS = ENV.get('MAX_REQ_ATTEMPTS', 3)
 NUM_ASYNC_WORKERS = ENV.get('NUM_ASYNC_WORKERS', 8)
+NUM_STAGE_WORKERS = ENV.get('NUM_STAGE_WORKERS', 1)
+RATE_LIMIT_THRESHOLD = ENV.get('RATE_LIMIT_THRESHOLD', 200)
+COURSE_FETCH_MODE = ENV.get('COURSE_FETCH_MODE', 'serial')
+ENROLLMENT_SOURCE = ENV.get('ENROLLMENT_SOURCE', 'canvas_graphql')
+ENROLLMENT_ENGINE = ENV.get('ENROLLMENT_ENGINE', 'threads')
+NUM_ASYNC_CONNECTIONS = ENV.get('NUM_ASYNC_CONNECTIONS', NUM_ASYNC_WORKERS)
+ENROLLMENT_BATCH_SIZE = ENV.get('ENROLLMENT_BATCH_SIZE', 1)
+ENROLLMENT_MAX_PAGE_SIZE = ENV.get('ENROLLMENT_MAX_PAGE_SIZE', 100)
 CREATE_CSVS = ENV.get('CREATE_CSVS', False)
+EXPORT_FORMATS = sorted(set(ENV.get('EXPORT_FORMATS', [])) | ({'csv'} if CREATE_CSVS else set()))
+EXPORT_COMPRESSION = ENV.get('EXPORT_COMPRESSION', 'zstd')
+EXPORT_PARTITION_BY_TERM = ENV.get('EXPORT_PARTITION_BY_TERM', False)
+DB_LOAD_MODE = ENV.get('DB_LOAD_MODE', 'replace')
+COURSE_USAGE_MODE = ENV.get('COURSE_USAGE_MODE', 'full')
+COURSE_USAGE_OVERLAP_DAYS = ENV.get('COURSE_USAGE_OVERLAP_DAYS', 2)
+CHECKPOINT_MAX_AGE_HOURS = ENV.get('CHECKPOINT_MAX_AGE_HOURS', 0)
+UDW_SECTION_LOOKUP_MODE = ENV.get('UDW_SECTION_LOOKUP_MODE', 'in_list')
+UDW_SECTION_CHUNK_SIZE = ENV.get('UDW_SECTION_CHUNK_SIZE', 5000)
+HTTP_FIXTURE_MODE = ENV.get('HTTP_FIXTURE_MODE', 'off')
+HTTP_FIXTURE_DIR = ENV.get('HTTP_FIXTURE_DIR') or os.path.join(DATA_DIR, 'http_fixtures')
 
 INVENTORY_DB = ENV['INVENTORY_DB']
 
 CANVAS_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+T = TypeVar('T')
+
 
 # Function(s) - Canvas
 
-def make_request_using_api_utils(url: str, params: Union[Dict[str, Any], None] = None) -> Response:
+def make_request_using_api_utils(
+    url: str,
+    params: Union[Dict[str, Any], None] = None,
+    fixture_store: Optional[FixtureStore] = None
+) -> Response:
     if params is None:
         request_params = {}
     else:
@@ -53,10 +91,22 @@ def make_request_using_api_utils(url: str, params: Union[Dict[str, Any], None] =
 
     logger.debug('Making a request for data...')
 
+    fixture_key = make_request_key(
+        'GET', f'{CANVAS["API_BASE_URL"]}/{url.lstrip("/")}?{urlencode(request_params, doseq=True)}'
+    )
     for i in range(1, MAX_REQ_ATTEMPTS + 1):
         logger.debug(f'Attempt #{i}')
-        response = API_UTIL.api_call(url, SUBSCRIPTION_NAME, payload=request_params)
+        if fixture_store is not None and fixture_store.mode == 'replay':
+            response = fixture_store.replay(fixture_key)
+        else:
+            response = API_UTIL.api_call(url, SUBSCRIPTION_NAME, payload=request_params)
+            if fixture_store is not None:
+                fixture_store.record(fixture_key, response)
         status_code = response.status_code
+        record(requests=1, retries=int(i > 1), bytes_received=len(response.content))
+        HTTP_METRICS.observe_response(response)
+        if i > 1:
+            HTTP_METRICS.record_retry(response.request.method, response.url)
 
         if status_code != 200:
             logger.warning(f'Received irregular status code: {status_code}')
@@ -74,7 +124,11 @@ def make_request_using_api_utils(url: str, params: Union[Dict[str, Any], None] =
     raise JobError(f'Data could not be gathered from the URL with the ending "{url}"')
 
 
-def gather_term_data_from_api(account_id: int, term_ids: Sequence[int]) -> pd.DataFrame:
+def gather_term_data_from_api(
+    account_id: int,
+    term_ids: Sequence[int],
+    fixture_store: Optional[FixtureStore] = None
+) -> pd.DataFrame:
     logger.info('** gather_new_term_data_from_api')
 
     # Fetch data for terms from config
@@ -85,7 +139,7 @@ def gather_term_data_from_api(account_id: int, term_ids: Sequence[int]) -> pd.Da
     for term_id in term_ids:
         logger.info(f'Pulling data for term number {term_id}')
         term_url_ending = url_ending_with_scope + str(term_id)
-        response = make_request_using_api_utils(term_url_ending)
+        response = make_request_using_api_utils(term_url_ending, fixture_store=fixture_store)
 
         term_data = json.loads(response.text)
         slim_term_dict = {
@@ -103,7 +157,7 @@ def gather_term_data_from_api(account_id: int, term_ids: Sequence[int]) -> pd.Da
         }
         term_dicts.append(slim_term_dict)
 
-    term_df = pd.DataFrame(term_dicts)
+    term_df = apply_schema(pd.DataFrame(term_dicts), 'term')
     logger.debug(term_df.head())
     return term_df
 
@@ -129,41 +183,138 @@ def slim_down_course_data(course_data: List[Dict]) -> List[Dict]:
     return slim_course_dicts
 
 
-def gather_course_data_from_api(account_id: int, term_ids: Sequence[int]) -> pd.DataFrame:
+def get_last_page_num(response: Response) -> Union[int, None]:
+    '''
+    Returns the page number from the "last" Link header of a Canvas response, if Canvas
+    provided one with a numeric page value; otherwise, returns None.
+    '''
+    last_link = response.links.get('last')
+    if last_link is None:
+        return None
+    page_values = parse_qs(urlparse(last_link['url']).query).get('page', [])
+    if len(page_values) == 1 and page_values[0].isdigit():
+        return int(page_values[0])
+    return None
+
+
+def parse_course_page(response: Response) -> List[Dict]:
+    # Pages are slimmed down as they arrive, so full course records and responses aren't held
+    return slim_down_course_data(json.loads(response.text))
+
+
+def fetch_course_page(
+    url_ending: str,
+    params: Dict[str, Any],
+    fixture_store: Optional[FixtureStore] = None
+) -> List[List[Dict]]:
+    return [parse_course_page(make_request_using_api_utils(url_ending, params, fixture_store))]
+
+
+def walk_course_pages(
+    url_ending: str,
+    response: Response,
+    fixture_store: Optional[FixtureStore] = None
+) -> List[List[Dict]]:
+    '''
+    Follows "next" links one page at a time, starting after the page in the given response.
+    '''
+    pages = []
+    next_params = API_UTIL.get_next_page(response)
+    while next_params:
+        response = make_request_using_api_utils(url_ending, next_params, fixture_store)
+        pages.append(parse_course_page(response))
+        next_params = API_UTIL.get_next_page(response)
+    return pages
+
+
+def gather_course_pages_serially(
+    url_ending: str,
+    term_params: Sequence[Dict[str, Any]],
+    fixture_store: Optional[FixtureStore] = None
+) -> List[List[Dict]]:
+    pages = []
+    for params in term_params:
+        logger.info(f'Fetching course data for term {params["enrollment_term_id"]}')
+        response = make_request_using_api_utils(url_ending, params, fixture_store)
+        pages.append(parse_course_page(response))
+        pages += walk_course_pages(url_ending, response, fixture_store)
+        logger.info(f'Fetched {len(pages)} course page(s) so far')
+    return pages
+
+
+def gather_course_pages_in_parallel(
+    url_ending: str,
+    term_params: Sequence[Dict[str, Any]],
+    fixture_store: Optional[FixtureStore] = None
+) -> List[List[Dict]]:
+    '''
+    Requests the first page for every term at once; when Canvas provides a "last" link,
+    the remaining pages for that term are requested by page number using the worker pool.
+    Terms without a usable "last" link are walked using "next" links within a worker.
+    Pages are returned ordered by term and page number, regardless of completion order.
+    '''
+    # Keys are (term_index, page_num); walked terms store their remaining pages under page_num 2
+    page_futures: Dict[Tuple[int, int], Future] = {}
+    course_pages: Dict[Tuple[int, int], List[List[Dict]]] = {}
+    with ThreadPoolExecutor(max_workers=NUM_ASYNC_WORKERS) as executor:
+        first_futures = {
+            executor.submit(make_request_using_api_utils, url_ending, params, fixture_store): term_index
+            for term_index, params in enumerate(term_params)
+        }
+        for first_future in as_completed(first_futures):
+            term_index = first_futures[first_future]
+            params = term_params[term_index]
+            response = first_future.result()
+            course_pages[(term_index, 1)] = [parse_course_page(response)]
+
+            last_page_num = get_last_page_num(response)
+            if last_page_num is None:
+                logger.info(f'No last page found for term {params["enrollment_term_id"]}; following next links')
+                page_futures[(term_index, 2)] = executor.submit(walk_course_pages, url_ending, response, fixture_store)
+            else:
+                logger.info(f'Term {params["enrollment_term_id"]} has {last_page_num} course page(s)')
+                for page_num in range(2, last_page_num + 1):
+                    page_futures[(term_index, page_num)] = executor.submit(
+                        fetch_course_page, url_ending, {**params, 'page': page_num}, fixture_store
+                    )
+
+        for key, page_future in page_futures.items():
+            course_pages[key] = page_future.result()
+
+    pages = []
+    for key in sorted(course_pages.keys()):
+        pages += course_pages[key]
+    logger.info(f'Fetched {len(pages)} course page(s) using {NUM_ASYNC_WORKERS} workers')
+    return pages
+
+
+def gather_course_data_from_api(
+    account_id: int,
+    term_ids: Sequence[int],
+    fixture_store: Optional[FixtureStore] = None
+) -> pd.DataFrame:
     logger.info('** gather_course_data_from_api')
     url_ending_with_scope = f'{API_SCOPE_PREFIX}/accounts/{account_id}/courses'
 
-    course_dicts: List[Dict[str, Any]] = []
-    for term_id in term_ids:
-        logger.info(f'Fetching course data for term {term_id}')
-
-        params = {
+    term_params = [
+        {
             'with_enrollments': True,
             'enrollment_type': ['student', 'teacher'],
             'enrollment_term_id': term_id,
             'per_page': 100,
             'include': ['total_students']
         }
+        for term_id in term_ids
+    ]
 
-        # Make first course request
-        page_num = 1
-        logger.info(f'Course Page Number: {page_num}')
-        response = make_request_using_api_utils(url_ending_with_scope, params)
-        all_course_data = json.loads(response.text)
-        course_dicts += slim_down_course_data(all_course_data)
-        more_pages = True
-
-        while more_pages:
-            next_params = API_UTIL.get_next_page(response)
-            if next_params:
-                page_num += 1
-                logger.info(f'Course Page Number: {page_num}')
-                response = make_request_using_api_utils(url_ending_with_scope, next_params)
-                all_course_data = json.loads(response.text)
-                course_dicts += slim_down_course_data(all_course_data)
-            else:
-                logger.info('No more pages!')
-                more_pages = False
+    if COURSE_FETCH_MODE == 'parallel':
+        course_pages = gather_course_pages_in_parallel(url_ending_with_scope, term_params, fixture_store)
+    else:
+        course_pages = gather_course_pages_serially(url_ending_with_scope, term_params, fixture_store)
+
+    course_dicts: List[Dict[str, Any]] = []
+    for course_page in course_pages:
+        course_dicts += course_page
 
     num_course_dicts = len(course_dicts)
     logger.info(f'Total course records for all active terms: {num_course_dicts}')
@@ -177,16 +328,19 @@ def gather_course_data_from_api(account_id: int, term_ids: Sequence[int]) -> pd.
     logger.info(f'Dropped {num_course_dicts - num_course_dicts_with_students} course record(s) with no students')
 
     course_df = pd.DataFrame(course_dicts_with_students)
-    course_df = course_df.drop(['total_students'], axis='columns')
+    course_df['created_at'] = pd.to_datetime(course_df['created_at'], format=CANVAS_DATETIME_FORMAT, errors='coerce')
     orig_course_count = len(course_df)
-    course_df = course_df.drop_duplicates(subset=['canvas_id'], keep='last')
+    course_df = apply_schema(course_df.drop_duplicates(subset=['canvas_id'], keep='last'), 'course')
     logger.info(f'Dropped {orig_course_count - len(course_df)} duplicate course record(s)')
 
     logger.debug(course_df.head())
     return course_df
 
 
-def gather_account_data_from_api(account_ids: Sequence[int]) -> pd.DataFrame:
+def gather_account_data_from_api(
+    account_ids: Sequence[int],
+    fixture_store: Optional[FixtureStore] = None
+) -> pd.DataFrame:
     logger.info('** gather_account_data_from_api')
     url_ending_with_scope = f'{API_SCOPE_PREFIX}/accounts/'
 
@@ -195,7 +349,7 @@ def gather_account_data_from_api(account_ids: Sequence[int]) -> pd.DataFrame:
     for account_id in account_ids:
         logger.debug(f'Account number {account_id}')
         account_url_ending = url_ending_with_scope + str(account_id)
-        response = make_request_using_api_utils(account_url_ending)
+        response = make_request_using_api_utils(account_url_ending, fixture_store=fixture_store)
         account_data = json.loads(response.text)
         slim_account_dict = {
             'canvas_id': account_data['id'],
@@ -208,105 +362,186 @@ def gather_account_data_from_api(account_ids: Sequence[int]) -> pd.DataFrame:
         account_dicts.append(slim_account_dict)
     logger.info('Gathered account data')
 
-    account_df = pd.DataFrame(account_dicts)
+    account_df = apply_schema(pd.DataFrame(account_dicts), 'account')
     logger.debug(account_df.head())
     return account_df
 
 
-# Function(s) - UDW
-
-def pull_sis_section_data_from_udw(section_ids: Sequence[int], conn: connection) -> pd.DataFrame:
-    section_ids_tup = tuple(section_ids)
-    section_query = f'''
-        SELECT cs.canvas_id AS canvas_id,
-               cs.sis_source_id AS sis_id
-        FROM course_section_dim cs
-        WHERE cs.canvas_id in %s;
-    '''
-    logger.info('Making course_section_dim query against UDW')
-    udw_section_df = pd.read_sql(section_query, conn, params=(section_ids_tup,))
-    logger.debug(udw_section_df.head())
-    return udw_section_df
-
-
-def get_pub_course_info_from_db(db_creator_obj: DBCreator) -> pd.DataFrame:
-    logger.info(f"Getting the course info from {db_creator_obj.db_name} database")
-    course_from_db_df = pd.read_sql(f'''select canvas_id, published_at from course
-                            where workflow_state = 'available' ;''',
-                                    db_creator_obj.engine)
-    return course_from_db_df
-
-
-# Entry point for run_jobs.py
+def add_published_dates(
+    canvas_client: CanvasClient,
+    db_creator_obj: DBCreator,
+    course_df: pd.DataFrame
+) -> pd.DataFrame:
+    course_from_db_df = get_pub_course_info_from_db(db_creator_obj)
 
+    # Other stages share course_df, so it isn't changed; published dates are only needed by ID
+    fetch_publish_date = FetchPublishedDate(
+        canvas_client, course_df[['canvas_id', 'workflow_state']], course_from_db_df, MAX_REQ_ATTEMPTS
+    )
+    pub_dates_df = fetch_publish_date.get_published_date()
+    published_date_updates_df = fetch_publish_date.get_published_date_updates()
+    logger.info(f'Storing the results of {len(published_date_updates_df)} published date lookup(s)')
+    db_creator_obj.bulk_insert('course_published_date', published_date_updates_df, on_duplicate='update')
+    published_at = pub_dates_df.drop_duplicates(subset=['canvas_id']).set_index('canvas_id')['published_at']
 
-def run_course_inventory() -> Sequence[DataSourceStatus]:
-    logger.info("* run_course_inventory")
-    # Initialize DBCreator object
-    db_creator_obj = DBCreator(INVENTORY_DB)
+    # total_students isn't stored, but it's used to schedule enrollment requests
+    course_df = course_df.drop(['total_students'], axis='columns')
+    course_df['published_at'] = course_df['canvas_id'].map(published_at)
+    logger.info(f"Found published dates for {course_df['published_at'].notna().sum()} course(s)")
+    return apply_schema(course_df, 'course')
 
-    logger.info('Making requests against the Canvas API')
 
-    # Gather term data
-    term_df = gather_term_data_from_api(ACCOUNT_ID, TERM_IDS)
+def get_course_usage_watermarks(db_creator_obj: DBCreator) -> pd.Series:
+    logger.info(f"Getting the latest canvas_course_usage dates from {db_creator_obj.db_name} database")
+    watermark_df = pd.read_sql(
+        'SELECT course_id, MAX(date) AS max_date FROM canvas_course_usage GROUP BY course_id;', db_creator_obj.engine
+    )
+    return pd.to_datetime(watermark_df.set_index('course_id')['max_date'])
 
-    # Gather course data
-    course_df = gather_course_data_from_api(ACCOUNT_ID, TERM_IDS)
-    course_available_df = course_df.loc[course_df.workflow_state == 'available'].copy(deep=True)
-    logger.info(f"Size of courses with available workflow state: {course_available_df.shape}")
 
-    course_copy_df = course_df.copy(deep=True)
-    course_from_db_df = get_pub_course_info_from_db(db_creator_obj)
+def is_course_usage_incremental() -> bool:
+    # Other load modes empty course, which (by cascading) empties canvas_course_usage
+    if COURSE_USAGE_MODE != 'incremental':
+        return False
+    if DB_LOAD_MODE != 'upsert':
+        logger.warning('Incremental course usage needs the upsert DB_LOAD_MODE; fetching all course usage instead')
+        return False
+    return True
 
-    fetch_publish_date = FetchPublishedDate(CANVAS_URL, CANVAS_TOKEN, NUM_ASYNC_WORKERS,
-                                            course_copy_df, course_from_db_df, MAX_REQ_ATTEMPTS)
-    pub_dates_df = fetch_publish_date.get_published_date()
-    course_size_before_merge = course_df.shape[0]
-    course_df = pd.merge(course_df, pub_dates_df, on='canvas_id', how='left')
-    course_size_after_merge = course_df.shape[0]
-    logger.info(
-        f"Course info loss due to published date fetch/merge: {course_size_before_merge - course_size_after_merge}")
 
-    course_df['created_at'] = pd.to_datetime(course_df['created_at'],
-                                             format=CANVAS_DATETIME_FORMAT,
-                                             errors='coerce')
+def gather_course_usage_data(
+    canvas_client: CanvasClient,
+    db_creator_obj: DBCreator,
+    course_df: pd.DataFrame
+) -> pd.DataFrame:
+    available_course_ids = course_df.loc[course_df['workflow_state'] == 'available', 'canvas_id'].tolist()
+    logger.info(f"Number of courses with available workflow state: {len(available_course_ids)}")
 
+    watermarks = get_course_usage_watermarks(db_creator_obj) if is_course_usage_incremental() else None
     logger.info("*** Fetching the canvas course usage data ***")
-    canvas_course_usage = CanvasCourseUsage(CANVAS_URL, CANVAS_TOKEN, MAX_REQ_ATTEMPTS, course_available_df['canvas_id'].tolist())
-    canvas_course_usage_df = canvas_course_usage.get_canvas_course_views_participation_data()
+    canvas_course_usage = CanvasCourseUsage(
+        canvas_client, MAX_REQ_ATTEMPTS, available_course_ids, watermarks, COURSE_USAGE_OVERLAP_DAYS
+    )
+    return canvas_course_usage.get_canvas_course_views_participation_data()
 
-    # Gather account data
-    account_ids = sorted(course_df['account_id'].drop_duplicates().to_list())
-    account_df = gather_account_data_from_api(account_ids)
 
-    # Gather enrollment and section data
+def gather_enrollment_data(
+    canvas_client: CanvasClient,
+    course_df: pd.DataFrame,
+    checkpoint_store: Optional[CheckpointStore] = None,
+    fixture_store: Optional[FixtureStore] = None
+) -> Tuple[pd.DataFrame, ...]:
     course_ids = course_df['canvas_id'].to_list()
+    course_sizes = dict(zip(course_df['canvas_id'], course_df['total_students']))
 
     enroll_start = time.time()
-    enroll_gatherer = AsyncEnrollGatherer(
-        course_ids=course_ids,
-        access_token=CANVAS_TOKEN,
-        complete_url=CANVAS_URL + '/api/graphql',
-        gql_query=QUERIES['course_enrollments'],
-        enroll_page_size=75,
-        num_workers=NUM_ASYNC_WORKERS
-    )
-    enroll_gatherer.gather()
-    enrollment_df, section_df = enroll_gatherer.generate_output()
+    enroll_gatherer: Union[AsyncEnrollGatherer, UDWEnrollGatherer]
+    if ENROLLMENT_SOURCE == 'udw':
+        enroll_gatherer = run_with_udw_conn(partial(gather_enrollment_data_from_udw, course_ids))
+    else:
+        if ENROLLMENT_ENGINE == 'asyncio' and fixture_store is not None:
+            # The asyncio engine uses aiohttp, which the fixture store can't record or replay
+            logger.warning('HTTP fixtures are only supported by the threads enrollment engine; using it instead')
+        if ENROLLMENT_ENGINE == 'asyncio' and fixture_store is None:
+            enroll_gatherer_class = AioEnrollGatherer
+            enroll_num_workers = NUM_ASYNC_CONNECTIONS
+        else:
+            enroll_gatherer_class = AsyncEnrollGatherer
+            enroll_num_workers = NUM_ASYNC_WORKERS
+        enroll_gatherer = enroll_gatherer_class(
+            course_ids=course_ids,
+            canvas_client=canvas_client,
+            gql_query=QUERIES['course_enrollments'],
+            enroll_page_size=75,
+            num_workers=enroll_num_workers,
+            course_batch_size=ENROLLMENT_BATCH_SIZE,
+            course_sizes=course_sizes,
+            max_page_size=ENROLLMENT_MAX_PAGE_SIZE,
+            checkpoint_store=checkpoint_store,
+            max_attempts=MAX_REQ_ATTEMPTS
+        )
+        enroll_gatherer.gather()
+    enrollment_output = enroll_gatherer.generate_output()
     enroll_delta = time.time() - enroll_start
     logger.info(f'Duration of process (seconds): {enroll_delta}')
+    return enrollment_output
 
-    # Record data source info for Canvas API
-    canvas_data_source = DataSourceStatus(ValidDataSourceName.CANVAS_API)
 
+# Function(s) - UDW
+
+def run_with_udw_conn(udw_function: Callable[[connection], T]) -> T:
+    '''
+    Calls udw_function with a new UDW connection, which is closed once it returns. Each UDW stage
+    opens its own, so no connection is held open while the Canvas data is gathered.
+    '''
     udw_conn = psycopg2.connect(**ENV['UDW'])
+    try:
+        return udw_function(udw_conn)
+    finally:
+        udw_conn.close()
+
+
+def gather_enrollment_data_from_udw(course_ids: Sequence[int], udw_conn: connection) -> UDWEnrollGatherer:
+    enroll_gatherer = UDWEnrollGatherer(course_ids, udw_conn)
+    enroll_gatherer.gather()
+    return enroll_gatherer
 
+
+def pull_sis_section_data_from_udw(section_ids: Sequence[int], conn: connection) -> pd.DataFrame:
+    '''
+    Looks up SIS IDs for course sections. Depending on UDW_SECTION_LOOKUP_MODE, the section IDs
+    are sent as one IN list ("in_list"), as IN lists of UDW_SECTION_CHUNK_SIZE IDs ("chunked"),
+    or copied into a temporary table that the query joins against ("temp_table").
+    '''
+    columns = ['canvas_id', 'sis_id']
+    section_query = '''
+        SELECT cs.canvas_id AS canvas_id,
+               cs.sis_source_id AS sis_id
+        FROM course_section_dim cs
+        WHERE cs.canvas_id in %s;
+    '''
+    logger.info(f'Making course_section_dim query against UDW using {UDW_SECTION_LOOKUP_MODE} mode')
+
+    if UDW_SECTION_LOOKUP_MODE == 'temp_table':
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                CREATE TEMPORARY TABLE course_section_lookup (canvas_id BIGINT PRIMARY KEY);
+            ''')
+            id_file = io.StringIO(''.join(f'{section_id}\n' for section_id in set(section_ids)))
+            cursor.copy_expert('COPY course_section_lookup (canvas_id) FROM STDIN;', id_file)
+            cursor.execute('ANALYZE course_section_lookup;')
+        udw_section_df = stream_udw_query(conn, '''
+            SELECT cs.canvas_id AS canvas_id,
+                   cs.sis_source_id AS sis_id
+            FROM course_section_dim cs
+            JOIN course_section_lookup csl ON csl.canvas_id = cs.canvas_id;
+        ''', None, columns)
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE course_section_lookup;')
+        conn.commit()
+    elif UDW_SECTION_LOOKUP_MODE == 'chunked':
+        chunk_dfs = []
+        for chunk_start in range(0, len(section_ids), UDW_SECTION_CHUNK_SIZE):
+            chunk_ids = tuple(section_ids[chunk_start:chunk_start + UDW_SECTION_CHUNK_SIZE])
+            chunk_dfs.append(stream_udw_query(conn, section_query, (chunk_ids,), columns))
+        udw_section_df = (
+            pd.concat(chunk_dfs, ignore_index=True) if chunk_dfs else pd.DataFrame(columns=columns)
+        )
+    else:
+        udw_section_df = stream_udw_query(conn, section_query, (tuple(section_ids),), columns)
+
+    logger.debug(udw_section_df.head())
+    return udw_section_df
+
+
+def add_sis_section_data(section_df: pd.DataFrame, udw_conn: connection) -> pd.DataFrame:
     # Pull SIS course section data from UDW
     udw_section_ids = section_df['canvas_id'].to_list()
     sis_section_df = pull_sis_section_data_from_udw(udw_section_ids, udw_conn)
-    section_df = pd.merge(section_df, sis_section_df, on='canvas_id', how='left')
+    return apply_schema(pd.merge(section_df, sis_section_df, on='canvas_id', how='left'), 'course_section')
+
 
-    # Record data source info for UDW
+def get_udw_data_source(udw_conn: connection) -> DataSourceStatus:
     udw_meta_df = pd.read_sql('''
         SELECT *
         FROM unizin_metadata
@@ -317,73 +552,220 @@ def run_course_inventory() -> Sequence[DataSourceStatus]:
         .to_pydatetime(warn=False)
     logger.info(f'Found canvasdatadate in UDW of {udw_update_datetime}')
 
-    udw_data_source = DataSourceStatus(
-        ValidDataSourceName.UNIZIN_DATA_WAREHOUSE, udw_update_datetime)
-
-    # Produce output
-    num_term_records = len(term_df)
-    num_account_records = len(account_df)
-    num_course_records = len(course_df)
-    num_section_records = len(section_df)
-    num_enrollment_records = len(enrollment_df)
-    num_canvas_usage_records = len(canvas_course_usage_df)
+    return DataSourceStatus(ValidDataSourceName.UNIZIN_DATA_WAREHOUSE, udw_update_datetime)
 
-    if CREATE_CSVS:
-        # Generate CSV output
-        logger.info(f'Writing {num_term_records} term records to CSV')
-        term_df.to_csv(os.path.join(DATA_DIR, 'term.csv'), index=False)
-        logger.info('Wrote data to data/term.csv')
 
-        logger.info(f'Writing {num_account_records} account records to CSV')
-        account_df.to_csv(os.path.join(DATA_DIR, 'account.csv'), index=False)
-        logger.info('Wrote data to data/account.csv')
+def get_pub_course_info_from_db(db_creator_obj: DBCreator) -> pd.DataFrame:
+    # Published dates are kept in their own table, so they survive reloads of course
+    logger.info(f"Getting the stored published dates from {db_creator_obj.db_name} database")
+    course_from_db_df = pd.read_sql(
+        'SELECT canvas_id, published_at, checked_at FROM course_published_date;', db_creator_obj.engine
+    )
+    return course_from_db_df
 
-        logger.info(f'Writing {num_course_records} course records to CSV')
-        course_df.to_csv(os.path.join(DATA_DIR, 'course.csv'), index=False)
-        logger.info('Wrote data to data/course.csv')
 
-        logger.info(f'Writing {num_section_records} course_section records to CSV')
-        section_df.to_csv(os.path.join(DATA_DIR, 'course_section.csv'), index=False)
-        logger.info('Wrote data to data/course_section.csv')
+# Entry point for run_jobs.py
 
-        logger.info(f'Writing {num_enrollment_records} enrollment records to CSV')
-        enrollment_df.to_csv(os.path.join(DATA_DIR, 'enrollment.csv'), index=False)
-        logger.info('Wrote data to data/enrollment.csv')
 
-        logger.info(f"Writing {num_canvas_usage_records} canvas course usage records to CSV")
-        canvas_course_usage_df.to_csv(os.path.join(DATA_DIR, 'canvas_course_usage.csv'), index=False)
-        logger.info('Wrote data to data/canvas_course_usage.csv')
+def run_course_inventory() -> Sequence[DataSourceStatus]:
+    logger.info("* run_course_inventory")
+    # Initialize DBCreator object
+    db_creator_obj = DBCreator(INVENTORY_DB)
 
-    # Empty records from Canvas data tables in database
-    logger.info('Emptying Canvas data tables in DB')
-    db_creator_obj.drop_records(
-        ['account', 'canvas_course_usage', 'course', 'course_section', 'enrollment', 'term']
+    # In record mode, Canvas responses are saved so later runs can replay them without the network
+    fixture_store = None
+    if HTTP_FIXTURE_MODE != 'off':
+        fixture_store = FixtureStore(
+            os.path.join(HTTP_FIXTURE_DIR, 'course_inventory'), HTTP_FIXTURE_MODE, ENV.get('HTTP_FIXTURE_RUN')
+        )
+    canvas_client = CanvasClient(
+        CANVAS_URL, CANVAS_TOKEN, NUM_ASYNC_WORKERS, RATE_LIMIT_THRESHOLD, fixture_store=fixture_store
     )
 
-    # Insert gathered data into DB
-    logger.info(f'Inserting {num_term_records} term records to DB')
-    term_df.to_sql('term', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into term table in {db_creator_obj.db_name}')
-
-    logger.info(f'Inserting {num_account_records} account records to DB')
-    account_df.to_sql('account', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into account table in {db_creator_obj.db_name}')
+    # Results of completed stages (and enrollment pages) are kept until the job finishes, so a
+    # re-run within CHECKPOINT_MAX_AGE_HOURS resumes where a failed run stopped
+    checkpoint_store = None
+    if CHECKPOINT_MAX_AGE_HOURS > 0:
+        checkpoint_store = CheckpointStore(
+            os.path.join(DATA_DIR, 'checkpoints', 'course_inventory'),
+            CHECKPOINT_MAX_AGE_HOURS * 3600,
+            'COURSE_INVENTORY',
+            f'{CANVAS_URL} account {ACCOUNT_ID} terms {sorted(TERM_IDS)}'
+        )
 
-    logger.info(f'Inserting {num_course_records} course records to DB')
-    course_df.to_sql('course', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into course table in {db_creator_obj.db_name}')
+    logger.info('Making requests against the Canvas API')
 
-    logger.info(f'Inserting {num_section_records} section records to DB')
-    section_df.to_sql('course_section', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into section table in {db_creator_obj.db_name}')
+    # Stages that only depend on course data run concurrently, sharing canvas_client's workers
+    # and rate-limit budget; the UDW stages each open (and close) their own UDW connection
+    stage_dag = StageDAG(NUM_STAGE_WORKERS, checkpoint_store)
+    stage_dag.add_stage('terms', lambda: gather_term_data_from_api(ACCOUNT_ID, TERM_IDS, fixture_store))
+    stage_dag.add_stage('courses', lambda: gather_course_data_from_api(ACCOUNT_ID, TERM_IDS, fixture_store))
+    stage_dag.add_stage(
+        'published_dates',
+        lambda course_df: add_published_dates(canvas_client, db_creator_obj, course_df),
+        ['courses']
+    )
+    stage_dag.add_stage(
+        'course_usage',
+        lambda course_df: gather_course_usage_data(canvas_client, db_creator_obj, course_df),
+        ['courses']
+    )
+    stage_dag.add_stage(
+        'accounts',
+        lambda course_df: gather_account_data_from_api(
+            sorted(course_df['account_id'].drop_duplicates().to_list()), fixture_store
+        ),
+        ['courses']
+    )
+    stage_dag.add_stage(
+        'enrollments',
+        lambda course_df: gather_enrollment_data(canvas_client, course_df, checkpoint_store, fixture_store),
+        ['courses']
+    )
+    stage_dag.add_stage(
+        'udw_sections',
+        lambda enrollment_output: run_with_udw_conn(partial(add_sis_section_data, enrollment_output[1])),
+        ['enrollments']
+    )
+    stage_dag.add_stage('udw_metadata', lambda _: run_with_udw_conn(get_udw_data_source), ['udw_sections'])
+
+    try:
+        stage_results = stage_dag.run()
+    finally:
+        canvas_client.close()
+        if fixture_store is not None:
+            fixture_store.close()
+
+    term_df = stage_results['terms']
+    course_df = stage_results['published_dates']
+    canvas_course_usage_df = stage_results['course_usage']
+    account_df = stage_results['accounts']
+    enrollment_df = stage_results['enrollments'][0]
+    section_df = stage_results['udw_sections']
+
+    # Record data source info for Canvas API and UDW
+    canvas_data_source = DataSourceStatus(ValidDataSourceName.CANVAS_API)
+    udw_data_source = stage_results['udw_metadata']
 
-    logger.info(f'Inserting {num_enrollment_records} enrollment records to DB')
-    enrollment_df.to_sql('enrollment', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into enrollment table in {db_creator_obj.db_name}')
+    # Produce output
+    num_term_records = len(term_df)
+    num_account_records = len(account_df)
+    num_course_records = len(course_df)
+    num_section_records = len(section_df)
+    num_enrollment_records = len(enrollment_df)
+    num_canvas_usage_records = len(canvas_course_usage_df)
 
-    logger.info(f"Inserting {num_canvas_usage_records} canvas_course_usage records to DB")
-    canvas_course_usage_df.to_sql('canvas_course_usage', db_creator_obj.engine, if_exists='append', index=False)
-    logger.info(f'Inserted data into canvas_course_usage table in {db_creator_obj.db_name}')
+    snapshot_writer = None
+    if EXPORT_FORMATS:
+        # Snapshots are written in the background while the data is loaded into the DB
+        logger.info(f'Exporting snapshots as {", ".join(EXPORT_FORMATS)}')
+        snapshot_writer = SnapshotWriter(
+            DATA_DIR,
+            EXPORT_FORMATS,
+            EXPORT_COMPRESSION,
+            EXPORT_PARTITION_BY_TERM,
+            course_df.set_index('canvas_id')['term_id']
+        )
+        snapshot_writer.submit('term', term_df)
+        snapshot_writer.submit('account', account_df)
+        snapshot_writer.submit('course', course_df)
+        snapshot_writer.submit('course_section', section_df)
+        snapshot_writer.submit('enrollment', enrollment_df)
+        snapshot_writer.submit('canvas_course_usage', canvas_course_usage_df)
+
+    if DB_LOAD_MODE == 'upsert':
+        course_usage_incremental = is_course_usage_incremental()
+        if not course_usage_incremental:
+            logger.info('Emptying canvas_course_usage table in DB')
+            db_creator_obj.drop_records(['canvas_course_usage'])
+
+        # Parents are upserted first, so new child records can reference them; deleting vanished
+        # parent records cascades to their children before the children are compared
+        load_dfs = [
+            ('term', term_df),
+            ('account', account_df),
+            ('course', course_df),
+            ('course_section', section_df),
+            ('enrollment', enrollment_df)
+        ]
+        for table_name, load_df in load_dfs:
+            logger.info(f'Upserting {len(load_df)} {table_name} records to DB')
+            db_creator_obj.upsert_records(table_name, load_df, ['canvas_id'])
+            logger.info(f'Upserted data into {table_name} table in {db_creator_obj.db_name}')
+
+        # Incremental usage only has the days after each course's latest stored day (less an
+        # overlap), which are upserted by (course_id, date)
+        logger.info(f"Inserting {num_canvas_usage_records} canvas_course_usage records to DB")
+        if course_usage_incremental:
+            load_incremental_course_usage(
+                db_creator_obj,
+                canvas_course_usage_df,
+                get_course_usage_watermarks(db_creator_obj).index,
+                course_df.loc[course_df['workflow_state'] == 'available', 'canvas_id']
+            )
+        else:
+            db_creator_obj.bulk_insert('canvas_course_usage', canvas_course_usage_df)
+        logger.info(f'Inserted data into canvas_course_usage table in {db_creator_obj.db_name}')
+    elif DB_LOAD_MODE == 'staging':
+        # Load into staging tables and publish them together, so readers never see partial data
+        load_dfs = [
+            ('term', term_df),
+            ('account', account_df),
+            ('course', course_df),
+            ('course_section', section_df),
+            ('enrollment', enrollment_df),
+            ('canvas_course_usage', canvas_course_usage_df)
+        ]
+        table_names = [table_name for table_name, _ in load_dfs]
+        logger.info('Creating staging tables for Canvas data tables in DB')
+        db_creator_obj.create_staging_tables(table_names)
+        try:
+            for table_name, load_df in load_dfs:
+                staging_table_name = get_staging_table_name(table_name)
+                logger.info(f'Inserting {len(load_df)} {table_name} records to DB')
+                db_creator_obj.bulk_insert(staging_table_name, load_df)
+                logger.info(f'Inserted data into {staging_table_name} table in {db_creator_obj.db_name}')
+        except Exception:
+            db_creator_obj.drop_staging_tables(table_names)
+            raise
+        db_creator_obj.swap_staging_tables(table_names)
+    else:
+        # Empty records from Canvas data tables in database
+        logger.info('Emptying Canvas data tables in DB')
+        db_creator_obj.drop_records(
+            ['account', 'canvas_course_usage', 'course', 'course_section', 'enrollment', 'term']
+        )
+
+        # Insert gathered data into DB
+        logger.info(f'Inserting {num_term_records} term records to DB')
+        db_creator_obj.bulk_insert('term', term_df)
+        logger.info(f'Inserted data into term table in {db_creator_obj.db_name}')
+
+        logger.info(f'Inserting {num_account_records} account records to DB')
+        db_creator_obj.bulk_insert('account', account_df)
+        logger.info(f'Inserted data into account table in {db_creator_obj.db_name}')
+
+        logger.info(f'Inserting {num_course_records} course records to DB')
+        db_creator_obj.bulk_insert('course', course_df)
+        logger.info(f'Inserted data into course table in {db_creator_obj.db_name}')
+
+        logger.info(f'Inserting {num_section_records} section records to DB')
+        db_creator_obj.bulk_insert('course_section', section_df)
+        logger.info(f'Inserted data into section table in {db_creator_obj.db_name}')
+
+        logger.info(f'Inserting {num_enrollment_records} enrollment records to DB')
+        db_creator_obj.bulk_insert('enrollment', enrollment_df)
+        logger.info(f'Inserted data into enrollment table in {db_creator_obj.db_name}')
+
+        logger.info(f"Inserting {num_canvas_usage_records} canvas_course_usage records to DB")
+        db_creator_obj.bulk_insert('canvas_course_usage', canvas_course_usage_df)
+        logger.info(f'Inserted data into canvas_course_usage table in {db_creator_obj.db_name}')
+
+    if snapshot_writer is not None:
+        snapshot_writer.wait()
+
+    if checkpoint_store is not None:
+        checkpoint_store.clear()
 
     return [canvas_data_source, udw_data_source]
 
@@ -1,100 +1,85 @@
 import logging
 import json
+from datetime import datetime
 from json.decoder import JSONDecodeError
-from requests_futures.sessions import FuturesSession
-from concurrent.futures import as_completed
-from typing import Any, Dict
+from typing import Dict, List, Optional, Sequence, Set
 import pandas as pd
+import requests
+
+from canvas_client.client import CanvasClient
+from canvas_client.retry_scheduler import RetryableResponseError, RetryScheduler
 
 
 logger = logging.getLogger(__name__)
 
+CANVAS_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 
 class FetchPublishedDate:
+    '''
+    Finds when available courses were published, using the published dates and the times of the
+    last completed lookups kept in the course_published_date table (course_data_from_db). Courses
+    with a stored date aren't requested; courses looked up before without a date only have their
+    audit events since that lookup requested, so they usually take one small page.
+    '''
 
     def __init__(
             self,
-            canvas_url: str,
-            canvas_token: str,
-            num_workers: int,
+            canvas_client: CanvasClient,
             course_data_from_api: pd.DataFrame,
             course_data_from_db: pd.DataFrame,
             retry_attempts: int
     ):
-        self.canvas_url: str = canvas_url
-        self.canvas_token: str = canvas_token
+        self.canvas_client: CanvasClient = canvas_client
         self.course_data_from_api: pd.DataFrame = course_data_from_api
         self.course_data_from_db: pd.DataFrame = course_data_from_db
         self.retry_attempts: int = retry_attempts
-        self.num_workers: int = num_workers
+        # Times are stored in UTC, like Canvas's
+        self.checked_at: datetime = datetime.utcnow().replace(microsecond=0)
         self.published_course_date: Dict[int, str] = {}
-        # { course_id: {'url': 'https://instructure.com','count': 0} }
-        self.published_date_retry_bucket: Dict[int, Dict[str, Any]] = {}
+        # Courses whose audit events were all read, or read up to a published event
+        self.checked_course_ids: Set[int] = set()
+        # { course_id: start_time } for courses looked up before
+        self.course_start_times: Dict[int, str] = {}
 
-    def get_next_page_url(self, response) -> None:
+    def get_next_page_url(self, response: requests.Response) -> Optional[str]:
         """
         get the next page url from the Http response headers
         :param response:
-        :type response: requests
+        :type response: requests.Response
         :return: next_page_url
         :rtype: str
         """
         logging.debug(self.get_next_page_url.__name__ + '() called')
-        result = response.result()
-        links = result.links
-        if not links:
-            logging.debug('The api call do not have Link headers')
-            return None
-
-        course_id = int(result.url.split('?')[0].split('/')[-1])
+        links = response.links
+        course_id = int(response.url.split('?')[0].split('/')[-1])
         if 'next' in links:
-            url_ = links['next']['url']
             logger.debug('Fetching the next page URL')
-            # This update or add to the retry bucket
-            self.published_date_retry_bucket[course_id] = {
-                'url': url_,
-                'count': 0,
-            }
-            logger.info(f"Retry list size {len(self.published_date_retry_bucket)} for published_at date")
-        else:
-            if course_id in self.published_date_retry_bucket:
-                logger.info(f"Removing the course {course_id} from the list as course don't have a date {links}")
-                self.published_date_retry_bucket.pop(course_id)
-            else:
-                # This is the case when canvas sends no Date for a course
-                logger.info(f"Course {course_id} don't have published date")
+            return links['next']['url']
 
-    def published_date_resp_parsing(self, response) -> None:
-        if response is None:
-            logger.info(f"Published course date response is None ")
-            return
+        # This is the case when canvas sends no Date for a course
+        logger.debug(f"Course {course_id} don't have published date")
+        self.checked_course_ids.add(course_id)
+        return None
 
-        logger.info(f"published courses date collected so far : {len(self.published_course_date)}")
-        response_result = response.result()
-        url = response_result.url
+    def published_date_resp_parsing(self, response: requests.Response) -> List[str]:
+        logger.debug(f"published courses date collected so far : {len(self.published_course_date)}")
+        url = response.url
         course_id = int(url.split('?')[0].split('/')[-1])
 
-        logger.info(f"Parsing the response for Course: {course_id}")
-        logger.debug(f"Pagination info {course_id} {response_result.links}")
-        logger.info(f"Time taken to get the response for {course_id} : {response_result.elapsed}")
-        status = response_result.status_code
-        published_date_found = False
-        if status != 200:
-            logger.warning(f"Request was unsuccessful for {course_id}")
-            logger.warning(f"Response status: {status}; time taken: {response_result.elapsed}; response text: {response_result.text}")
-            self.retry_logic_with_error(course_id, url)
-            return
+        logger.debug(f"Parsing the response for Course: {course_id}")
+        logger.debug(f"Pagination info {course_id} {response.links}")
+        logger.debug(f"Time taken to get the response for {course_id} : {response.elapsed}")
 
         try:
-            audit_events = json.loads(response_result.text)
+            audit_events = json.loads(response.text)
         except JSONDecodeError as e:
-            logger.error(f"Error in parsing the response {e.msg}")
-            self.retry_logic_with_error(course_id, url)
-            return
+            raise RetryableResponseError(f"Error in parsing the response {e.msg}")
 
         if not audit_events:
-            logger.info(f"Response for fetching published date is empty {audit_events}")
-            return
+            logger.debug(f"Response for fetching published date is empty {audit_events}")
+            self.checked_course_ids.add(course_id)
+            return []
 
         events = audit_events['events']
 
@@ -103,37 +88,14 @@ class FetchPublishedDate:
         for event in events:
             if event['event_type'] == 'published':
                 course_id = event['links']['course']
-                published_date_found = True
                 self.published_course_date.update({course_id: event['created_at']})
-                logger.info(f"Published Date {event['created_at']} for course {course_id}")
-                if course_id in self.published_date_retry_bucket:
-                    logger.info(f"Going to remove {course_id} from retry list {len(self.published_date_retry_bucket)}")
-                    self.published_date_retry_bucket.pop(course_id)
-                    logger.info(f"Removed {course_id} removed from retry list {len(self.published_date_retry_bucket)}")
-                break
-        if not published_date_found:
-            self.get_next_page_url(response)
-
-        return
-
-    def retry_logic_with_error(self, course_id, url) -> None:
-        if course_id in self.published_date_retry_bucket:
-            retry_count = self.published_date_retry_bucket[course_id]['count']
-            if retry_count >= self.retry_attempts:
-                # Don't want to retry more
-                logger.info(f"Reached max retry attempts for {course_id} with count {retry_count}, Removing... ")
-                self.published_date_retry_bucket.pop(course_id)
-            else:
-                # We will give one more chance to retry
-                logger.info(f"Another retry attempt will be made for {course_id}")
-                self.published_date_retry_bucket[course_id]['count'] += 1
-        else:
-            logger.info(f"Adding course {course_id} to retry bucket")
-            self.published_date_retry_bucket[course_id] = {
-                'url': url,
-                'count': 1,
-            }
-        logger.info(f"Retry list size {len(self.published_date_retry_bucket)} for published_at date")
+                self.checked_course_ids.add(course_id)
+                logger.debug(f"Published Date {event['created_at']} for course {course_id}")
+                return []
+
+        # The next page goes out as soon as this one is parsed
+        next_page_url = self.get_next_page_url(response)
+        return [next_page_url] if next_page_url is not None else []
 
     def filter_courses_to_fetch_published_date(self) -> pd.DataFrame:
         logger.info(f"Size of courses data from API routine: {self.course_data_from_api.shape}")
@@ -148,30 +110,23 @@ class FetchPublishedDate:
         logger.info(f"Size of course data after merging with DB data: {course_with_pub_date_added_from_df.shape}")
         return course_with_pub_date_added_from_df
 
-    def get_published_course_date(self, course_ids, retry_list: Dict[int, str] = None) -> None:
+    def get_published_course_date(self, course_ids: Sequence[int]) -> None:
         logger.info("Starting of get_published_course_date from API call")
-
-        with FuturesSession(max_workers=self.num_workers) as future_session:
-            headers = {'Content-type': 'application/json', 'Authorization': 'Bearer ' + self.canvas_token}
-            if retry_list is not None:
-                logger.info("Going through error and pagination list")
-                responses = [future_session.get(retry_list[course]['url'], headers=headers)
-                             for course in retry_list]
-            else:
-                logger.info("Initial Round of Fetching course published date")
-                responses = [
-                    future_session.get(f'{self.canvas_url}/api/v1/audit/course/courses/{course_id}?per_page=100',
-                                       headers=headers)
-                    for course_id in course_ids
-                ]
-
-            for response in as_completed(responses):
-                self.published_date_resp_parsing(response)
-
-        if len(self.published_date_retry_bucket) != 0:
-            logger.info(f"""Retrying now with list size {len(self.published_date_retry_bucket)} 
-                        {self.published_date_retry_bucket}""")
-            self.get_published_course_date(course_ids, self.published_date_retry_bucket)
+        retry_scheduler = RetryScheduler(self.canvas_client, self.retry_attempts)
+        retry_scheduler.add_stream(
+            (
+                (
+                    f'/api/v1/audit/course/courses/{course_id}?per_page=100',
+                    {'start_time': self.course_start_times[course_id]}
+                    if course_id in self.course_start_times else None
+                )
+                for course_id in course_ids
+            ),
+            self.published_date_resp_parsing
+        )
+        failed_requests = retry_scheduler.run()
+        if failed_requests:
+            logger.warning(f"Published dates could not be fetched for {len(failed_requests)} course(s)")
 
     def get_published_date(self) -> pd.DataFrame:
         logger.info("Getting into fetching published date routine")
@@ -184,6 +139,13 @@ class FetchPublishedDate:
             (courses_with_pub_date_col_df['published_at'].isnull())].copy(deep=True)
         course_avail_with_no_pub_date_list = course_avail_with_no_pub_date_df['canvas_id'].to_list()
         logger.info(f"Published dates going to be fetched are: {len(course_avail_with_no_pub_date_list)}")
+        checked_before_df = course_avail_with_no_pub_date_df.loc[
+            course_avail_with_no_pub_date_df['checked_at'].notnull()]
+        self.course_start_times = dict(zip(
+            checked_before_df['canvas_id'],
+            pd.to_datetime(checked_before_df['checked_at']).dt.strftime(CANVAS_DATETIME_FORMAT)
+        ))
+        logger.info(f"Courses only needing audit events since their last lookup: {len(self.course_start_times)}")
         if len(course_avail_with_no_pub_date_list) == 0:
             courses_with_pub_date_col_df = courses_with_pub_date_col_df[['canvas_id', 'published_at']]
             logger.info("No more published date to fetch than what is stored in DB")
@@ -214,3 +176,20 @@ class FetchPublishedDate:
             f"There are now {published_date_in_db[0] + len(self.published_course_date)} published dates")
         courses_with_pub_date_col_df = courses_with_pub_date_col_df[['canvas_id', 'published_at']]
         return courses_with_pub_date_col_df
+
+    def get_published_date_updates(self) -> pd.DataFrame:
+        '''
+        Returns records for the course_published_date table for the courses whose lookups
+        completed, with the date found (if any) and the time the lookups started.
+        '''
+        checked_course_ids = sorted(self.checked_course_ids)
+        published_date_updates_df = pd.DataFrame({
+            'canvas_id': checked_course_ids,
+            'published_at': pd.to_datetime(
+                [self.published_course_date.get(course_id) for course_id in checked_course_ids],
+                format=CANVAS_DATETIME_FORMAT,
+                errors='coerce'
+            ),
+            'checked_at': self.checked_at
+        })
+        return published_date_updates_df
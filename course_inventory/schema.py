@@ -0,0 +1,80 @@
+'''
+Compact dtypes for the DataFrames COURSE_INVENTORY loads into each table. IDs are int64, since
+Canvas doesn't bound them to 32 bits (e.g. IDs of objects on other shards are over 2^31); only
+counts are int32. Repeated strings (states and role types) are categoricals, and dates and times
+are datetime64. Free-text strings such as names, which are nearly all distinct, stay as objects.
+'''
+
+# standard libraries
+from typing import Dict
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+
+
+TABLE_DTYPES: Dict[str, Dict[str, str]] = {
+    'term': {
+        'canvas_id': 'int64',
+        'name': 'object',
+        'sis_id': 'int64',
+        'start_at': 'datetime64[ns]',
+        'end_at': 'datetime64[ns]'
+    },
+    'account': {
+        'canvas_id': 'int64',
+        'name': 'object',
+        'sis_id': 'object'
+    },
+    'course': {
+        'canvas_id': 'int64',
+        'sis_id': 'object',
+        'name': 'object',
+        'account_id': 'int64',
+        'term_id': 'int64',
+        'created_at': 'datetime64[ns]',
+        'published_at': 'datetime64[ns]',
+        'workflow_state': 'category',
+        # Not stored; used to schedule enrollment requests, then dropped
+        'total_students': 'int32'
+    },
+    'course_section': {
+        'canvas_id': 'int64',
+        'name': 'object',
+        'sis_id': 'object'
+    },
+    'enrollment': {
+        'canvas_id': 'int64',
+        'user_id': 'int64',
+        'course_id': 'int64',
+        'course_section_id': 'int64',
+        'role_type': 'category',
+        'workflow_state': 'category'
+    },
+    'canvas_course_usage': {
+        'course_id': 'int64',
+        'views': 'int32',
+        'participations': 'int32',
+        'date': 'datetime64[ns]'
+    }
+}
+
+
+def apply_schema(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    '''
+    Casts the columns of df that the table's schema lists to their compact dtypes; other columns
+    are left alone, and columns already of the right dtype aren't copied. Raises a ValueError if
+    integer values don't fit their dtype, rather than letting them wrap around.
+    '''
+    dtypes = {
+        column: dtype for column, dtype in TABLE_DTYPES[table_name].items()
+        if column in df.columns and df[column].dtype != dtype
+    }
+    for column, dtype in dtypes.items():
+        if dtype.startswith('int') and pd.api.types.is_numeric_dtype(df[column]) and len(df[column]) > 0:
+            int_info = np.iinfo(dtype)
+            if df[column].min() < int_info.min or df[column].max() > int_info.max:
+                raise ValueError(f'Values in {table_name}.{column} do not fit in {dtype}')
+    if not dtypes:
+        return df
+    return df.astype(dtypes, copy=False)
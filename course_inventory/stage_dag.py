@@ -0,0 +1,157 @@
+# This is needed for type hinting with fluent interfaces
+from __future__ import annotations
+
+# standard libraries
+import contextvars, logging, time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from course_inventory.checkpoints import CheckpointStore
+from instrumentation.spans import record, span
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageDAG:
+    '''
+    Runs the stages of a job as a dependency graph: each stage starts as soon as the stages it
+    depends on have finished, with up to max_workers stages running at once. A stage's function is
+    called with the results of its dependencies, in the order they were listed. Stages doing
+    Canvas requests should share one CanvasClient, so together they stay within its worker pool
+    and rate-limit budget. With a checkpoint_store, each stage's result is saved when it finishes,
+    and stages with a saved result are loaded instead of run.
+    '''
+
+    def __init__(self, max_workers: int = 1, checkpoint_store: Optional[CheckpointStore] = None) -> None:
+        self.max_workers: int = max_workers
+        self.checkpoint_store: Optional[CheckpointStore] = checkpoint_store
+        self.stages: Dict[str, Tuple[Callable[..., Any], Tuple[str, ...]]] = {}
+        self.results: Dict[str, Any] = {}
+        self.timings: Dict[str, Tuple[float, float]] = {}
+        self.started_at: float = 0.0
+        self.finished_at: float = 0.0
+
+    def add_stage(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        dependencies: Sequence[str] = ()
+    ) -> StageDAG:
+        '''
+        Adds a stage; dependencies must already have been added, which keeps the graph acyclic.
+        '''
+        if name in self.stages:
+            raise ValueError(f'Stage {name} was already added')
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+        self.stages[name] = (func, tuple(dependencies))
+        return self
+
+    def run_stage(self, name: str) -> Any:
+        func, dependencies = self.stages[name]
+        start = time.time()
+        with span(name):
+            if self.checkpoint_store is not None and self.checkpoint_store.has(name):
+                logger.info(f'Loading stage {name} from checkpoint')
+                result = self.checkpoint_store.load(name)
+            else:
+                logger.info(f'Starting stage {name}')
+                result = func(*[self.results[dependency] for dependency in dependencies])
+                if self.checkpoint_store is not None:
+                    self.checkpoint_store.save(name, result)
+            record(rows=count_rows(result))
+        self.timings[name] = (start, time.time())
+        logger.info(f'Finished stage {name} in {self.timings[name][1] - start:.1f} seconds')
+        return result
+
+    def run(self) -> Dict[str, Any]:
+        '''
+        Runs all the stages and returns their results by stage name. If a stage raises an
+        exception, no more stages are started, and the exception is raised once the running
+        stages have finished.
+        '''
+        self.started_at = time.time()
+        pending_names = list(self.stages)
+        in_flight: Dict[Future, str] = {}
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending_names or in_flight:
+                # Stages are started in the order they were added, once their dependencies are done;
+                # only as many are submitted as there are free workers, so none wait in the queue
+                for name in list(pending_names):
+                    if len(in_flight) >= self.max_workers:
+                        break
+                    if all(dependency in self.results for dependency in self.stages[name][1]):
+                        pending_names.remove(name)
+                        stage_future = executor.submit(contextvars.copy_context().run, self.run_stage, name)
+                        in_flight[stage_future] = name
+
+                completed_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for completed_future in completed_futures:
+                    name = in_flight.pop(completed_future)
+                    self.results[name] = completed_future.result()
+        except BaseException:
+            # Stages that haven't started are cancelled; running ones can't be, so they're waited for
+            for stage_future in in_flight:
+                stage_future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+        self.finished_at = time.time()
+        self.log_summary()
+        return self.results
+
+    def get_critical_path(self) -> Tuple[List[str], float]:
+        '''
+        Returns the chain of dependent stages with the longest total duration, and that duration;
+        the job can't finish faster than this, however many stages run at once.
+        '''
+        path_durations: Dict[str, float] = {}
+        path_predecessors: Dict[str, str] = {}
+        # Stages were added after their dependencies, so this order is topological
+        for name, (_, dependencies) in self.stages.items():
+            start, finish = self.timings[name]
+            longest_dependency = max(dependencies, key=lambda dependency: path_durations[dependency], default=None)
+            path_durations[name] = finish - start
+            if longest_dependency is not None:
+                path_durations[name] += path_durations[longest_dependency]
+                path_predecessors[name] = longest_dependency
+
+        if not path_durations:
+            return ([], 0.0)
+        name = max(path_durations, key=lambda stage_name: path_durations[stage_name])
+        duration = path_durations[name]
+        path = [name]
+        while name in path_predecessors:
+            name = path_predecessors[name]
+            path.insert(0, name)
+        return (path, duration)
+
+    def log_summary(self) -> None:
+        for name, (start, finish) in self.timings.items():
+            logger.info(
+                f'Stage {name}: started at +{start - self.started_at:.1f}s, '
+                f'took {finish - start:.1f}s'
+            )
+        critical_path, critical_duration = self.get_critical_path()
+        logger.info(f'Total stage wall time (seconds): {self.finished_at - self.started_at:.1f}')
+        logger.info(f'Critical path ({critical_duration:.1f} seconds): {" -> ".join(critical_path)}')
+
+
+def count_rows(result: Any) -> int:
+    '''
+    Counts the rows in a stage result that is a DataFrame or a sequence of DataFrames.
+    '''
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (list, tuple)):
+        return sum(len(item) for item in result if isinstance(item, pd.DataFrame))
+    return 0
@@ -0,0 +1,102 @@
+# standard libraries
+import logging
+from typing import Any, Sequence, Tuple, Union
+
+# third-party libraries
+import pandas as pd
+from psycopg2.extensions import connection
+
+# local libraries
+from course_inventory.schema import apply_schema
+
+
+logger = logging.getLogger(__name__)
+
+UDW_FETCH_SIZE = 10000
+
+
+def stream_udw_query(
+    conn: connection,
+    query: str,
+    params: Union[Tuple[Any, ...], None],
+    columns: Sequence[str]
+) -> pd.DataFrame:
+    '''
+    Runs a query with a server-side (named) cursor, building the DataFrame from batches of
+    UDW_FETCH_SIZE rows rather than holding the whole result on the client at once.
+    '''
+    chunk_dfs = []
+    with conn.cursor(name='udw_stream_cursor') as cursor:
+        cursor.itersize = UDW_FETCH_SIZE
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(UDW_FETCH_SIZE)
+            if not rows:
+                break
+            chunk_dfs.append(pd.DataFrame.from_records(rows, columns=columns))
+    if not chunk_dfs:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunk_dfs, ignore_index=True)
+
+
+class UDWEnrollGatherer:
+    '''
+    Gathers enrollments and their course sections for many courses from the Unizin Data Warehouse
+    in one set-based query, instead of paging through each course with GraphQL. Output has the
+    same shape as AsyncEnrollGatherer's, but is only as fresh as the UDW's canvasdatadate.
+    Deleted enrollments are excluded, as they are by GraphQL's enrollmentsConnection.
+    '''
+
+    enrollment_query = '''
+        SELECT e.canvas_id AS canvas_id,
+               u.canvas_id AS user_id,
+               c.canvas_id AS course_id,
+               cs.canvas_id AS course_section_id,
+               e.type AS role_type,
+               e.workflow_state AS workflow_state,
+               cs.name AS course_section_name
+        FROM enrollment_dim e
+        JOIN course_dim c ON c.id = e.course_id
+        JOIN user_dim u ON u.id = e.user_id
+        JOIN course_section_dim cs ON cs.id = e.course_section_id
+        WHERE c.canvas_id = ANY(%s)
+            AND e.workflow_state <> 'deleted';
+    '''
+
+    def __init__(self, course_ids: Sequence[int], udw_conn: connection):
+        self.course_ids: Sequence[int] = course_ids
+        self.udw_conn: connection = udw_conn
+        self.udw_enrollment_df: pd.DataFrame = pd.DataFrame()
+
+    def gather(self) -> None:
+        logger.info('** UDWEnrollGatherer')
+        logger.info('Gathering enrollment data for courses from UDW')
+        # The course IDs are sent as a single array parameter rather than a literal IN list
+        self.udw_enrollment_df = stream_udw_query(
+            self.udw_conn,
+            self.enrollment_query,
+            ([int(course_id) for course_id in self.course_ids],),
+            [
+                'canvas_id', 'user_id', 'course_id', 'course_section_id',
+                'role_type', 'workflow_state', 'course_section_name'
+            ]
+        )
+        logger.info(f'Gathered {len(self.udw_enrollment_df)} enrollment records from UDW')
+
+    def generate_output(self) -> Tuple[pd.DataFrame, ...]:
+        logger.debug('generate_output')
+        enrollment_columns = ['canvas_id', 'user_id', 'course_id', 'course_section_id', 'role_type', 'workflow_state']
+        enrollment_df = apply_schema(
+            self.udw_enrollment_df[enrollment_columns]
+            .drop_duplicates(subset=['canvas_id'], keep='last')
+            .reset_index(drop=True),
+            'enrollment'
+        )
+        section_df = apply_schema(
+            self.udw_enrollment_df[['course_section_id', 'course_section_name']]
+            .rename(columns={'course_section_id': 'canvas_id', 'course_section_name': 'name'})
+            .drop_duplicates(subset=['canvas_id'], keep='last')
+            .reset_index(drop=True),
+            'course_section'
+        )
+        return (enrollment_df, section_df)
@@ -2,12 +2,16 @@
 from __future__ import annotations
 
 # standard libraries
-import logging, os
-from typing import Dict, List, Sequence, Union
+import logging, os, re, tempfile
+from datetime import date, datetime
+from typing import Any, Dict, List, Sequence, TextIO, Tuple, Union
 from urllib.parse import quote_plus
 
 # third-party libraries
-from sqlalchemy.engine import create_engine, Engine
+import numpy as np
+import pandas as pd
+from sqlalchemy.engine import Connection, create_engine, Engine
+from sqlalchemy.exc import OperationalError
 from yoyo import get_backend, read_migrations
 
 
@@ -18,12 +22,23 @@ logger = logging.getLogger(__name__)
 PARENT_PATH = os.path.dirname(os.path.abspath(__file__))
 MIGRATIONS_PATH = os.path.join(PARENT_PATH, 'migrations')
 
+# MySQL error codes meaning LOAD DATA LOCAL INFILE is disabled on the server or client
+LOCAL_INFILE_DISABLED_CODES = (1148, 2068, 3948)
+
+
+class LoadDataError(Exception):
+    '''
+    Raised when LOAD DATA LOCAL INFILE loads fewer rows than it was given or reports warnings,
+    since it skips duplicate keys and stores invalid values (e.g. truncated) instead of failing.
+    '''
+
 
 class DBCreator:
     '''
     Utility class for managing the application's database. Leverages SQLAlchemy
-    and yoyo-migrations. The migrate, drop_records, and reset_database methods can be
-    used fluently, i.e. with method chaining (see reset_database for an example).
+    and yoyo-migrations. The migrate, drop_records, reset_database, bulk_insert, upsert_records,
+    create_staging_tables, and swap_staging_tables methods can be used fluently, i.e. with
+    method chaining (see reset_database for an example).
     '''
 
     def __init__(self, db_params: Dict[str, str]) -> None:
@@ -40,7 +55,9 @@ class DBCreator:
             f":{db_params['port']}" +
             f"/{db_params['dbname']}?charset=utf8&ssl=true"
         )
-        self.engine: Engine = create_engine(self.conn_str)
+        # local_infile lets bulk_insert use LOAD DATA LOCAL INFILE, if the server allows it
+        self.engine: Engine = create_engine(self.conn_str, connect_args={'local_infile': 1})
+        self.local_infile_enabled: bool = True
 
     def get_table_names(self) -> List[str]:
         '''
@@ -112,3 +129,335 @@ class DBCreator:
         for row in rs:
             pk_values.append(row[0])
         return pk_values
+
+    def diff_records(
+        self,
+        table_name: str,
+        new_df: pd.DataFrame,
+        key_columns: Sequence[str]
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        '''
+        Compares a DataFrame with the current contents of a table by primary key. Returns the rows
+        of new_df that are new or changed, and the keys of table rows that are not in new_df.
+        '''
+        columns = list(new_df.columns)
+        current_df = pd.read_sql(f'SELECT {", ".join(columns)} FROM {table_name};', self.engine)
+
+        new_norm_df = normalize_for_comparison(new_df)
+        current_norm_df = normalize_for_comparison(current_df)
+        merged_df = new_norm_df.merge(
+            current_norm_df, on=list(key_columns), how='outer', suffixes=('', '_current'), indicator=True
+        )
+
+        vanished_key_df = merged_df.loc[merged_df['_merge'] == 'right_only', list(key_columns)]
+        changed_mask = merged_df['_merge'] == 'left_only'
+        for column in columns:
+            if column not in key_columns:
+                changed_mask |= merged_df[column] != merged_df[f'{column}_current']
+        changed_key_df = merged_df.loc[changed_mask & (merged_df['_merge'] != 'right_only'), list(key_columns)]
+
+        changed_df = new_df[
+            new_norm_df.set_index(list(key_columns)).index.isin(
+                changed_key_df.set_index(list(key_columns)).index
+            )
+        ]
+        return (changed_df, vanished_key_df)
+
+    def upsert_records(
+        self,
+        table_name: str,
+        new_df: pd.DataFrame,
+        key_columns: Sequence[str],
+        batch_size: int = 5000
+    ) -> DBCreator:
+        '''
+        Makes a table match new_df by primary key, writing only what changed: rows whose keys
+        vanished are deleted, and new and changed rows are written with bulk_insert (updating
+        existing keys), both in transactions of batch_size rows, so no transaction holds locks on
+        a whole large table.
+        '''
+        logger.debug('upsert_records')
+        changed_df, vanished_key_df = self.diff_records(table_name, new_df, key_columns)
+        logger.info(
+            f'{table_name}: {len(changed_df)} new or changed and {len(vanished_key_df)} vanished record(s) '
+            f'out of {len(new_df)}'
+        )
+        self.delete_keys(table_name, vanished_key_df, batch_size)
+        for batch_start in range(0, len(changed_df), batch_size):
+            self.bulk_insert(table_name, changed_df.iloc[batch_start:batch_start + batch_size], on_duplicate='update')
+        logger.info(f'Upserted {len(changed_df)} record(s) in {table_name} in {self.db_name}')
+        return self
+
+    def bulk_insert(
+        self,
+        table_name: str,
+        df: pd.DataFrame,
+        on_duplicate: Union[str, None] = None,
+        chunk_size: int = 1000
+    ) -> DBCreator:
+        '''
+        Appends the rows of a DataFrame (using its columns, not its index) to a table in one
+        transaction. The rows are streamed to a temporary file and loaded with LOAD DATA LOCAL
+        INFILE; if the server or client doesn't allow that, multi-row INSERT statements of
+        chunk_size rows are used instead. on_duplicate can be None, "ignore" (keep existing rows),
+        or "update" (overwrite existing rows). LOAD DATA LOCAL skips rows with duplicate keys and
+        turns invalid values into warnings, so unless on_duplicate is "ignore", a load that doesn't
+        add every row, or has any warnings, raises a LoadDataError and is rolled back.
+        '''
+        logger.debug('bulk_insert')
+        if on_duplicate not in (None, 'ignore', 'update'):
+            raise ValueError(f'Invalid on_duplicate value: {on_duplicate}')
+        if df.empty:
+            return self
+
+        if self.local_infile_enabled:
+            try:
+                with self.engine.begin() as conn:
+                    self.load_data_infile(conn, table_name, df, on_duplicate)
+                logger.debug(f'Loaded {len(df)} record(s) into {table_name} with LOAD DATA LOCAL INFILE')
+                return self
+            except OperationalError as error:
+                if error.orig.args[0] not in LOCAL_INFILE_DISABLED_CODES:
+                    raise
+                logger.warning(f'LOAD DATA LOCAL INFILE is not allowed; using INSERT statements instead: {error.orig}')
+                self.local_infile_enabled = False
+
+        with self.engine.begin() as conn:
+            insert_values(conn, table_name, df, on_duplicate, chunk_size)
+        logger.debug(f'Inserted {len(df)} record(s) into {table_name} with multi-row INSERT statements')
+        return self
+
+    def load_data_infile(
+        self,
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame,
+        on_duplicate: Union[str, None]
+    ) -> None:
+        columns = list(df.columns)
+        with tempfile.NamedTemporaryFile(
+            'w', suffix='.tsv', encoding='utf-8', newline='\n', delete=False
+        ) as load_file:
+            write_load_file(df, load_file)
+        try:
+            # LOAD DATA can only ignore or replace (delete and re-insert, which would cascade to
+            # child tables) duplicates, so updates go through a temporary table
+            load_table_name = f'{table_name}_load' if on_duplicate == 'update' else table_name
+            if on_duplicate == 'update':
+                conn.execute(f'DROP TEMPORARY TABLE IF EXISTS {load_table_name};')
+                conn.execute(f'CREATE TEMPORARY TABLE {load_table_name} LIKE {table_name};')
+            load_result = conn.execute(
+                f'LOAD DATA LOCAL INFILE %s {"IGNORE " if on_duplicate == "ignore" else ""}'
+                f'INTO TABLE {load_table_name} CHARACTER SET utf8mb4 ({", ".join(columns)});',
+                (load_file.name,)
+            )
+            if on_duplicate != 'ignore':
+                # Updates are loaded into an empty table, so every row should be added there too
+                load_warnings = conn.execute('SHOW WARNINGS;').fetchall()
+                if load_result.rowcount != len(df) or load_warnings:
+                    raise LoadDataError(
+                        f'LOAD DATA LOCAL INFILE added {load_result.rowcount} of {len(df)} record(s) to '
+                        f'{load_table_name} with {len(load_warnings)} warning(s): {load_warnings[:5]}'
+                    )
+            if on_duplicate == 'update':
+                conn.execute(
+                    f'INSERT INTO {table_name} ({", ".join(columns)}) '
+                    f'SELECT {", ".join(columns)} FROM {load_table_name} '
+                    f'ON DUPLICATE KEY UPDATE {make_update_clause(columns)};'
+                )
+                conn.execute(f'DROP TEMPORARY TABLE {load_table_name};')
+        finally:
+            os.remove(load_file.name)
+
+    def delete_keys(self, table_name: str, key_df: pd.DataFrame, batch_size: int = 5000) -> DBCreator:
+        '''
+        Deletes the rows whose key values are in key_df, in batched transactions.
+        '''
+        key_columns = list(key_df.columns)
+        rows = df_to_rows(key_df)
+        row_placeholder = f'({", ".join(["%s"] * len(key_columns))})'
+        for batch_start in range(0, len(rows), batch_size):
+            batch = rows[batch_start:batch_start + batch_size]
+            delete_statement = (
+                f'DELETE FROM {table_name} WHERE ({", ".join(key_columns)}) IN '
+                f'({", ".join([row_placeholder] * len(batch))});'
+            )
+            with self.engine.begin() as conn:
+                execute_flat(conn, delete_statement, batch)
+        logger.info(f'Deleted {len(rows)} record(s) in {table_name} in {self.db_name}')
+        return self
+
+    def create_staging_tables(self, table_names: Sequence[str]) -> DBCreator:
+        '''
+        Creates an empty staging table for each of the tables, using the live table's DDL. Foreign
+        keys between the tables reference the other staging tables, so the group can be swapped in
+        together; constraint names are toggled between a plain and a "_stg" form, since they must
+        be unique across the database.
+        '''
+        logger.debug('create_staging_tables')
+        conn = self.engine.connect()
+        conn.execute('SET FOREIGN_KEY_CHECKS=0;')
+        for table_name in table_names:
+            staging_table_name = get_staging_table_name(table_name)
+            create_statement = conn.execute(f'SHOW CREATE TABLE {table_name};').fetchone()[1]
+            conn.execute(f'DROP TABLE IF EXISTS {staging_table_name};')
+            conn.execute(make_staging_ddl(create_statement, table_names))
+            logger.info(f'Created {staging_table_name} in {self.db_name}')
+        conn.execute('SET FOREIGN_KEY_CHECKS=1;')
+        conn.close()
+        return self
+
+    def swap_staging_tables(self, table_names: Sequence[str]) -> DBCreator:
+        '''
+        Publishes the staging tables created by create_staging_tables with one atomic RENAME TABLE,
+        so readers see either the previous data or the new data in every table; the previous
+        tables are then dropped.
+        '''
+        logger.debug('swap_staging_tables')
+        old_table_names = [f'{table_name}_old' for table_name in table_names]
+        renames = []
+        for table_name, old_table_name in zip(table_names, old_table_names):
+            renames.append(f'{table_name} TO {old_table_name}')
+            renames.append(f'{get_staging_table_name(table_name)} TO {table_name}')
+
+        conn = self.engine.connect()
+        conn.execute('SET FOREIGN_KEY_CHECKS=0;')
+        for old_table_name in old_table_names:
+            conn.execute(f'DROP TABLE IF EXISTS {old_table_name};')
+        conn.execute(f'RENAME TABLE {", ".join(renames)};')
+        logger.info(f'Swapped staging tables into {", ".join(table_names)} in {self.db_name}')
+        for old_table_name in old_table_names:
+            conn.execute(f'DROP TABLE {old_table_name};')
+        conn.execute('SET FOREIGN_KEY_CHECKS=1;')
+        conn.close()
+        return self
+
+    def drop_staging_tables(self, table_names: Sequence[str]) -> DBCreator:
+        '''
+        Drops any staging tables left for the tables, e.g. after a failed load.
+        '''
+        logger.debug('drop_staging_tables')
+        conn = self.engine.connect()
+        conn.execute('SET FOREIGN_KEY_CHECKS=0;')
+        for table_name in table_names:
+            conn.execute(f'DROP TABLE IF EXISTS {get_staging_table_name(table_name)};')
+        conn.execute('SET FOREIGN_KEY_CHECKS=1;')
+        conn.close()
+        return self
+
+
+def get_staging_table_name(table_name: str) -> str:
+    return f'{table_name}_staging'
+
+
+def make_staging_ddl(create_statement: str, table_names: Sequence[str]) -> str:
+    '''
+    Rewrites a SHOW CREATE TABLE statement for the table's staging table.
+    '''
+    def toggle_constraint_name(match: re.Match) -> str:
+        name = match.group(1)
+        new_name = name[:-len('_stg')] if name.endswith('_stg') else f'{name}_stg'
+        return f'CONSTRAINT `{new_name}`'
+
+    def reference_staging_table(match: re.Match) -> str:
+        name = match.group(1)
+        return f'REFERENCES `{get_staging_table_name(name) if name in table_names else name}`'
+
+    ddl = re.sub(
+        r'^CREATE TABLE `([^`]+)`',
+        lambda match: f'CREATE TABLE `{get_staging_table_name(match.group(1))}`',
+        create_statement
+    )
+    ddl = re.sub(r'CONSTRAINT `([^`]+)`', toggle_constraint_name, ddl)
+    ddl = re.sub(r'REFERENCES `([^`]+)`', reference_staging_table, ddl)
+    return re.sub(r' AUTO_INCREMENT=\d+', '', ddl)
+
+
+def df_to_rows(df: pd.DataFrame) -> List[Tuple[Any, ...]]:
+    '''
+    Converts a DataFrame to tuples of values the MySQL driver accepts (nulls as None, no NumPy types).
+    '''
+    object_df = df.astype(object).where(df.notna(), None)
+    return [
+        tuple(
+            value.to_pydatetime() if isinstance(value, pd.Timestamp)
+            else value.item() if isinstance(value, np.generic) else value
+            for value in row
+        )
+        for row in object_df.itertuples(index=False, name=None)
+    ]
+
+
+def insert_values(
+    conn: Connection,
+    table_name: str,
+    df: pd.DataFrame,
+    on_duplicate: Union[str, None],
+    chunk_size: int
+) -> None:
+    columns = list(df.columns)
+    row_placeholder = f'({", ".join(["%s"] * len(columns))})'
+    if on_duplicate == 'update':
+        update_clause = f' ON DUPLICATE KEY UPDATE {make_update_clause(columns)}'
+    elif on_duplicate == 'ignore':
+        # Unlike INSERT IGNORE, this doesn't also turn other errors into warnings
+        update_clause = f' ON DUPLICATE KEY UPDATE {columns[0]}={columns[0]}'
+    else:
+        update_clause = ''
+    for chunk_start in range(0, len(df), chunk_size):
+        rows = df_to_rows(df.iloc[chunk_start:chunk_start + chunk_size])
+        insert_statement = (
+            f'INSERT INTO {table_name} ({", ".join(columns)}) '
+            f'VALUES {", ".join([row_placeholder] * len(rows))}{update_clause};'
+        )
+        execute_flat(conn, insert_statement, rows)
+
+
+def make_update_clause(columns: Sequence[str]) -> str:
+    return ', '.join(f'{column}=VALUES({column})' for column in columns)
+
+
+def write_load_file(df: pd.DataFrame, load_file: TextIO, chunk_size: int = 10000) -> None:
+    '''
+    Writes rows in the format LOAD DATA expects by default: tab-separated fields, newline-terminated
+    lines, \\N for NULL, and backslash escapes. Time zone-aware datetimes are written in UTC.
+    '''
+    def format_value(value: Any) -> str:
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = pd.Timestamp(value).tz_convert(None).to_pydatetime()
+            return value.isoformat(sep=' ')
+        return (
+            str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r')
+        )
+
+    for chunk_start in range(0, len(df), chunk_size):
+        for row in df_to_rows(df.iloc[chunk_start:chunk_start + chunk_size]):
+            load_file.write('\t'.join(format_value(value) for value in row) + '\n')
+
+
+def execute_flat(conn: Connection, statement: str, rows: Sequence[Tuple[Any, ...]]) -> None:
+    conn.execute(statement, [value for row in rows for value in row])
+
+
+def normalize_for_comparison(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Converts values to strings so values read from the database compare equal to gathered ones
+    (e.g. 12 and 12.0, or a Timestamp and the matching DATETIME); nulls become empty strings.
+    '''
+    def normalize_value(value: Any) -> str:
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return ''
+        if isinstance(value, (float, np.floating)) and float(value).is_integer():
+            return str(int(value))
+        if isinstance(value, (date, pd.Timestamp)):
+            value = pd.Timestamp(value)
+            return value.tz_localize(None).isoformat() if value.tzinfo else value.isoformat()
+        return str(value)
+
+    return df.astype(object).apply(lambda column: column.map(normalize_value))
@@ -0,0 +1,27 @@
+#
+# file: migrations/0024.add_job_run_stage.py
+#
+from yoyo import step
+
+__depends__ = {'0023.relax_course_name'}
+
+step('''
+    CREATE TABLE IF NOT EXISTS job_run_stage
+    (
+        id INTEGER NOT NULL UNIQUE AUTO_INCREMENT,
+        job_run_id INTEGER NOT NULL,
+        stage_name VARCHAR(255) NOT NULL,
+        started_at DATETIME NOT NULL,
+        finished_at DATETIME NOT NULL,
+        wall_seconds DOUBLE NOT NULL,
+        cpu_seconds DOUBLE NOT NULL,
+        rows_produced BIGINT NOT NULL,
+        num_requests INTEGER NOT NULL,
+        num_retries INTEGER NOT NULL,
+        bytes_received BIGINT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY (job_run_id) REFERENCES job_run(id) ON DELETE CASCADE ON UPDATE CASCADE
+    )
+    ENGINE=InnoDB
+    CHARACTER SET utf8mb4;
+''')
@@ -0,0 +1,26 @@
+#
+# file: migrations/0025.add_course_published_date.py
+#
+from yoyo import step
+
+__depends__ = {'0024.add_job_run_stage'}
+
+steps = [
+    step('''
+        CREATE TABLE IF NOT EXISTS course_published_date
+        (
+            canvas_id INTEGER NOT NULL,
+            published_at DATETIME NULL,
+            checked_at DATETIME NOT NULL,
+            PRIMARY KEY (canvas_id)
+        )
+        ENGINE=InnoDB
+        CHARACTER SET utf8mb4;
+    '''),
+    # Keep the published dates already found
+    step('''
+        INSERT IGNORE INTO course_published_date (canvas_id, published_at, checked_at)
+        SELECT canvas_id, published_at, UTC_TIMESTAMP() FROM course
+        WHERE published_at IS NOT NULL;
+    ''')
+]
@@ -0,0 +1,19 @@
+#
+# file: migrations/0026.add_course_usage_unique_key.py
+#
+from yoyo import step
+
+__depends__ = {'0025.add_course_published_date'}
+
+steps = [
+    # Keep the latest record of any duplicated day
+    step('''
+        DELETE older FROM canvas_course_usage older
+        JOIN canvas_course_usage newer
+            ON older.course_id = newer.course_id AND older.date = newer.date AND older.id < newer.id;
+    '''),
+    step('''
+        ALTER TABLE canvas_course_usage
+        ADD UNIQUE KEY course_id_date (course_id, date);
+    ''')
+]
@@ -0,0 +1,168 @@
+'''
+Writes snapshots of the tables a job loads, as CSV (the CREATE_CSVS output), Parquet or Arrow IPC
+(Feather V2) files, in a background thread so the writes overlap the database load. Columnar
+snapshots use the dtypes from course_inventory.schema, are compressed, and can be split by term
+into Hive-style term_id=<ID> directories, which pandas, pyarrow and Spark read as one dataset.
+'''
+
+# standard libraries
+import contextvars, logging, os, shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+# third-party libraries
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+# local libraries
+from course_inventory.schema import TABLE_DTYPES, apply_schema
+from instrumentation.spans import record, span
+
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'parquet', 'arrow')
+EXPORT_COMPRESSIONS = ('zstd', 'lz4', 'uncompressed')
+
+FILE_EXTENSIONS: Dict[str, str] = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+ARROW_TYPES: Dict[str, pa.DataType] = {
+    'int32': pa.int32(),
+    'int64': pa.int64(),
+    'object': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    # Parquet can't store nanoseconds, and Canvas times are to the second
+    'datetime64[ns]': pa.timestamp('us')
+}
+
+
+def make_arrow_table(table_name: str, df: pd.DataFrame) -> pa.Table:
+    '''
+    Converts df to an Arrow table, using the types from the table's schema where it has one (so
+    e.g. an all-null published_at column is still a timestamp) and inferring the rest.
+    '''
+    dtypes = TABLE_DTYPES.get(table_name, {})
+    if dtypes:
+        df = apply_schema(df, table_name)
+    inferred_schema = pa.Schema.from_pandas(df, preserve_index=False)
+    arrow_schema = pa.schema([
+        pa.field(field.name, ARROW_TYPES[dtypes[field.name]]) if dtypes.get(field.name) in ARROW_TYPES else field
+        for field in inferred_schema
+    ])
+    return pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False, safe=True)
+
+
+class SnapshotWriter:
+    '''
+    Queues table snapshots to be written by a single background thread. Each snapshot replaces
+    the previous run's once it's complete, so readers don't see partly written files. Tables with
+    a term_id column, or a course_id column when course_term_ids (term IDs indexed by course ID) is
+    given, are written to a directory per term when partition_by_term is set; CSVs never are.
+    '''
+
+    def __init__(
+        self,
+        directory: str,
+        formats: Sequence[str],
+        compression: str = 'zstd',
+        partition_by_term: bool = False,
+        course_term_ids: Optional[pd.Series] = None
+    ) -> None:
+        for export_format in formats:
+            if export_format not in EXPORT_FORMATS:
+                raise ValueError(f'Invalid export format: {export_format}')
+        if compression not in EXPORT_COMPRESSIONS:
+            raise ValueError(f'Invalid export compression: {compression}')
+        self.directory: str = directory
+        self.formats: List[str] = list(formats)
+        self.compression: str = compression
+        self.partition_by_term: bool = partition_by_term
+        self.course_term_ids: Optional[pd.Series] = course_term_ids
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+        self.futures: List[Future] = []
+
+    def submit(self, table_name: str, df: pd.DataFrame) -> None:
+        '''
+        Queues df to be written in each format; df must not be changed until wait returns.
+        '''
+        for export_format in self.formats:
+            # The context is copied so the export's span is recorded under the job's
+            self.futures.append(self.executor.submit(
+                contextvars.copy_context().run, self.write_snapshot, table_name, df, export_format
+            ))
+
+    def write_snapshot(self, table_name: str, df: pd.DataFrame, export_format: str) -> None:
+        with span(f'export_{table_name}_{export_format}'):
+            if export_format == 'csv':
+                path = os.path.join(self.directory, f'{table_name}.csv')
+                self.write_csv(df, path)
+            else:
+                path = os.path.join(self.directory, export_format, f'{table_name}.{FILE_EXTENSIONS[export_format]}')
+                term_ids = self.get_term_ids(df) if self.partition_by_term else None
+                if term_ids is None:
+                    self.write_columnar(make_arrow_table(table_name, df), path, export_format)
+                else:
+                    path = os.path.join(self.directory, export_format, table_name)
+                    self.write_partitions(table_name, df, term_ids, path, export_format)
+            record(rows=len(df))
+        logger.info(f'Wrote {len(df)} {table_name} records to {os.path.relpath(path, self.directory)}')
+
+    def get_term_ids(self, df: pd.DataFrame) -> Optional[pd.Series]:
+        if 'term_id' in df.columns:
+            return df['term_id']
+        if 'course_id' in df.columns and self.course_term_ids is not None:
+            return df['course_id'].map(self.course_term_ids)
+        return None
+
+    def write_csv(self, df: pd.DataFrame, path: str) -> None:
+        temp_path = f'{path}.tmp'
+        df.to_csv(temp_path, index=False)
+        os.replace(temp_path, path)
+
+    def write_columnar(self, arrow_table: pa.Table, path: str, export_format: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.tmp'
+        if export_format == 'parquet':
+            pq.write_table(
+                arrow_table, temp_path, compression='NONE' if self.compression == 'uncompressed' else self.compression
+            )
+        else:
+            feather.write_feather(arrow_table, temp_path, compression=self.compression)
+        os.replace(temp_path, path)
+
+    def write_partitions(
+        self,
+        table_name: str,
+        df: pd.DataFrame,
+        term_ids: pd.Series,
+        path: str,
+        export_format: str
+    ) -> None:
+        # The term is in each directory's name, so (as with Hive partitions) it isn't a column;
+        # records of courses without a known term go in term_id=-1
+        partition_df = df.drop(columns=['term_id'], errors='ignore')
+        temp_path = f'{path}.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for term_id, term_df in partition_df.groupby(term_ids.fillna(-1).astype('int64').values, sort=True):
+            self.write_columnar(
+                make_arrow_table(table_name, term_df),
+                os.path.join(temp_path, f'term_id={term_id}', f'{table_name}.{FILE_EXTENSIONS[export_format]}'),
+                export_format
+            )
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+
+    def wait(self) -> None:
+        '''
+        Waits for the queued snapshots to be written, raising the first error, if any; no more can
+        be submitted afterwards.
+        '''
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,192 @@
+# standard libraries
+import logging, os, re, threading
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+# third-party libraries
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+# Latency bucket upper bounds in seconds, each 25% above the previous one (1 ms to about 4 min),
+# so percentiles interpolated within a bucket are within about 12% of the true value
+BUCKET_BOUNDS: List[float] = [0.001 * 1.25 ** i for i in range(56)] + [float('inf')]
+
+ID_SEGMENT_PATTERN = re.compile(r'^(\d+|[0-9a-f]{32,}|[0-9a-f-]{36})$', re.IGNORECASE)
+
+
+def make_endpoint_template(method: str, url: str) -> str:
+    '''
+    Reduces a URL to an endpoint template by dropping the query string and replacing ID-like
+    path segments, e.g. "GET canvas.example.edu/api/v1/courses/:id/analytics/activity".
+    '''
+    parsed_url = urlparse(url)
+    segments = [
+        ':id' if ID_SEGMENT_PATTERN.match(segment) else segment
+        for segment in parsed_url.path.split('/')
+    ]
+    return f'{method.upper()} {parsed_url.netloc}{"/".join(segments)}'
+
+
+class EndpointStats:
+
+    __slots__ = (
+        'count', 'latency_sum', 'bucket_counts', 'status_counts', 'num_retries', 'bytes_received', 'bytes_sent'
+    )
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.latency_sum: float = 0.0
+        self.bucket_counts: List[int] = [0] * len(BUCKET_BOUNDS)
+        self.status_counts: Counter = Counter()
+        self.num_retries: int = 0
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+
+    def get_percentile(self, fraction: float) -> float:
+        '''
+        Estimates a latency percentile by interpolating within the bucket containing it.
+        '''
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        cumulative_count = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            if bucket_count and cumulative_count + bucket_count >= target:
+                lower_bound = BUCKET_BOUNDS[i - 1] if i > 0 else 0.0
+                upper_bound = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) - 1 else lower_bound
+                return lower_bound + (upper_bound - lower_bound) * (target - cumulative_count) / bucket_count
+            cumulative_count += bucket_count
+        return BUCKET_BOUNDS[-2]
+
+
+class HttpMetrics:
+    '''
+    Aggregates HTTP calls by endpoint template: a latency histogram, status code counts (0 for
+    calls that failed without a response), retries, and bytes sent and received. Safe to use from
+    several threads.
+    '''
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.endpoints: Dict[str, EndpointStats] = {}
+
+    def get_stats(self, endpoint: str) -> EndpointStats:
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointStats()
+        return self.endpoints[endpoint]
+
+    def observe(
+        self,
+        method: str,
+        url: str,
+        status: int,
+        seconds: float,
+        bytes_received: int = 0,
+        bytes_sent: int = 0
+    ) -> None:
+        endpoint = make_endpoint_template(method, url)
+        with self.lock:
+            stats = self.get_stats(endpoint)
+            stats.count += 1
+            stats.latency_sum += seconds
+            stats.bucket_counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+            stats.status_counts[status] += 1
+            stats.bytes_received += bytes_received
+            stats.bytes_sent += bytes_sent
+
+    def observe_response(self, response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        '''
+        Records a requests response; can be added to a session's response hooks.
+        '''
+        request_body = response.request.body if response.request is not None else None
+        self.observe(
+            response.request.method if response.request is not None else 'GET',
+            response.url,
+            response.status_code,
+            response.elapsed.total_seconds(),
+            len(response.content),
+            len(request_body) if request_body is not None else 0
+        )
+
+    def record_retry(self, method: str, url: str) -> None:
+        endpoint = make_endpoint_template(method, url)
+        with self.lock:
+            self.get_stats(endpoint).num_retries += 1
+
+    def reset(self) -> None:
+        with self.lock:
+            self.endpoints = {}
+
+    def log_summary(self) -> None:
+        with self.lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: -item[1].latency_sum)
+        if not endpoints:
+            return
+        logger.info('HTTP requests by endpoint (sorted by total time):')
+        for endpoint, stats in endpoints:
+            statuses = ', '.join(f'{status}: {count}' for status, count in sorted(stats.status_counts.items()))
+            logger.info(
+                f'{endpoint}: {stats.count} request(s), {stats.num_retries} retries; '
+                f'p50 {stats.get_percentile(0.5):.3f}s, p95 {stats.get_percentile(0.95):.3f}s, '
+                f'p99 {stats.get_percentile(0.99):.3f}s, total {stats.latency_sum:.1f}s; '
+                f'{stats.bytes_received / 2 ** 20:.1f} MiB received; statuses {{{statuses}}}'
+            )
+
+    def write_prometheus_textfile(self, path: str, job_name: str) -> None:
+        '''
+        Writes the metrics in the Prometheus text format (e.g. for node_exporter's textfile
+        collector); the file is replaced atomically.
+        '''
+        # Each metric family's samples have to be grouped together after its TYPE line
+        families: Dict[str, List[str]] = {
+            'http_request_duration_seconds': ['# TYPE http_request_duration_seconds histogram'],
+            'http_requests_total': ['# TYPE http_requests_total counter'],
+            'http_request_retries_total': ['# TYPE http_request_retries_total counter'],
+            'http_response_bytes_total': ['# TYPE http_response_bytes_total counter'],
+            'http_request_bytes_total': ['# TYPE http_request_bytes_total counter']
+        }
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+        for endpoint, stats in endpoints:
+            method, _, path_template = endpoint.partition(' ')
+            labels = f'job="{job_name}",method="{method}",endpoint="{path_template}"'
+            duration_lines = families['http_request_duration_seconds']
+            cumulative_count = 0
+            for bound, bucket_count in zip(BUCKET_BOUNDS, stats.bucket_counts):
+                cumulative_count += bucket_count
+                bound_label = '+Inf' if bound == float('inf') else f'{bound:.6g}'
+                duration_lines.append(
+                    f'http_request_duration_seconds_bucket{{{labels},le="{bound_label}"}} {cumulative_count}'
+                )
+            duration_lines.append(f'http_request_duration_seconds_sum{{{labels}}} {stats.latency_sum:.6f}')
+            duration_lines.append(f'http_request_duration_seconds_count{{{labels}}} {stats.count}')
+            for status, count in sorted(stats.status_counts.items()):
+                families['http_requests_total'].append(f'http_requests_total{{{labels},status="{status}"}} {count}')
+            families['http_request_retries_total'].append(f'http_request_retries_total{{{labels}}} {stats.num_retries}')
+            families['http_response_bytes_total'].append(
+                f'http_response_bytes_total{{{labels}}} {stats.bytes_received}'
+            )
+            families['http_request_bytes_total'].append(f'http_request_bytes_total{{{labels}}} {stats.bytes_sent}')
+        lines = [line for family_lines in families.values() for line in family_lines]
+
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+        logger.info(f'Wrote HTTP metrics to {path}')
+
+
+# Shared by every module; Job.run resets it before each job and summarizes it afterwards
+HTTP_METRICS = HttpMetrics()
+
+
+def summarize_http_metrics(job_name: str, textfile_dir: Optional[str] = None) -> None:
+    HTTP_METRICS.log_summary()
+    if textfile_dir:
+        HTTP_METRICS.write_prometheus_textfile(
+            os.path.join(textfile_dir, f'{job_name.lower()}_http.prom'), job_name
+        )
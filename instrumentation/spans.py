@@ -0,0 +1,100 @@
+# standard libraries
+import logging, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    '''
+    Timing and throughput for one named piece of work (a job or a stage). Counts recorded while
+    a span is current are added to it and to the spans containing it. CPU time is the process's,
+    so it includes other threads working at the same time.
+    '''
+
+    __slots__ = (
+        'name', 'parent', 'started_at', 'finished_at', 'cpu_started_at', 'cpu_seconds',
+        'rows_produced', 'num_requests', 'num_retries', 'bytes_received'
+    )
+
+    def __init__(self, name: str, parent: Optional['Span'] = None) -> None:
+        self.name: str = name
+        self.parent: Optional[Span] = parent
+        self.started_at: float = time.time()
+        self.finished_at: Optional[float] = None
+        self.cpu_started_at: float = time.process_time()
+        self.cpu_seconds: float = 0.0
+        self.rows_produced: int = 0
+        self.num_requests: int = 0
+        self.num_retries: int = 0
+        self.bytes_received: int = 0
+
+    @property
+    def path(self) -> str:
+        return self.name if self.parent is None else f'{self.parent.path}/{self.name}'
+
+    def finish(self) -> None:
+        self.finished_at = time.time()
+        self.cpu_seconds = time.process_time() - self.cpu_started_at
+
+    def to_record(self) -> Dict[str, Any]:
+        finished_at = self.finished_at if self.finished_at is not None else time.time()
+        return {
+            'stage_name': self.path,
+            'started_at': self.started_at,
+            'finished_at': finished_at,
+            'wall_seconds': round(finished_at - self.started_at, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'rows_produced': self.rows_produced,
+            'num_requests': self.num_requests,
+            'num_retries': self.num_retries,
+            'bytes_received': self.bytes_received
+        }
+
+
+# The current span follows the context, so it carries into asyncio tasks, and into threads
+# when work is submitted with contextvars.copy_context().run
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+_lock = threading.Lock()
+_finished_spans: List[Span] = []
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span]:
+    new_span = Span(name, _current_span.get())
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    finally:
+        _current_span.reset(token)
+        new_span.finish()
+        with _lock:
+            _finished_spans.append(new_span)
+        logger.debug(f'Span {new_span.path} took {new_span.finished_at - new_span.started_at:.1f} seconds')
+
+
+def record(rows: int = 0, requests: int = 0, retries: int = 0, bytes_received: int = 0) -> None:
+    '''
+    Adds counts to the current span and the spans containing it; does nothing outside a span.
+    '''
+    current_span = _current_span.get()
+    with _lock:
+        while current_span is not None:
+            current_span.rows_produced += rows
+            current_span.num_requests += requests
+            current_span.num_retries += retries
+            current_span.bytes_received += bytes_received
+            current_span = current_span.parent
+
+
+def pop_span_records() -> List[Dict[str, Any]]:
+    '''
+    Returns records for the spans finished since the last call, in the order they started.
+    '''
+    with _lock:
+        finished_spans = sorted(_finished_spans, key=lambda finished_span: finished_span.started_at)
+        _finished_spans.clear()
+    return [finished_span.to_record() for finished_span in finished_spans]
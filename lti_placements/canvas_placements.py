@@ -3,7 +3,6 @@
 import json
 import logging
 import math
-import os
 import re
 from typing import Dict, List, Optional, Sequence, Union
 
@@ -12,8 +11,12 @@ import pandas as pd
 import requests
 from bs4 import BeautifulSoup as bs
 
-from db.db_creator import DBCreator
+from canvas_client.client import CanvasClient
+from db.db_creator import DBCreator, get_staging_table_name
 from environ import ENV, DATA_DIR
+from export.snapshots import SnapshotWriter
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record, span
 from vocab import DataSourceStatus, ValidDataSourceName
 
 logger = logging.getLogger(__name__)
@@ -29,11 +32,10 @@ class CanvasLtiPlacementProcessor:
     course_count: int = 0
     placement_count: int = 0
 
-    def __init__(self,
-                 canvas_url: str,
-                 canvas_token: str):
-        self.canvas = canvasapi.Canvas(canvas_url, canvas_token)
-        self.zoom_placements = ZoomPlacements(self.canvas)
+    def __init__(self, canvas_client: CanvasClient):
+        self.canvas_client = canvas_client
+        self.canvas = canvasapi.Canvas(canvas_client.canvas_url, canvas_client.canvas_token)
+        self.zoom_placements = ZoomPlacements(self.canvas, canvas_client)
         self.db_creator: DBCreator = DBCreator(ENV['INVENTORY_DB'])
         self.supported_tools = self.get_supported_lti_tools()
 
@@ -43,7 +45,7 @@ class CanvasLtiPlacementProcessor:
                                    add_course_ids: Union[List[int], None],
                                    published: bool = True):
     
-        account = self.canvas.get_account(canvas_account_id)
+        account = self.canvas_client.call_limited(self.canvas.get_account, canvas_account_id)
         # Canvas has a limit of 100 per page on this API
         per_page = 100
 
@@ -52,13 +54,13 @@ class CanvasLtiPlacementProcessor:
         if enrollment_term_ids is not None:
             for enrollment_term_id in enrollment_term_ids:
                 logger.info(f'Fetching published course data for term {enrollment_term_id}')
-                courses_list = list(
+                courses_list = list(self.canvas_client.iterate_limited(
                     account.get_courses(
                         enrollment_term_id=enrollment_term_id,
                         published=published,
                         per_page=per_page
                     )
-                )
+                ))
                 courses += courses_list
 
         for course in courses:
@@ -71,7 +73,7 @@ class CanvasLtiPlacementProcessor:
         # If there are course_ids passed in, also process those
         if add_course_ids:
             for course_id in add_course_ids:
-                self.get_lti_tabs(self.canvas.get_course(course_id))
+                self.get_lti_tabs(self.canvas_client.call_limited(self.canvas.get_course, course_id))
         return None
 
     def get_supported_lti_tools(self) -> List[Union[int, None]]:
@@ -82,7 +84,7 @@ class CanvasLtiPlacementProcessor:
         self.course_count += 1
         logger.info(f"Fetching course #{self.course_count} for {course}")
         # Get tabs and look for defined tool(s) that aren't hidden
-        tabs = course.get_tabs()
+        tabs = self.canvas_client.iterate_limited(course.get_tabs())
         for tab in tabs:
             # The format in canvas of ids is like
             # context_external_tool_12345. But we need the numeric part
@@ -117,32 +119,54 @@ class CanvasLtiPlacementProcessor:
         lti_zoom_meeting_df = pd.DataFrame(self.zoom_courses_meetings)
         lti_zoom_meeting_df.index.name = "id"
 
-        if ENV.get('CREATE_CSVS', False):
-            logger.info(f'Writing {len(lti_placement_df)} lti_placement records to CSV')
-            lti_placement_df.to_csv(os.path.join(DATA_DIR, "lti_placement.csv"))
-            logger.info(f'Writing {len(lti_zoom_meeting_df)} lti_zoom_meeting records to CSV')
-            lti_zoom_meeting_df.to_csv(os.path.join(DATA_DIR, "lti_zoom_meeting.csv"))
+        load_dfs = [('lti_placement', lti_placement_df), ('lti_zoom_meeting', lti_zoom_meeting_df)]
+        table_names = [table_name for table_name, _ in load_dfs]
 
-        # For now until this process is improved just remove all the previous records
-        logger.info('Emptying Canvas LTI data tables in DB')
-        self.db_creator.drop_records(
-            ['lti_placement', 'lti_zoom_meeting']
+        export_formats = sorted(
+            set(ENV.get('EXPORT_FORMATS', [])) | ({'csv'} if ENV.get('CREATE_CSVS', False) else set())
         )
+        snapshot_writer = None
+        if export_formats:
+            # Snapshots are written in the background while the data is loaded into the DB
+            snapshot_writer = SnapshotWriter(DATA_DIR, export_formats, ENV.get('EXPORT_COMPRESSION', 'zstd'))
+            for table_name, load_df in load_dfs:
+                snapshot_writer.submit(table_name, load_df.reset_index())
+
+        if ENV.get('DB_LOAD_MODE', 'replace') == 'staging':
+            # Load into staging tables and publish them together, so readers never see partial data
+            logger.info('Creating staging tables for Canvas LTI data tables in DB')
+            self.db_creator.create_staging_tables(table_names)
+            try:
+                for table_name, load_df in load_dfs:
+                    staging_table_name = get_staging_table_name(table_name)
+                    logger.info(f'Inserting {len(load_df)} {table_name} records to DB')
+                    self.db_creator.bulk_insert(staging_table_name, load_df.reset_index())
+                    logger.info(f'Inserted data into {staging_table_name} table in {self.db_creator.db_name}')
+            except Exception:
+                self.db_creator.drop_staging_tables(table_names)
+                raise
+            self.db_creator.swap_staging_tables(table_names)
+        else:
+            # For now until this process is improved just remove all the previous records
+            logger.info('Emptying Canvas LTI data tables in DB')
+            self.db_creator.drop_records(table_names)
 
-        logger.info(f'Inserting {len(lti_placement_df)} lti_placement records to DB')
-        lti_placement_df.to_sql("lti_placement", self.db_creator.engine, if_exists="append", index=True)
-        logger.info(f'Inserted data into lti_placement table in {self.db_creator.db_name}')
+            for table_name, load_df in load_dfs:
+                logger.info(f'Inserting {len(load_df)} {table_name} records to DB')
+                self.db_creator.bulk_insert(table_name, load_df.reset_index())
+                logger.info(f'Inserted data into {table_name} table in {self.db_creator.db_name}')
 
-        logger.info(f'Inserting {len(lti_zoom_meeting_df)} lti_zoom_meeting records to DB')
-        lti_zoom_meeting_df.to_sql("lti_zoom_meeting", self.db_creator.engine, if_exists="append", index=True)
-        logger.info(f'Inserted data into lti_zoom_meeting table in {self.db_creator.db_name}')
+        if snapshot_writer is not None:
+            snapshot_writer.wait()
 
 
 class ZoomPlacements():
 
-    def __init__(self, canvas: canvasapi.Canvas):
-        self.zoom_session = requests.Session()
+    def __init__(self, canvas: canvasapi.Canvas, canvas_client: CanvasClient):
+        # A separate pooled session, so the Canvas token and Zoom cookies aren't shared
+        self.zoom_session = canvas_client.create_session()
         self.canvas = canvas
+        self.canvas_client = canvas_client
 
     def get_zoom_json(self, **kwargs) -> Optional[Dict]:
         """Retrieves data directly from Zoom. You need to have zoom_session already setup
@@ -195,9 +219,13 @@ class ZoomPlacements():
 
         logger.info("Found a course with zoom as %s", tab.id)
 
-        r = self.canvas._Canvas__requester.request("GET", _url=tab.url)
+        r = self.canvas_client.get(tab.url)
+        if not r.ok:
+            logger.warning("Could not get the zoom launch URL (status %s) for %s, skipping", r.status_code, tab.url)
+            return []
         external_url = r.json().get("url")
         r = requests.get(external_url)
+        HTTP_METRICS.observe_response(r)
         # Parse out the form from the response
         soup = bs(r.text, 'html.parser')
         # Get the form and parse out all of the inputs
@@ -255,16 +283,23 @@ def main() -> Sequence[DataSourceStatus]:
 
     # Get ids for tools in lti_type table as supported tools
     canvas_env = ENV.get('CANVAS', {})
-    lti_processor = CanvasLtiPlacementProcessor(
+    canvas_client = CanvasClient(
         canvas_env.get("CANVAS_URL"),
-        canvas_env.get("CANVAS_TOKEN"))
-
-    lti_processor.generate_lti_course_report(
-        canvas_env.get("CANVAS_ACCOUNT_ID", 1),
-        canvas_env.get("CANVAS_TERM_IDS", []),
-        canvas_env.get("ADD_COURSE_IDS", []),
-        True)
-    lti_processor.output_report()
+        canvas_env.get("CANVAS_TOKEN"),
+        ENV.get('NUM_ASYNC_WORKERS', 8),
+        ENV.get('RATE_LIMIT_THRESHOLD', 200))
+    lti_processor = CanvasLtiPlacementProcessor(canvas_client)
+
+    with span('lti_course_report'):
+        lti_processor.generate_lti_course_report(
+            canvas_env.get("CANVAS_ACCOUNT_ID", 1),
+            canvas_env.get("CANVAS_TERM_IDS", []),
+            canvas_env.get("ADD_COURSE_IDS", []),
+            True)
+        record(rows=len(lti_processor.lti_placements) + len(lti_processor.zoom_courses_meetings))
+    with span('output_report'):
+        lti_processor.output_report()
+    canvas_client.close()
 
     return [DataSourceStatus(ValidDataSourceName.CANVAS_LTI)]
 
@@ -4,8 +4,9 @@ Module for setting up and running the MiVideo data extract.
 '''
 import logging
 import os
+import time
 from datetime import datetime
-from typing import Dict, Iterable, Sequence, Union
+from typing import Dict, Sequence, Union
 
 import pandas as pd
 from KalturaClient import KalturaClient, KalturaConfiguration
@@ -17,12 +18,13 @@ from KalturaClient.Plugins.Core import (
 from KalturaClient.exceptions import KalturaException
 from google.cloud import bigquery
 from google.oauth2 import service_account
-from pandas.io.sql import SQLTable
-from sqlalchemy.engine import Connection, ResultProxy
+from sqlalchemy.engine import ResultProxy
 from sqlalchemy.exc import SQLAlchemyError
 
 import mivideo.queries as queries
 from db.db_creator import DBCreator
+from instrumentation.http_metrics import HTTP_METRICS
+from instrumentation.spans import record, span
 from environ import CONFIG_DIR, ENV
 from vocab import DataSourceStatus, ValidDataSourceName
 
@@ -154,7 +156,8 @@ class MiVideoExtract:
 
             logger.debug('Saving to table...')
 
-            dfCourseEvents.to_sql(tableName, self.appDb.engine, if_exists='append', index=False)
+            self.appDb.bulk_insert(tableName, dfCourseEvents)
+            record(rows=len(dfCourseEvents))
 
             logger.debug('Saved.')
         else:
@@ -164,30 +167,6 @@ class MiVideoExtract:
 
         return DataSourceStatus(ValidDataSourceName.UNIZIN_DATA_PLATFORM_EVENTS)
 
-    @staticmethod
-    def _queryRunner(
-            pandasTable: SQLTable,
-            dbConn: Connection,
-            columnNameList: Sequence[str],
-            data: Iterable):
-        '''
-        This handles the fairly rare occurrence of conflicting keys when
-        inserting data into a table.
-        '''
-
-        tableFullName = pandasTable.name
-        if (pandasTable.schema):
-            tableFullName = f'{pandasTable.schema}.{tableFullName}'
-        columnNames = ', '.join(columnNameList)
-        valuePlaceholders = ', '.join(['%s'] * len(columnNameList))
-
-        sql = (
-            f'INSERT INTO {tableFullName} ({columnNames}) VALUES ({valuePlaceholders}) '
-            f'ON DUPLICATE KEY UPDATE {columnNameList[0]}={columnNameList[0]}'  # magic
-        )
-
-        dbConn.execute(sql, list(data))
-
     def mediaCreation(self) -> DataSourceStatus:
         """
         Update data with Kaltura media metadata from Kaltura API.
@@ -230,10 +209,17 @@ class MiVideoExtract:
         totalNumberResults: int = numberResults  # for logging purposes
         endOfResults = False
 
+        # For HTTP_METRICS; the Kaltura client doesn't expose its responses
+        kalturaListUrl: str = f'{kClient.config.serviceUrl}/api_v3/service/media/action/list'
+
         while not endOfResults:
+            kalturaListStart: float = time.perf_counter()
             try:
+                record(requests=1)
                 results = kMedia.list(kFilter, kPager).objects
+                HTTP_METRICS.observe('POST', kalturaListUrl, 200, time.perf_counter() - kalturaListStart)
             except KalturaException as kException:
+                HTTP_METRICS.observe('POST', kalturaListUrl, 0, time.perf_counter() - kalturaListStart)
                 if (KALTURA_MAX_MATCHES_ERROR in kException.args):
                     # set new filter timestamp, reset pager to page 1, then continue
                     kFilter.createdAtGreaterThanOrEqual = lastCreatedAtTimestamp
@@ -258,13 +244,13 @@ class MiVideoExtract:
 
                 creationData: pd.DataFrame = self._makeCreationData(resultDictionaries)
 
-                creationData.to_sql(
-                    tableName, self.appDb.engine, if_exists='append', index=False)
+                self.appDb.bulk_insert(tableName, creationData)
+                record(rows=len(creationData))
 
                 courseData: pd.DataFrame = self._makeCourseData(resultDictionaries)
 
-                courseData.to_sql('mivideo_media_courses', self.appDb.engine, if_exists='append',
-                                  index=False, method=self._queryRunner)
+                # Conflicting keys are fairly rare; the existing records are kept
+                self.appDb.bulk_insert('mivideo_media_courses', courseData, on_duplicate='ignore')
 
                 lastCreatedAtTimestamp = results[-1].createdAt
                 lastId = results[-1].id
@@ -354,10 +340,11 @@ class MiVideoExtract:
 
         :return: List of DataSourceStatus
         '''
-        return [
-            self.mediaStartedHourly(),
-            self.mediaCreation(),
-        ]
+        with span('media_started_hourly'):
+            mediaStartedStatus: DataSourceStatus = self.mediaStartedHourly()
+        with span('media_creation'):
+            mediaCreationStatus: DataSourceStatus = self.mediaCreation()
+        return [mediaStartedStatus, mediaCreationStatus]
 
 
 def main() -> Sequence[DataSourceStatus]:
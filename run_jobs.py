@@ -1,7 +1,7 @@
 # standard libraries
 import logging, os, sys, time
 from importlib import import_module
-from typing import Sequence, Union
+from typing import Any, Dict, Sequence, Union
 
 # third-party libraries
 import pandas as pd
@@ -10,6 +10,8 @@ import sqlalchemy
 # local libraries
 from db.db_creator import DBCreator
 from environ import ENV
+from instrumentation.http_metrics import HTTP_METRICS, summarize_http_metrics
+from instrumentation.spans import pop_span_records, span
 from vocab import DataSourceStatus, JobError, ValidJobName
 
 # Initialize settings and global variables
@@ -27,6 +29,7 @@ class Job:
         self.started_at: Union[float, None] = None
         self.finished_at: Union[float, None] = None
         self.data_sources: Sequence[DataSourceStatus] = []
+        self.span_records: Sequence[Dict[str, Any]] = []
 
     def create_metadata(self) -> None:
         started_at_dt = pd.to_datetime(self.started_at, unit='s')
@@ -37,7 +40,7 @@ class Job:
             'started_at': [started_at_dt],
             'finished_at': [finished_at_dt]
         })
-        job_run_df.to_sql('job_run', db_creator_obj.engine, if_exists='append', index=False)
+        db_creator_obj.bulk_insert('job_run', job_run_df)
         logger.info(
             f'Inserted job_run record for job_name "{self.name}" '
             f'with finished_at value of "{finished_at_dt}"')
@@ -51,19 +54,30 @@ class Job:
                     data_source.copy() for data_source in self.data_sources)
                     .assign(**{'job_run_id': job_run_id}))
 
-            data_source_status_df.to_sql(
-                'data_source_status', db_creator_obj.engine, if_exists='append', index=False)
+            db_creator_obj.bulk_insert('data_source_status', data_source_status_df)
             logger.info(f'Inserted ({len(data_source_status_df)}) data_source_status records')
 
+        if len(self.span_records) > 0:
+            job_run_stage_df = pd.DataFrame.from_records(self.span_records).assign(**{'job_run_id': job_run_id})
+            for time_column in ['started_at', 'finished_at']:
+                job_run_stage_df[time_column] = pd.to_datetime(job_run_stage_df[time_column], unit='s')
+
+            db_creator_obj.bulk_insert('job_run_stage', job_run_stage_df)
+            logger.info(f'Inserted ({len(job_run_stage_df)}) job_run_stage records')
+
     def run(self) -> None:
         leaf_module = import_module(self.import_path)
         start_method = getattr(leaf_module, self.method_name)
 
         # Until we have a decorator for this
         self.started_at = time.time()
+        HTTP_METRICS.reset()
         try:
-            self.data_sources = start_method()
+            # Stages and other spans started by the job are recorded in job_run_stage
+            with span(self.name):
+                self.data_sources = start_method()
             self.finished_at = time.time()
+            self.span_records = pop_span_records()
 
             delta = self.finished_at - self.started_at
             str_time = time.strftime('%H:%M:%S', time.gmtime(delta))
@@ -71,9 +85,12 @@ class Job:
 
             self.create_metadata()
         except JobError as je:
+            pop_span_records()
             logger.error(f'JobError: {je}')
             logger.error(f'An error prevented the {self.name} job from finishing')
             logger.info('The program will continue running other jobs')
+        finally:
+            summarize_http_metrics(self.name, ENV.get('PROMETHEUS_TEXTFILE_DIR'))
 
 
 class JobManager:
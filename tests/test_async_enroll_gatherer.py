@@ -0,0 +1,88 @@
+# standard libraries
+import json, unittest
+from collections import Counter
+from concurrent.futures import Future
+from typing import Dict, Sequence
+
+# local libraries
+from canvas_client.client import CanvasClient
+from course_inventory.async_enroll_gatherer import AsyncEnrollGatherer
+
+
+class FakeResponse:
+
+    def __init__(self, status_code: int, text: str) -> None:
+        self.status_code: int = status_code
+        self.text: str = text
+
+
+def make_course_page(course_id: int) -> str:
+    node = {
+        '_id': str(course_id * 10),
+        'user': {'_id': '1'},
+        'course': {'_id': str(course_id)},
+        'section': {'_id': str(course_id * 100), 'name': f'Section {course_id}'},
+        'type': 'StudentEnrollment',
+        'state': 'active'
+    }
+    return json.dumps({'data': {'course': {
+        '_id': str(course_id),
+        'enrollmentsConnection': {'pageInfo': {'endCursor': 'end', 'hasNextPage': False}, 'nodes': [node]}
+    }}})
+
+
+class FakeEnrollGatherer(AsyncEnrollGatherer):
+    '''
+    Answers each course's first failures_by_course_id[course_id] requests with a 500, and the
+    ones after with a page of one enrollment.
+    '''
+
+    def __init__(self, failures_by_course_id: Dict[int, int], max_attempts: int) -> None:
+        super().__init__(
+            list(failures_by_course_id),
+            CanvasClient('http://localhost', 'token'),
+            '',
+            max_attempts=max_attempts,
+            base_delay=0.01
+        )
+        self.failures_by_course_id: Dict[int, int] = failures_by_course_id
+        self.num_requests: Counter = Counter()
+
+    def post_enrollment_request(self, course_ids: Sequence[int]) -> Future:
+        course_id = course_ids[0]
+        self.num_requests[course_id] += 1
+        future: Future = Future()
+        if self.num_requests[course_id] <= self.failures_by_course_id[course_id]:
+            future.set_result(FakeResponse(500, 'Internal Server Error'))
+        else:
+            future.set_result(FakeResponse(200, make_course_page(course_id)))
+        return future
+
+
+class AsyncEnrollGathererTestCase(unittest.TestCase):
+
+    def test_failed_course_is_retried_until_it_succeeds(self):
+        gatherer = FakeEnrollGatherer({1: 2}, max_attempts=3)
+        gatherer.gather()
+        self.assertEqual(gatherer.num_requests[1], 3)
+        self.assertEqual(gatherer.failed_course_ids, [])
+        self.assertEqual(list(gatherer.generate_output()[0]['course_id']), [1])
+
+    def test_failing_course_is_given_up_on_after_max_attempts(self):
+        gatherer = FakeEnrollGatherer({1: 0, 2: 10}, max_attempts=3)
+        gatherer.gather()
+        self.assertEqual(gatherer.num_requests, Counter({1: 1, 2: 3}))
+        self.assertEqual(gatherer.failed_course_ids, [2])
+        self.assertEqual(list(gatherer.generate_output()[0]['course_id']), [1])
+
+    def test_failed_course_backs_off_before_it_is_queued_again(self):
+        gatherer = FakeEnrollGatherer({1: 10}, max_attempts=3)
+        gatherer.base_delay = 60.0
+        gatherer.start_queue()
+        gatherer.requeue_course_ids(gatherer.pop_course_ids(), set())
+        self.assertEqual(list(gatherer.queued_course_ids), [])
+        self.assertEqual([course_id for _, _, course_id in gatherer.delayed_course_ids], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
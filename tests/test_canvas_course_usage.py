@@ -0,0 +1,92 @@
+# standard libraries
+import unittest
+from typing import Any, Dict, List, Optional, Sequence
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from course_inventory.canvas_course_usage import CanvasCourseUsage, load_incremental_course_usage
+
+
+def make_activity(course_id: int, num_days: int, revision: int = 0) -> List[Dict[str, Any]]:
+    # Days near the end are still being updated by Canvas, so their counts change with revision
+    return [
+        {
+            'date': f'2020-03-{day:02d}T00:00:00Z',
+            'views': course_id * 100 + day + (revision if day >= num_days - 1 else 0),
+            'participations': day,
+            'id': None
+        }
+        for day in range(1, num_days + 1)
+    ]
+
+
+def gather_usage(
+    activity_by_course_id: Dict[int, List[Dict[str, Any]]],
+    watermarks: Optional[pd.Series] = None
+) -> pd.DataFrame:
+    canvas_course_usage = CanvasCourseUsage(None, 0, list(activity_by_course_id), watermarks, overlap_days=2)
+    for course_id, activity in activity_by_course_id.items():
+        canvas_course_usage.usage_buffer.add_rows(course_id, activity, canvas_course_usage.get_keep_after(course_id))
+    return canvas_course_usage.canvas_course_usage_to_df()
+
+
+class FakeDBCreator:
+    '''
+    Keeps canvas_course_usage in a DataFrame, deleting and upserting by key as MySQL would.
+    '''
+
+    def __init__(self, usage_df: pd.DataFrame) -> None:
+        self.usage_df: pd.DataFrame = usage_df
+
+    def delete_keys(self, table_name: str, key_df: pd.DataFrame) -> None:
+        self.usage_df = self.usage_df[~self.usage_df['course_id'].isin(key_df['course_id'])]
+
+    def bulk_insert(self, table_name: str, df: pd.DataFrame, on_duplicate: Optional[str] = None) -> None:
+        self.usage_df = pd.concat([self.usage_df, df]).drop_duplicates(subset=['course_id', 'date'], keep='last')
+
+    def get_sorted_usage(self) -> pd.DataFrame:
+        return sort_usage(self.usage_df)
+
+
+def sort_usage(usage_df: pd.DataFrame) -> pd.DataFrame:
+    return usage_df.sort_values(['course_id', 'date'], ignore_index=True)
+
+
+class LoadIncrementalCourseUsageTestCase(unittest.TestCase):
+
+    def load_incrementally(
+        self,
+        previous_activity: Dict[int, List[Dict[str, Any]]],
+        activity: Dict[int, List[Dict[str, Any]]],
+        available_course_ids: Sequence[int]
+    ) -> pd.DataFrame:
+        db_creator_obj = FakeDBCreator(gather_usage(previous_activity))
+        watermarks = db_creator_obj.usage_df.groupby('course_id')['date'].max()
+        new_usage_df = gather_usage(activity, watermarks)
+        load_incremental_course_usage(db_creator_obj, new_usage_df, watermarks.index, available_course_ids)
+        return db_creator_obj.get_sorted_usage()
+
+    def test_incremental_load_matches_full_run(self):
+        # Course 3 is no longer available, and course 4 is new; the last stored days have changed
+        previous_activity = {course_id: make_activity(course_id, 10) for course_id in (1, 2, 3)}
+        activity = {course_id: make_activity(course_id, 12, revision=5) for course_id in (1, 2, 4)}
+
+        full_usage_df = sort_usage(gather_usage(activity))
+        incremental_usage_df = self.load_incrementally(previous_activity, activity, [1, 2, 4])
+
+        self.assertNotIn(3, incremental_usage_df['course_id'].tolist())
+        pd.testing.assert_frame_equal(incremental_usage_df, full_usage_df)
+
+    def test_only_stored_courses_that_are_not_available_are_deleted(self):
+        previous_activity = {course_id: make_activity(course_id, 10) for course_id in (1, 2)}
+
+        incremental_usage_df = self.load_incrementally(previous_activity, {2: make_activity(2, 10)}, [2])
+
+        self.assertEqual(incremental_usage_df['course_id'].unique().tolist(), [2])
+        self.assertEqual(len(incremental_usage_df), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
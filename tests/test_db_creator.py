@@ -0,0 +1,72 @@
+# standard libraries
+import unittest
+from typing import Any, List, Optional, Sequence, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from db.db_creator import DBCreator, LoadDataError
+
+
+class FakeResult:
+
+    def __init__(self, rowcount: int = 0, rows: Optional[List[Tuple[Any, ...]]] = None) -> None:
+        self.rowcount: int = rowcount
+        self.rows: List[Tuple[Any, ...]] = rows if rows is not None else []
+
+    def fetchall(self) -> List[Tuple[Any, ...]]:
+        return self.rows
+
+
+class FakeConnection:
+    '''
+    Answers LOAD DATA with the given number of added rows, and SHOW WARNINGS with the given
+    warnings; other statements are only recorded.
+    '''
+
+    def __init__(self, num_loaded_rows: int, warnings: Sequence[Tuple[Any, ...]] = ()) -> None:
+        self.num_loaded_rows: int = num_loaded_rows
+        self.warnings: List[Tuple[Any, ...]] = list(warnings)
+        self.statements: List[str] = []
+
+    def execute(self, statement: str, *args: Any) -> FakeResult:
+        self.statements.append(statement)
+        if statement.startswith('LOAD DATA'):
+            return FakeResult(rowcount=self.num_loaded_rows)
+        if statement == 'SHOW WARNINGS;':
+            return FakeResult(rows=self.warnings)
+        return FakeResult()
+
+
+class LoadDataInfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # No engine is needed, since load_data_infile is given a connection
+        self.db_creator_obj = DBCreator.__new__(DBCreator)
+        self.term_df = pd.DataFrame({'canvas_id': [1, 2, 3], 'name': ['Fall', 'Winter', 'Spring']})
+
+    def test_complete_load_without_warnings_passes(self):
+        for on_duplicate in (None, 'update'):
+            conn = FakeConnection(3)
+            self.db_creator_obj.load_data_infile(conn, 'term', self.term_df, on_duplicate)
+            self.assertIn('SHOW WARNINGS;', conn.statements)
+
+    def test_skipped_rows_raise(self):
+        for on_duplicate in (None, 'update'):
+            with self.assertRaisesRegex(LoadDataError, 'added 2 of 3 record'):
+                self.db_creator_obj.load_data_infile(FakeConnection(2), 'term', self.term_df, on_duplicate)
+
+    def test_warnings_raise(self):
+        warning = ('Warning', 1265, "Data truncated for column 'name' at row 2")
+        with self.assertRaisesRegex(LoadDataError, 'Data truncated'):
+            self.db_creator_obj.load_data_infile(FakeConnection(3, [warning]), 'term', self.term_df, None)
+
+    def test_ignored_duplicates_are_not_checked(self):
+        conn = FakeConnection(2, [('Warning', 1062, "Duplicate entry '2' for key 'PRIMARY'")])
+        self.db_creator_obj.load_data_infile(conn, 'term', self.term_df, 'ignore')
+        self.assertNotIn('SHOW WARNINGS;', conn.statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
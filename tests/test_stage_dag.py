@@ -0,0 +1,78 @@
+# standard libraries
+import threading, time, unittest
+from typing import List
+
+# local libraries
+from course_inventory.stage_dag import StageDAG
+
+
+class StageDAGTestCase(unittest.TestCase):
+
+    def test_failed_stage_stops_later_stages(self):
+        started: List[str] = []
+
+        def fail() -> None:
+            started.append('a')
+            raise RuntimeError('stage a failed')
+
+        def succeed(name: str) -> str:
+            started.append(name)
+            return name
+
+        stage_dag = StageDAG(max_workers=1)
+        stage_dag.add_stage('a', fail)
+        stage_dag.add_stage('b', lambda: succeed('b'))
+        stage_dag.add_stage('c', lambda: succeed('c'))
+        with self.assertRaisesRegex(RuntimeError, 'stage a failed'):
+            stage_dag.run()
+        self.assertEqual(started, ['a'])
+
+    def test_running_stages_are_waited_for_but_queued_ones_are_not_started(self):
+        started: List[str] = []
+        release = threading.Event()
+
+        def fail_after_b_starts() -> None:
+            time.sleep(0.05)
+            started.append('a')
+            raise RuntimeError('stage a failed')
+
+        def slow() -> str:
+            started.append('b')
+            release.wait(5)
+            return 'b'
+
+        stage_dag = StageDAG(max_workers=2)
+        stage_dag.add_stage('b', slow)
+        stage_dag.add_stage('a', fail_after_b_starts)
+        stage_dag.add_stage('c', lambda: started.append('c'))
+        timer = threading.Timer(0.2, release.set)
+        timer.start()
+        with self.assertRaisesRegex(RuntimeError, 'stage a failed'):
+            stage_dag.run()
+        timer.cancel()
+        self.assertEqual(sorted(started), ['a', 'b'])
+
+    def test_no_more_stages_than_workers_run_at_once(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def stage() -> None:
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        stage_dag = StageDAG(max_workers=2)
+        for name in 'abcdef':
+            stage_dag.add_stage(name, stage)
+        stage_dag.add_stage('g', lambda *results: len(results), dependencies=['a', 'f'])
+        results = stage_dag.run()
+        self.assertEqual(max_running[0], 2)
+        self.assertEqual(results['g'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()